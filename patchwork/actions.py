@@ -1,9 +1,11 @@
-from typing import List, Optional, Tuple
+import copy
+
+from typing import Dict, List, Optional, Tuple
 
 from .context import Context, DryContext
 from .datastore import Datastore
 from .hypertext import Workspace
-from .text_manipulation import create_raw_hypertext, insert_raw_hypertext
+from .text_manipulation import create_raw_hypertext, insert_raw_hypertext, rename_pointers
 
 class Action(object):
     def execute(
@@ -14,6 +16,14 @@ class Action(object):
         # Successor context should be first if it exists.
         raise NotImplementedError("Action is pure virtual")
 
+    def rename_pointers(self, names: Dict[str, str]) -> "Action":
+        """Return this action with the anonymous pointers in its text renamed."""
+        renamed = copy.copy(self)
+        for field, value in vars(self).items():
+            if isinstance(value, str):
+                setattr(renamed, field, rename_pointers(value, names))
+        return renamed
+
 
 # Predictability here means "the user can predict what the successor looks like based only
 # on the current workspace and the action taken." It's not very clear whether Reply should
@@ -53,12 +63,12 @@ class Scratch(PredictableAction):
 
         successor_workspace_link = db.insert(successor_workspace)
 
-        new_unlocked_locations = set(context.unlocked_locations_from_workspace(
+        new_unlocked_locations = context.unlocked_locations_from_workspace(
                 context.workspace_link,
-                db))
-        new_unlocked_locations.remove(context.workspace_link)
-        new_unlocked_locations.add(successor_workspace_link)
-        new_unlocked_locations.add(new_scratchpad_link)
+                db)
+        new_unlocked_locations = new_unlocked_locations.remove(context.workspace_link) \
+            .add(successor_workspace_link) \
+            .add(new_scratchpad_link)
 
         return (
                 Context(
@@ -102,7 +112,7 @@ class AskSubquestion(PredictableAction):
         sub_workspace = db.dereference(sub_workspace_link) # in case our copy was actually clobbered.
 
         new_subquestions = (current_workspace.subquestions +
-                [(subquestion_link, sub_workspace.answer_promise, sub_workspace.final_workspace_promise)])
+                ((subquestion_link, sub_workspace.answer_promise, sub_workspace.final_workspace_promise),))
         successor_workspace = Workspace(
                 current_workspace.question_link,
                 current_workspace.answer_promise,
@@ -113,12 +123,14 @@ class AskSubquestion(PredictableAction):
 
         successor_workspace_link = db.insert(successor_workspace)
 
-        new_unlocked_locations = set(context.unlocked_locations_from_workspace(
-            context.workspace_link, db))
-        new_unlocked_locations.remove(context.workspace_link)
-        new_unlocked_locations.add(subquestion_link)
-        new_unlocked_locations.add(successor_workspace_link)
+        new_unlocked_locations = context.unlocked_locations_from_workspace(
+            context.workspace_link, db)
+        new_unlocked_locations = new_unlocked_locations.remove(context.workspace_link) \
+            .add(subquestion_link) \
+            .add(successor_workspace_link)
 
+        # The subquestion starts with what is left of the budget, like the
+        # successor, rather than sharing it with its siblings.
         return (
                 Context(
                     successor_workspace_link,
@@ -184,19 +196,19 @@ class Unlock(Action):
         except KeyError:
             raise ValueError("{} is not visible in this context".format(self.unlock_text))
 
-        new_unlocked_locations = set(context.unlocked_locations_from_workspace(
-                context.workspace_link, db))
+        new_unlocked_locations = context.unlocked_locations_from_workspace(
+                context.workspace_link, db)
 
         if pointer_address in new_unlocked_locations:
             raise ValueError("{} is already unlocked.".format(self.unlock_text))
 
-        new_unlocked_locations.add(pointer_address)
+        new_unlocked_locations = new_unlocked_locations.add(pointer_address)
 
         dry_successor_context = DryContext(context.workspace_link,
-                                           new_unlocked_locations, context)
+                                           new_unlocked_locations, context.budget)
 
         if db.is_fulfilled(pointer_address):
-            return (None, [Context.from_dry(dry_successor_context, db)])
+            return (None, [Context.from_dry(dry_successor_context, db, context)])
 
         db.register_promisee(pointer_address, dry_successor_context)
         return (None, [])
@@ -1,35 +1,65 @@
+import hashlib
+
 from collections import defaultdict, deque
 from textwrap import indent
-from typing import DefaultDict, Dict, Deque, Generator, List, Optional, Set, Tuple
+from typing import AbstractSet, Any, DefaultDict, Dict, Deque, Generator, Iterator, List, Mapping, Optional, \
+    Set, Tuple, Union, cast
 
 import attr
 
 from .datastore import Address, Datastore
 from .hypertext import Workspace, visit_unlocked_region
-from .text_manipulation import make_link_texts
+from .persistent import PersistentSet
+from .text_manipulation import Fragment, canonicalize_pointer_names, make_link_texts, render_fragment
 
 
 @attr.s(frozen=True)
 class DryContext(object):
     """Stores the arguments for reconstituting a Context in the future."""
     workspace_link = attr.ib(type=Address)
-    unlocked_locations = attr.ib(type=Optional[Set[Address]])
-    parent = attr.ib(type=Optional["Context"])
+    unlocked_locations = attr.ib(type=Optional[AbstractSet[Address]])
+    budget = attr.ib(type=int) # See Context.budget
+
+    def references(self) -> List[Any]:
+        """Return the addresses and contexts that this refers to."""
+        return _context_references(self)
+
 
+def _context_references(context: Union[DryContext, "Context"]) -> List[Any]:
+    result: List[Any] = [context.workspace_link]
+    if context.unlocked_locations is not None:
+        result.extend(context.unlocked_locations)
+    return result
 
-def _can_advance_promise(db: Datastore, wsaddr: Address, promise: Address) \
-        -> bool:
-    """See :py:meth:`Context.can_advance_promise`."""
-    ws_promises = db.dereference(wsaddr).promises
 
-    if promise in ws_promises:
-        return True
+class _LinkTexts(Mapping):
+    """The texts of the links visible in a context, from its fragments."""
+    def __init__(
+            self,
+            fragments: Dict[Address, Fragment],
+            pointer_names: Dict[Address, str],
+            unlocked_region: Set[Address],
+            ) -> None:
+        self.fragments = fragments
+        self.pointer_names = pointer_names
+        self.unlocked_region = unlocked_region
 
-    promisee_wsaddrs = (dry_context.workspace_link
-                        for p in ws_promises
-                        for dry_context in db.get_promisees(p))
-    return any(_can_advance_promise(db, pwsa, promise)
-               for pwsa in promisee_wsaddrs)
+    def __getitem__(self, link: Address) -> str:
+        if link in self.unlocked_region:
+            return self.fragments[link][2]
+        return self.pointer_names[link]
+
+    def __iter__(self) -> Iterator[Address]:
+        return iter(self.pointer_names)
+
+    def __len__(self) -> int:
+        return len(self.pointer_names)
+
+
+def _format_subquestion(i: int, subquestion: Tuple[Address, Address, Address], link_texts: Mapping[Address, str]) -> str:
+    q, a, w = subquestion
+    return "{}.\n{}\n{}\n{}".format(
+            i + 1, indent(link_texts[q], "  "), indent(link_texts[a], "  "), indent(link_texts[w], "  "))
 
 
 class Context(object):
@@ -37,40 +67,307 @@ class Context(object):
             self,
             workspace_link: Address,
             db: Datastore,
-            unlocked_locations: Optional[Set[Address]]=None,
+            unlocked_locations: Optional[AbstractSet[Address]]=None,
             parent: Optional["Context"]=None,
+            budget: Optional[int]=None,
             ) -> None:
 
         # Unlocked locations should be in terms of the passed in workspace_link.
 
         self.workspace_link = workspace_link
         workspace = db.dereference(workspace_link)
+        # Successors share most of their unlocked locations with their
+        # predecessors, so they are kept in a persistent set.
         if unlocked_locations is not None:
-            self.unlocked_locations = unlocked_locations
-            self.unlocked_locations.add(self.workspace_link)
+            if not isinstance(unlocked_locations, PersistentSet):
+                unlocked_locations = PersistentSet(unlocked_locations)
+            self.unlocked_locations = unlocked_locations.add(self.workspace_link)
         else:
             # All of the things that are visible in a context with no explicit unlocks.
-            self.unlocked_locations = set(
+            self.unlocked_locations = PersistentSet(
                     [workspace_link, workspace.question_link, workspace.scratchpad_link] +
                     [q for q, a, w in workspace.subquestions] +
                     ([workspace.predecessor_link] if workspace.predecessor_link else []))
 
-        self.pointer_names, self.name_pointers = self._name_pointers(self.workspace_link, db)
-        self.display = self.to_str(db)
-        self.parent = parent
+        # What is left of the budget for automating this context and the
+        # contexts derived from it (see Scheduler). Unless given, it is the
+        # parent's.
+        if budget is None:
+            budget = parent.budget if parent is not None else 0
+        self.budget: int = budget
+        # Set by the scheduler when it could have automated this context,
+        # but the budget was used up.
+        self.budget_exhausted = False
+        # Set by the scheduler to where it keeps this context in its store
+        # (see SchedulerStore).
+        self.position: Optional[int] = None
+        # Only kept until rendering, which reuses what the parent rendered.
+        self._parent = parent
+
+        # Pointer names and the rendering are computed when first needed,
+        # after which the datastore is no longer needed.
+        self._db: Optional[Datastore] = db
+        self._pointers: Optional[Tuple[Dict[Address, str], Dict[str, Address]]] = None
+        self._unlocked_region: Optional[Set[Address]] = None
+        # Map from each visible link to the pages in the unlocked region that
+        # link to it (None for the workspace itself), the number of the last
+        # anonymous pointer, and the links whose names or unlocking differ
+        # from the parent's (see _extend_pointers).
+        self._referrers: Optional[Dict[Address, Set[Optional[Address]]]] = None
+        self._pointer_count = 0
+        self._changed: Optional[Set[Address]] = None
+        # The rendered subquestions, and where each link appears in them.
+        self._subquestion_texts: Optional[List[str]] = None
+        self._subquestion_positions: Optional[Dict[Address, List[int]]] = None
+        self._display: Optional[str] = None
+        self._hash: Optional[int] = None
+        self._digest: Optional[bytes] = None
+        self._canonical_names: Optional[Dict[str, str]] = None
+        self._fragments: Optional[Dict[Address, Fragment]] = None
+
+    @property
+    def pointer_names(self) -> Dict[Address, str]:
+        return self._get_pointers()[0]
+
+    @property
+    def name_pointers(self) -> Dict[str, Address]:
+        return self._get_pointers()[1]
+
+    @property
+    def unlocked_region(self) -> Set[Address]:
+        """The links in this context's workspace that are unlocked.
+
+        Like the pointer names, this is computed once; do not modify it.
+        """
+        self._get_pointers()
+        assert self._unlocked_region is not None
+        return self._unlocked_region
+
+    def _get_pointers(self) -> Tuple[Dict[Address, str], Dict[str, Address]]:
+        if self._pointers is None:
+            assert self._db is not None
+            if self._parent is not None and self._parent._referrers is not None \
+                    and self._extends(self._parent, self._db):
+                self._extend_pointers(self._parent, self._db)
+            else:
+                self._unlocked_region = set()
+                self._referrers = {}
+                self._pointers = self._name_pointers(self.workspace_link, self._db,
+                                                     self._unlocked_region, self._referrers)
+                self._pointer_count = sum(1 for name in self._pointers[1] if name[1:].isdigit())
+        assert self._pointers is not None
+        return self._pointers
+
+    def _extends(self, parent: "Context", db: Datastore) -> bool:
+        """Whether this context's workspace is ``parent``'s with at most a
+        new scratchpad and new subquestions, so that it can keep its names."""
+        workspace = db.dereference(self.workspace_link)
+        parent_workspace = db.dereference(parent.workspace_link)
+        return workspace.question_link == parent_workspace.question_link and \
+            workspace.subquestions[:len(parent_workspace.subquestions)] == parent_workspace.subquestions
+
+    def _extend_pointers(self, parent: "Context", db: Datastore) -> None:
+        """Name the pointers by updating ``parent``'s naming.
+
+        Links that were visible in the parent keep their names, and links that
+        become visible are numbered after the parent's. Only the pages that
+        are unlocked or locked by the change are visited.
+        """
+        pointer_names = dict(parent.pointer_names)
+        name_pointers = dict(parent.name_pointers)
+        region = set(parent.unlocked_region)
+        assert parent._referrers is not None
+        referrers = dict(parent._referrers) # The sets are replaced, never changed.
+        count = parent._pointer_count
+        changed: Set[Address] = set()
+        to_unlock: Deque[Address] = deque()
+        to_lock: List[Address] = []
+
+        def assign(link: Address, name: str) -> None:
+            old_name = pointer_names.get(link)
+            if old_name is not None:
+                del name_pointers[old_name]
+            pointer_names[link] = name
+            name_pointers[name] = link
+            changed.add(link)
+
+        def link_to(link: Address, page_link: Optional[Address]) -> None:
+            nonlocal count
+            page_referrers = referrers.get(link)
+            if page_referrers is not None:
+                referrers[link] = page_referrers | {page_link}
+                return
+            referrers[link] = {page_link}
+            if link not in pointer_names:
+                count += 1
+                assign(link, "${}".format(count))
+            if link in self.unlocked_locations:
+                to_unlock.append(link)
+
+        def unlink_from(link: Address, page_link: Optional[Address]) -> None:
+            page_referrers = referrers[link] - {page_link}
+            if len(page_referrers) > 0:
+                referrers[link] = page_referrers
+                return
+            del referrers[link]
+            del name_pointers[pointer_names.pop(link)]
+            changed.add(link)
+            if link in region:
+                to_lock.append(link)
+
+        def unlock_pending() -> None:
+            # Breadth-first, like _name_pointers.
+            while len(to_unlock) > 0:
+                link = to_unlock.popleft()
+                if link not in region:
+                    region.add(link)
+                    changed.add(link)
+                    for visible_link in db.dereference(link).links():
+                        link_to(visible_link, link)
+
+        def lock_pending() -> None:
+            while len(to_lock) > 0:
+                link = to_lock.pop()
+                if link in region:
+                    region.remove(link)
+                    changed.add(link)
+                    for visible_link in db.dereference(link).links():
+                        unlink_from(visible_link, link)
+
+        workspace = db.dereference(self.workspace_link)
+        parent_workspace = db.dereference(parent.workspace_link)
+        known = len(parent_workspace.subquestions)
+        for i, subquestion in enumerate(workspace.subquestions[known:], start=known + 1):
+            for link, name in zip(subquestion, ["$q{}", "$a{}", "$w{}"]):
+                # A link in several subquestions is shown with the name from
+                # the first, but can be referred to by any of them.
+                if link in pointer_names and not pointer_names[link][1:].isdigit():
+                    name_pointers[name.format(i)] = link
+                else:
+                    assign(link, name.format(i))
+
+        if self.workspace_link != parent.workspace_link:
+            region.discard(parent.workspace_link)
+            region.add(self.workspace_link)
+            # Only the links that the new workspace doesn't share with the old
+            # one are visited. New links are linked before old ones are
+            # unlinked, so that what the old ones share with them stays.
+            removed = []
+            for old, new in [(parent_workspace.predecessor_link, workspace.predecessor_link),
+                             (parent_workspace.scratchpad_link, workspace.scratchpad_link)]:
+                if old != new:
+                    if new is not None:
+                        link_to(new, None)
+                    if old is not None:
+                        removed.append(old)
+            for subquestion in workspace.subquestions[known:]:
+                for link in subquestion:
+                    link_to(link, None)
+            unlock_pending()
+            for link in removed:
+                # Links in subquestions have their names, and are still there.
+                if link not in (workspace.question_link, workspace.scratchpad_link, workspace.predecessor_link) \
+                        and pointer_names[link][1:].isdigit():
+                    unlink_from(link, None)
+            lock_pending()
+            # A new scratchpad takes the name of the one it replaces.
+            old_scratchpad = parent_workspace.scratchpad_link
+            new_name = pointer_names[workspace.scratchpad_link]
+            if old_scratchpad not in referrers and workspace.scratchpad_link not in parent.pointer_names:
+                assign(workspace.scratchpad_link, parent.pointer_names[old_scratchpad])
+                if new_name == "${}".format(count):
+                    count -= 1
+
+        # The unlocked locations are all addresses.
+        unlocked, locked = cast(Tuple[List[Address], List[Address]],
+                                self.unlocked_locations.diff(parent.unlocked_locations))
+        # Only the links that are visible are affected, in the order of
+        # their names, so that the naming doesn't depend on hashes.
+        to_unlock.extend(sorted((link for link in unlocked if link in referrers),
+                                key=lambda link: pointer_names[link]))
+        unlock_pending()
+        to_lock.extend(link for link in locked if link in region)
+        lock_pending()
+
+        self._pointers = pointer_names, name_pointers
+        self._unlocked_region = region
+        self._referrers = referrers
+        self._pointer_count = count
+        self._changed = changed
+
+    @property
+    def display(self) -> str:
+        if self._display is None:
+            assert self._db is not None
+            self._display = self.to_str(self._db)
+            self._db = None
+            self._parent = None
+        return self._display
+
+    @property
+    def digest(self) -> bytes:
+        """A digest of the rendering of this context.
+
+        Anonymous pointers are renumbered in order of appearance first (see
+        ``canonical_names``), so contexts that only differ in how they number
+        them have the same digest.
+        """
+        if self._digest is None:
+            self._canonicalize()
+        assert self._digest is not None
+        return self._digest
+
+    @property
+    def canonical_names(self) -> Dict[str, str]:
+        """Map from the anonymous pointer names in this context to canonical ones."""
+        if self._canonical_names is None:
+            self._canonicalize()
+        assert self._canonical_names is not None
+        return self._canonical_names
+
+    def _canonicalize(self) -> None:
+        text, self._canonical_names = canonicalize_pointer_names(self.display)
+        self._digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Render now rather than pickling the datastore (which may be a
+        # transaction) along with the context.
+        self.display
+        state = self.__dict__.copy()
+        state["_fragments"] = None
+        state["_referrers"] = None
+        state["_changed"] = None
+        state["_subquestion_texts"] = None
+        state["_subquestion_positions"] = None
+        return state
 
     def to_dry(self) -> DryContext:
-        return DryContext(self.workspace_link, self.unlocked_locations, self.parent)
+        return DryContext(self.workspace_link, self.unlocked_locations, self.budget)
 
     @classmethod
-    def from_dry(cls, dry_context: DryContext, db: Datastore) -> "Context":
-        return cls(dry_context.workspace_link, db,
-                   dry_context.unlocked_locations, dry_context.parent)
+    def from_dry(cls, dry_context: DryContext, db: Datastore, parent: Optional["Context"]=None) -> "Context":
+        return cls(dry_context.workspace_link, db, dry_context.unlocked_locations,
+                   parent=parent, budget=dry_context.budget)
+
+    def with_budget(self, budget: int) -> "Context":
+        """Return a copy of this context with ``budget`` left."""
+        # Not copy.copy, which would render the context through __getstate__.
+        result = object.__new__(Context)
+        result.__dict__.update(self.__dict__)
+        result.budget = budget
+        result.budget_exhausted = False
+        return result
+
+    def references(self) -> List[Any]:
+        """Return the addresses and contexts that this refers to."""
+        return _context_references(self)
 
     def _name_pointers(
             self,
             workspace_link: Address,
             db: Datastore,
+            unlocked_region: Optional[Set[Address]]=None,
+            referrers: Optional[Dict[Address, Set[Optional[Address]]]]=None,
             ) -> Tuple[Dict[Address, str], Dict[str, Address]]:
         pointers: Dict[Address, str] = {}
         backward_pointers: Dict[str, Address] = {}
@@ -88,8 +385,13 @@ class Context(object):
 
         count = 0
         for your_link in visit_unlocked_region(self.workspace_link, workspace_link, db, self.unlocked_locations):
+            if unlocked_region is not None:
+                unlocked_region.add(your_link)
             your_page = db.dereference(your_link)
             for visible_link in your_page.links():
+                if referrers is not None:
+                    referrers.setdefault(visible_link, set()).add(
+                            your_link if your_link != workspace_link else None)
                 if visible_link not in pointers:
                     count += 1
                     assign(visible_link, "${}".format(count))
@@ -100,31 +402,70 @@ class Context(object):
             self,
             workspace_link: Address,
             db: Datastore,
-            ) -> Set[Address]:
-        result = set(visit_unlocked_region(self.workspace_link, workspace_link, db, self.unlocked_locations))
-        return result
+            ) -> PersistentSet:
+        if workspace_link == self.workspace_link:
+            # The unlocked region is made of the unlocked locations that can
+            # still be reached, which are usually all of them.
+            result = self.unlocked_locations
+            if len(result) > len(self.unlocked_region):
+                for address in self.unlocked_locations:
+                    if address not in self.unlocked_region:
+                        result = result.discard(address)
+            return result
+        return PersistentSet(visit_unlocked_region(self.workspace_link, workspace_link, db, self.unlocked_locations))
 
     def name_pointers_for_workspace(
             self,
             workspace_link: Address,
             db: Datastore
             ) -> Dict[str, Address]:
+        if workspace_link == self.workspace_link:
+            return self.name_pointers
         return self._name_pointers(workspace_link, db)[1]
 
     def to_str(self, db: Datastore) -> str:
         CONTEXT_FMT = "{predecessor}Question: {question}\nScratchpad: {scratchpad}\nSubquestions:\n{subquestions}\n"
 
-        link_texts = make_link_texts(self.workspace_link, db, self.unlocked_locations, self.pointer_names)
-
-        subquestion_builder = []
+        # Most of the workspace usually renders the same as in the parent.
+        previous_fragments = self._parent._fragments if self._parent is not None else None
+        pointer_names = self.pointer_names # Also sets _changed if the parent's names are kept.
+        link_texts: Mapping[Address, str]
         workspace: Workspace = db.dereference(self.workspace_link)
-        for i, subquestion in enumerate(workspace.subquestions, start=1):
-            q, a, w = subquestion
-            q_text = link_texts[q]
-            a_text = link_texts[a]
-            w_text = link_texts[w]
-            subquestion_builder.append("{}.\n{}\n{}\n{}".format(i, indent(q_text, "  "), indent(a_text, "  "), indent(w_text, "  ")))
-        subquestions = "\n".join(subquestion_builder)
+        subquestion_texts: List[str]
+        positions: Dict[Address, List[int]]
+        parent = self._parent
+        if self._changed is not None and previous_fragments is not None \
+                and parent is not None and parent._subquestion_texts is not None:
+            assert parent._subquestion_positions is not None
+            self._fragments, stale = self._render_changes(previous_fragments, db)
+            link_texts = _LinkTexts(self._fragments, pointer_names, self.unlocked_region)
+            # Only the subquestions showing a link whose text changed, and the
+            # new ones, are formatted again.
+            subquestion_texts = list(parent._subquestion_texts)
+            positions = parent._subquestion_positions.copy() # The lists are replaced, never changed.
+            redo = {i for link in stale | self._changed for i in positions.get(link, ())}
+            for i in range(len(subquestion_texts), len(workspace.subquestions)):
+                subquestion_texts.append("")
+                for link in workspace.subquestions[i]:
+                    positions[link] = positions.get(link, []) + [i]
+                redo.add(i)
+            for i in redo:
+                subquestion_texts[i] = _format_subquestion(i, workspace.subquestions[i], link_texts)
+        else:
+            self._fragments = {}
+            # All the links that are rendered are in the unlocked region or locked,
+            # so the region (a plain set) will do for looking up what is unlocked.
+            link_texts = make_link_texts(self.workspace_link, db, self.unlocked_region, pointer_names,
+                                         previous_fragments, self._fragments, self.unlocked_region)
+            subquestion_texts = []
+            positions = {}
+            for i, subquestion in enumerate(workspace.subquestions):
+                subquestion_texts.append(_format_subquestion(i, subquestion, link_texts))
+                for link in subquestion:
+                    positions.setdefault(link, []).append(i)
+        self._subquestion_texts = subquestion_texts
+        self._subquestion_positions = positions
+        subquestions = "\n".join(subquestion_texts)
 
         if workspace.predecessor_link is None:
             predecessor = ""
@@ -137,18 +478,63 @@ class Context(object):
                 scratchpad=link_texts[workspace.scratchpad_link],
                 subquestions=subquestions)
 
-    def is_own_ancestor(self, db: Datastore) -> bool:
-        initial_workspace = db.canonicalize(self.workspace_link)
-        context: Optional[Context] = self.parent
-        while context is not None:
-            if context == self and db.canonicalize(context.workspace_link) == initial_workspace:
-                return True
-            context = context.parent
-        return False
-
-    # Note: The definition is mutually recursive, but we can implement it
-    # with simple recursion, because we can obtain workspaces from the
-    # datastore without constructing contexts.
+    def _render_changes(
+            self,
+            previous_fragments: Dict[Address, Fragment],
+            db: Datastore,
+            ) -> Tuple[Dict[Address, Fragment], Set[Address]]:
+        """Return the parent's ``previous_fragments``, with the links whose
+        texts changed (see _extend_pointers) and the links containing them
+        rendered again, and the links that were rendered again."""
+        assert self._changed is not None and self._referrers is not None
+        fragments = dict(previous_fragments)
+        region = self.unlocked_region
+        for link in self._changed:
+            if link not in region:
+                fragments.pop(link, None)
+
+        stale: Set[Address] = set()
+        stack = [link for link in self._changed if link in self._referrers]
+        while len(stack) > 0:
+            link = stack.pop()
+            if link not in stale:
+                stale.add(link)
+                # None stands for the workspace, which isn't a fragment.
+                stack.extend(page_link for page_link in self._referrers.get(link, ()) if page_link is not None)
+        stale.discard(self.workspace_link)
+
+        # Links on a page are rendered before the page.
+        link_texts = _LinkTexts(fragments, self.pointer_names, region)
+        stale.intersection_update(region) # Locked links are shown by name.
+        rendered: Set[Address] = set()
+        for link in stale:
+            if link in rendered:
+                continue
+            # Each page on the path links to the next one.
+            path = [link]
+            on_path = {link}
+            while len(path) > 0:
+                top = path[-1]
+                page = db.dereference(top)
+                unrendered = next((child for child in page.links()
+                                   if child in stale and child not in rendered), None)
+                if unrendered is not None:
+                    if unrendered in on_path:
+                        raise ValueError("{} contains itself".format(self.pointer_names[unrendered]))
+                    path.append(unrendered)
+                    on_path.add(unrendered)
+                    continue
+                path.pop()
+                on_path.remove(top)
+                fragments[top] = render_fragment(
+                        top, page, self.pointer_names[top],
+                        {child: link_texts[child] for child in page.links()},
+                        previous_fragments.get(top))
+                rendered.add(top)
+        return fragments, stale
+
+    # Note: The definition is mutually recursive, but the datastore keeps an
+    # index of which promises work towards which, so this is a lookup.
     def can_advance_promise(self, db: Datastore, promise: Address) -> bool:
         """Determine if ``self`` can advance ``promise``.
 
@@ -159,20 +545,26 @@ class Context(object):
         - one of the promisees of the promises P(w) can advance P.
         The promisees of P(w) are contexts.
         """
-        return _can_advance_promise(db, self.workspace_link, promise)
+        advancing = db.advancing_promises(promise)
+        return not advancing.isdisjoint(db.dereference(self.workspace_link).promises)
 
 
     def __str__(self) -> str:
+        # The budget isn't part of the display, so that memoized actions
+        # apply whatever the budget.
+        if self.budget_exhausted:
+            return self.display + "Budget exhausted.\n"
         return self.display
 
     def __hash__(self) -> int:
-        return hash(str(self))
+        if self._hash is None:
+            self._hash = hash((self.workspace_link, self.unlocked_locations))
+        return self._hash
 
     def __eq__(self, other: object) -> bool:
         if not isinstance(other, Context):
             return NotImplemented
         return self.workspace_link == other.workspace_link \
-            and self.unlocked_locations == other.unlocked_locations \
-            and self.parent == other.parent
+            and self.unlocked_locations == other.unlocked_locations
 
 
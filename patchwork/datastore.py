@@ -1,13 +1,22 @@
+import hashlib
+import pickle
+import sys
+import threading
 import uuid
 
-from collections import defaultdict
+from collections import ChainMap, Counter, defaultdict
+from contextlib import contextmanager
+from itertools import chain
 
-from typing import Any, DefaultDict, Dict, List, Set
+from typing import Any, Callable, DefaultDict, Dict, Generator, Iterable, Iterator, List, \
+    Mapping, MutableMapping, Optional, Set, Tuple, Union
+
+import attr
 
 
 class Address(object):
-    def __init__(self) -> None:
-        self.location = uuid.uuid1()
+    def __init__(self, location: Optional[uuid.UUID]=None) -> None:
+        self.location = uuid.uuid1() if location is None else location
 
     def __hash__(self) -> int:
         return hash(self.location)
@@ -24,19 +33,171 @@ class Address(object):
         return "Address({})".format(self.location)
 
 
+def _encode_structure(value: Any, out: List[bytes]) -> None:
+    if isinstance(value, Address):
+        out.append(b"a")
+        out.append(value.location.bytes)
+    elif isinstance(value, str):
+        encoded = value.encode("utf-8")
+        out.append(b"s%d:" % len(encoded))
+        out.append(encoded)
+    elif isinstance(value, (tuple, list)):
+        out.append(b"t%d:" % len(value))
+        for item in value:
+            _encode_structure(item, out)
+    elif value is None:
+        out.append(b"n")
+    else:
+        raise TypeError("Cannot encode {!r} in a content address".format(value))
+
+
+def content_address(content: Any) -> Address:
+    """Return the address determined by the structure of ``content``.
+
+    ``content`` must provide an ``identity()`` method returning nested tuples
+    of strings, addresses and ``None``. The resulting address only depends on
+    that structure, so it is the same across runs and machines whenever the
+    addresses that ``content`` links to are. Since ``identity()`` is what
+    equality compares, equal content gets the same address, as it does from
+    ``canonical_addresses`` when the store isn't content-addressed.
+    """
+    return Address(uuid.UUID(bytes=identity_digest(content)))
+
+
+def identity_digest(content: Any) -> bytes:
+    """Return a digest of what equality compares in ``content``.
+
+    Equal content always has the same digest. Stores that look up content
+    by a digest use this one.
+    """
+    out = [type(content).__name__.encode("utf-8")]
+    _encode_structure(content.identity(), out)
+    return hashlib.sha256(b"".join(out)).digest()[:16]
+
+
+class AliasIndex(object):
+    """Union-find structure mapping aliases to canonical addresses.
+
+    ``parents`` maps each alias to the address it was aliased to, which may
+    itself be an alias. An index can be layered on top of a ``base`` index;
+    lookups fall through to the base, but writes only go to this layer.
+
+    Path compression writes to ``shortcuts``, which are the ``parents``
+    unless given. Pass a separate mapping when ``parents`` must only hold
+    the aliases that were made, like the ones a transaction commits.
+    """
+    def __init__(
+            self,
+            parents: Optional[MutableMapping[Address, Address]]=None,
+            base: Optional["AliasIndex"]=None,
+            shortcuts: Optional[MutableMapping[Address, Address]]=None,
+            ) -> None:
+        self.parents: MutableMapping[Address, Address] = {} if parents is None else parents
+        self.base = base
+        self.shortcuts = self.parents if shortcuts is None else shortcuts
+
+    def parent(self, address: Address) -> Optional[Address]:
+        result = self.shortcuts.get(address)
+        if result is None and self.shortcuts is not self.parents:
+            result = self.parents.get(address)
+        if result is None and self.base is not None:
+            return self.base.parent(address)
+        return result
+
+    def find(self, address: Address) -> Address:
+        """Return the canonical address for ``address``."""
+        path = []
+        parent = self.parent(address)
+        while parent is not None:
+            path.append(address)
+            address = parent
+            parent = self.parent(address)
+        # The last alias on the path already points at the root.
+        for alias in path[:-1]:
+            self.shortcuts[alias] = address
+        return address
+
+    def union(self, alias: Address, address: Address) -> None:
+        """Make ``alias`` an alias of ``address``."""
+        self.parents[alias] = self.find(address)
+
+    def is_alias(self, address: Address) -> bool:
+        return self.parent(address) is not None
+
+
+class TransactionConflict(ValueError):
+    """Raised when a transaction conflicts with one committed after it began."""
+
+
 class Datastore(object):
-    def __init__(self) -> None:
-        self.content: Dict[Address, Any] = {} # Map from canonical address to content
-        self.canonical_addresses: Dict[Any, Address] = {} # Map from content to canonical address
-        self.promises: Dict[Address, List[Any]] = {} # Map from alias to list of promisees
-        self.aliases: Dict[Address, Address] = {} # Map from alias to canonical address
+    # In content-addressed mode, fulfilled addresses are digests of their
+    # content (see content_address) and canonical_addresses is not used.
+    # Promises still get opaque addresses.
+    content_addressed = False
+
+    # Subclasses keep these in tables, images or views of another store.
+    content: MutableMapping[Address, Any] # Map from canonical address to content
+    canonical_addresses: MutableMapping[Any, Address] # Map from content to canonical address
+    promises: MutableMapping[Address, List[Any]] # Map from alias to list of promisees
+    aliases: MutableMapping[Address, Address] # Map from alias to canonical address
+
+    # When set, what is committed inside each outermost committing() block
+    # is written to this log as one record (see patchwork.wal), numbered by
+    # log_sequence.
+    wal: Optional[Any] = None
+    log_sequence = 0
+
+    def __init__(self, content_addressed: bool=False) -> None:
+        self.content_addressed = content_addressed
+        self.content = {}
+        self.canonical_addresses = {}
+        self.promises = {}
+        self.aliases = {}
+        self.alias_index = AliasIndex(self.aliases)
+        self._init_versions()
+
+    def _init_versions(self) -> None:
+        # Every write increments the version. Transactions read the store
+        # through a Snapshot of the version they started at, which needs
+        # to know when the promises it sees were made and resolved.
+        self.version = 0
+        self._promise_versions: Dict[Address, int] = {} # Map from promise to version that made it
+        # Map from resolved promise to (version made, version resolved, promisees),
+        # for as long as a snapshot might still see it pending.
+        self._retired: Dict[Address, Tuple[int, int, List[Any]]] = {}
+        self._snapshots: Counter = Counter() # Versions of the snapshots in use
+        # Map from promise to the promises whose promisees work towards it,
+        # built when first needed (see advancing_promises).
+        self._prerequisites: Optional[DefaultDict[Address, Set[Address]]] = None
+        self._advancing: Dict[Address, Set[Address]] = {} # Results of advancing_promises
+        # Held while committing. Hold it to keep commits out while looking
+        # at the store together with state that is updated along with it.
+        self.lock = threading.RLock()
+        self._committing = 0 # How many committing() blocks are open
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        for name in ["_retired", "_snapshots", "lock", "_committing", "wal", "_prerequisites", "_advancing"]:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self.wal = None
+        self._retired = {}
+        self._snapshots = Counter()
+        self.lock = threading.RLock()
+        self._committing = 0
+        self._prerequisites = None
+        self._advancing = {}
 
     def dereference(self, address: Address) -> Any:
         return self.content[self.canonicalize(address)]
 
     def canonicalize(self, address: Address) -> Address:
-        if address in self.aliases:
-            return self.aliases[address]
+        canonical = self.alias_index.find(address)
+        if canonical is not address:
+            return canonical
         elif address in self.content or address in self.promises:
             return address
         else:
@@ -44,27 +205,40 @@ class Datastore(object):
 
     def make_promise(self) -> Address:
         address = Address()
+        self.version += 1
         self.promises[address] = []
+        self._promise_versions[address] = self.version
         return address
 
     def register_promisee(self, address: Address, promisee: Any) -> None:
         self.promises[address].append(promisee)
+        self._index_promisees(address, [promisee])
 
     def get_promisees(self, address: Address) -> List[Any]:
         return self.promises[address]
 
     def resolve_promise(self, address: Address, content: Any) -> List[Any]:
         assert address in self.promises, "{} not in promises".format(address)
-        if content in self.canonical_addresses:
-            self.aliases[address] = self.canonical_addresses[content]
+        if self.content_addressed:
+            self.alias_index.union(address, self.insert(content))
+        elif content in self.canonical_addresses:
+            self.alias_index.union(address, self.canonical_addresses[content])
         else:
             self.content[address] = content
             self.canonical_addresses[content] = address
         promisees = self.promises[address]
+        self.version += 1
+        self._retire(address, promisees)
+        self._unindex_promisees(address, promisees)
         del self.promises[address]
         return promisees
 
     def insert(self, content: Any) -> Address:
+        if self.content_addressed:
+            address = content_address(content)
+            if address not in self.content:
+                self.content[address] = content
+            return address
         if content in self.canonical_addresses:
             return self.canonical_addresses[content]
 
@@ -76,11 +250,385 @@ class Datastore(object):
         address = self.canonicalize(address)
         return address in self.content
 
-
-class TransactionAccumulator(Datastore):
-    # A way of performing ACID-ish transactions against the Datastore
+    def apply(self, transaction: Union["TransactionAccumulator", "Changes"]) -> None:
+        """Write the changes accumulated in ``transaction`` to this store."""
+        self.version += 1
+        self.promises.update(transaction.new_promises)
+        self._promise_versions.update((a, self.version) for a in transaction.new_promises)
+        for a, l in transaction.additional_promisees.items():
+            self.promises[a] = self.promises[a] + l
+
+        # A concurrent transaction may have committed equal content under
+        # a different address in the meantime. Keep that one.
+        merged: Dict[Address, Address] = {}
+        for content, address in transaction.new_canonical_addresses.items():
+            existing = self.canonical_addresses.get(content)
+            if existing is not None and existing != address:
+                merged[address] = existing
+        self.content.update((a, c) for a, c in transaction.new_content.items()
+                            if a not in merged)
+        self.canonical_addresses.update((c, a) for c, a in transaction.new_canonical_addresses.items()
+                                        if a not in merged)
+        self.aliases.update(transaction.new_aliases)
+        self.aliases.update(merged)
+
+        for a, l in chain(transaction.new_promises.items(), transaction.additional_promisees.items()):
+            self._index_promisees(a, l)
+        for a in transaction.resolved_promises:
+            self._retire(a, self.promises[a])
+            self._unindex_promisees(a, self.promises[a])
+            del self.promises[a]
+
+    def advancing_promises(self, promise: Address) -> Set[Address]:
+        """Return the promises that work towards resolving ``promise``.
+
+        These are ``promise`` itself and, transitively, the promises on which
+        a context that works towards one of them is waiting. A workspace can
+        advance ``promise`` iff one of its own promises is among them.
+        """
+        result = self._advancing.get(promise)
+        if result is None:
+            if self._prerequisites is None:
+                self._prerequisites = _index_prerequisites(self)
+            result = _close_prerequisites(self._prerequisites, promise)
+            self._advancing[promise] = result
+        return result
+
+    def _index_promisees(self, address: Address, promisees: List[Any]) -> None:
+        if self._prerequisites is not None:
+            for promisee in promisees:
+                for promise in self.dereference(promisee.workspace_link).promises:
+                    self._prerequisites[promise].add(address)
+        self._advancing.clear()
+
+    def _unindex_promisees(self, address: Address, promisees: List[Any]) -> None:
+        if self._prerequisites is not None:
+            for promisee in promisees:
+                for promise in self.dereference(promisee.workspace_link).promises:
+                    self._prerequisites[promise].discard(address)
+        self._advancing.clear()
+
+    def snapshot(self) -> "StoreView":
+        """Return a view of this store that later commits don't change."""
+        with self.lock:
+            self._snapshots[self.version] += 1
+            return Snapshot(self, self.version)
+
+    @contextmanager
+    def committing(self) -> Generator[None, None, None]:
+        """Commit transactions and update state kept along with the store
+        in the enclosed statements, without other commits in between.
+
+        Everything committed in the outermost block is logged together.
+        """
+        with self.lock:
+            self._committing += 1
+            try:
+                yield
+            finally:
+                self._committing -= 1
+                if self._committing == 0 and self.wal is not None:
+                    self.wal.flush()
+
+    def commit_transaction(self, transaction: "TransactionAccumulator") -> None:
+        """Validate ``transaction`` against concurrent commits and apply it.
+
+        Raises TransactionConflict if a promise that the transaction resolved
+        or registered promisees on has been resolved since it began.
+        """
+        with self.committing():
+            for a in chain(transaction.resolved_promises, transaction.additional_promisees):
+                if a not in self.promises:
+                    raise TransactionConflict(
+                            "{} was resolved by a concurrent transaction".format(a))
+            self.apply(transaction)
+            if self.wal is not None:
+                self.wal.append(transaction)
+
+    def _release_snapshot(self, version: int) -> None:
+        with self.lock:
+            self._snapshots[version] -= 1
+            if self._snapshots[version] == 0:
+                del self._snapshots[version]
+            if len(self._snapshots) == 0:
+                self._retired.clear()
+            else:
+                oldest = min(self._snapshots)
+                for address in [a for a, (_, resolved, _) in self._retired.items()
+                                if resolved <= oldest]:
+                    del self._retired[address]
+
+    def _retire(self, address: Address, promisees: List[Any]) -> None:
+        # Keep what a snapshot that still sees the promise pending needs.
+        made = self._promise_versions.pop(address, 0)
+        if any(made <= version for version in self._snapshots):
+            self._retired[address] = (made, self.version, promisees)
+
+    def collect_garbage(self, roots: Iterable[Any]) -> int:
+        """Drop everything that is not reachable from ``roots``.
+
+        ``roots`` may contain addresses and other objects that refer to
+        addresses. Like stored content and promisees, such objects must
+        have a ``references()`` method that returns the addresses and objects
+        they refer to.
+
+        Alias chains among the survivors are flattened. Returns the number of
+        bytes reclaimed, measured as the pickled size of what was dropped.
+        """
+        live = self._mark(roots)
+        reclaimed = 0
+
+        # Promises go first, because unindexing their promisees looks at
+        # the promisees' workspaces.
+        dropped = [a for a in self.promises if a not in live]
+        for address in dropped:
+            promisees = self.promises.pop(address)
+            self._promise_versions.pop(address, None)
+            self._unindex_promisees(address, promisees)
+            reclaimed += _pickled_size(promisees)
+        if self._prerequisites is not None:
+            for address in dropped:
+                self._prerequisites.pop(address, None)
+
+        for address in [a for a in self.content if a not in live]:
+            content = self.content.pop(address)
+            if self.canonical_addresses.get(content) == address:
+                del self.canonical_addresses[content]
+            reclaimed += _pickled_size(content)
+
+        for address in list(self.aliases):
+            if address not in live:
+                reclaimed += _pickled_size((address, self.aliases.pop(address)))
+                self.alias_index.shortcuts.pop(address, None)
+            else:
+                canonical = self.alias_index.find(address)
+                if self.aliases[address] != canonical:
+                    self.aliases[address] = canonical
+
+        return reclaimed
+
+    def _mark(self, roots: Iterable[Any]) -> Set[Address]:
+        live: Set[Address] = set()
+        seen_objects: Set[int] = set()
+        stack = list(roots)
+        while len(stack) > 0:
+            item = stack.pop()
+            if isinstance(item, Address):
+                if item in live:
+                    continue
+                live.add(item)
+                if item in self.aliases:
+                    stack.append(self.aliases[item])
+                if item in self.content:
+                    stack.extend(self.content[item].references())
+                if item in self.promises:
+                    stack.extend(self.promises[item])
+            elif id(item) not in seen_objects:
+                seen_objects.add(id(item))
+                stack.extend(item.references())
+        return live
+
+
+def _pickled_size(obj: Any) -> int:
+    return len(pickle.dumps(obj))
+
+
+def _index_prerequisites(db: Datastore) -> DefaultDict[Address, Set[Address]]:
+    # Promisees are contexts waiting on a promise. They work towards the
+    # promises of their workspace.
+    index: DefaultDict[Address, Set[Address]] = defaultdict(set)
+    for address, promisees in db.promises.items():
+        for promisee in promisees:
+            for promise in db.dereference(promisee.workspace_link).promises:
+                index[promise].add(address)
+    return index
+
+
+def _close_prerequisites(index: Mapping[Address, Set[Address]], promise: Address) -> Set[Address]:
+    result = {promise}
+    frontier = [promise]
+    while len(frontier) > 0:
+        for prerequisite in index.get(frontier.pop(), ()):
+            if prerequisite not in result:
+                result.add(prerequisite)
+                frontier.append(prerequisite)
+    return result
+
+
+class _ReadOnlyMapping(MutableMapping):
+    """A view that stands in for one of a store's mappings, but can't be
+    written through."""
+    def __setitem__(self, key: Any, value: Any) -> None:
+        raise TypeError("{} is read-only".format(type(self).__name__))
+
+    def __delitem__(self, key: Any) -> None:
+        raise TypeError("{} is read-only".format(type(self).__name__))
+
+
+class _SnapshotView(_ReadOnlyMapping):
+    """A read-only view of one of a store's mappings, as of a snapshot."""
+    def __init__(
+            self,
+            mapping: Mapping,
+            hidden: Callable[[Any, Any], bool],
+            ) -> None:
+        self.mapping = mapping
+        self.hidden = hidden
+
+    def __getitem__(self, key: Any) -> Any:
+        value = self.mapping[key]
+        if self.hidden(key, value):
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: object) -> bool:
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self) -> Iterator[Any]:
+        return (k for k, v in self.mapping.items() if not self.hidden(k, v))
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+class _SnapshotPromises(_ReadOnlyMapping):
+    def __init__(self, snapshot: "Snapshot") -> None:
+        self.snapshot = snapshot
+
+    def __getitem__(self, address: Address) -> List[Any]:
+        retired = self.snapshot.retired_promisees(address)
+        if retired is not None:
+            return retired
+        return self.snapshot.store.promises[address]
+
+    def __contains__(self, address: object) -> bool:
+        return address in self.snapshot.store.promises or \
+            self.snapshot.retired_promisees(address) is not None
+
+    def __iter__(self) -> Iterator[Address]:
+        store = self.snapshot.store
+        yield from store.promises
+        for address in list(store._retired):
+            if address not in store.promises and self.snapshot.retired_promisees(address) is not None:
+                yield address
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+class StoreView(object):
+    """What a transaction reads from and commits to.
+
+    This is a Snapshot of a Datastore, or, for a nested transaction, the
+    enclosing TransactionAccumulator.
+    """
+    content_addressed: bool
+    content: MutableMapping[Address, Any]
+    canonical_addresses: MutableMapping[Any, Address]
+    promises: MutableMapping[Address, List[Any]]
+    aliases: MutableMapping[Address, Address]
+    alias_index: AliasIndex
+
+    def apply(self, transaction: "TransactionAccumulator") -> None:
+        raise NotImplementedError("StoreView is pure virtual")
+
+    def release(self) -> None:
+        raise NotImplementedError("StoreView is pure virtual")
+
+
+class Snapshot(StoreView):
+    """The contents of a Datastore as of some version.
+
+    Promises that were resolved after that version still look pending, with
+    the promisees they had when they were resolved. Content committed later
+    is visible, which is harmless since content never changes.
+    """
+    def __init__(self, store: Datastore, version: int) -> None:
+        self.store = store
+        self.version = version
+        self.content_addressed = store.content_addressed
+        self.released = False
+
+        hidden_key = lambda address, _: self.is_hidden(address)
+        hidden_value = lambda _, address: self.is_hidden(address)
+        self.content = _SnapshotView(store.content, hidden_key)
+        self.canonical_addresses = _SnapshotView(store.canonical_addresses, hidden_value)
+        self.aliases = _SnapshotView(store.aliases, hidden_key)
+        self.promises = _SnapshotPromises(self)
+        # Path compression mustn't write to the store.
+        self.alias_index = AliasIndex(self.aliases, shortcuts={})
+
+    def is_hidden(self, address: Address) -> bool:
+        """Return whether ``address`` was a pending promise in this snapshot."""
+        return self.retired_promisees(address) is not None
+
+    def retired_promisees(self, address: Any) -> Optional[List[Any]]:
+        entry = self.store._retired.get(address)
+        if entry is not None and entry[0] <= self.version < entry[1]:
+            return entry[2]
+        return None
+
+    def apply(self, transaction: "TransactionAccumulator") -> None:
+        try:
+            self.store.commit_transaction(transaction)
+        finally:
+            self.release()
+
+    def release(self) -> None:
+        """Stop tracking the snapshot's version.
+
+        From then on the snapshot shows the store as it is, so objects that
+        still read through it (like lazily rendered contexts) see what the
+        transaction committed.
+        """
+        if not self.released:
+            self.released = True
+            self.store._release_snapshot(self.version)
+            self.version = sys.maxsize
+
+
+class _PendingPromises(_ReadOnlyMapping):
+    """The promises that are pending from the point of view of a transaction."""
+    def __init__(self, transaction: "TransactionAccumulator") -> None:
+        self.transaction = transaction
+
+    def __getitem__(self, address: Address) -> List[Any]:
+        t = self.transaction
+        if address in t.new_promises:
+            return t.new_promises[address]
+        if address in t.resolved_promises:
+            raise KeyError(address)
+        return t.db.promises[address] + t.additional_promisees.get(address, [])
+
+    def __contains__(self, address: object) -> bool:
+        t = self.transaction
+        return address in t.new_promises or \
+            (address not in t.resolved_promises and address in t.db.promises)
+
+    def __iter__(self) -> Iterator[Address]:
+        t = self.transaction
+        yield from t.new_promises
+        for address in t.db.promises:
+            if address not in t.resolved_promises:
+                yield address
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+class TransactionAccumulator(Datastore, StoreView):
+    # A way of performing ACID-ish transactions against the Datastore.
+    # The transaction reads a snapshot of the Datastore, so several
+    # transactions can run concurrently. It can also be nested in another
+    # TransactionAccumulator (see savepoint), so it only accesses its
+    # Datastore through the mappings that snapshots and transactions share.
     def __init__(self, db: Datastore) -> None:
-        self.db = db
+        self.db = db.snapshot()
+        self.content_addressed = db.content_addressed
         # Promises that were made and not fulfilled in this transaction
         self.new_promises: Dict[Address, List[Any]] = {}
 
@@ -98,6 +646,19 @@ class TransactionAccumulator(Datastore):
 
         # aliases that were created in this transaction
         self.new_aliases: Dict[Address, Address] = {}
+        # Path compression goes elsewhere, so that reads don't add aliases.
+        self.alias_shortcuts: Dict[Address, Address] = {}
+        self.alias_index = AliasIndex(self.new_aliases, self.db.alias_index, self.alias_shortcuts)
+
+        # Memoizer entries made along with this transaction. The store
+        # doesn't use them, but they are logged with the transaction.
+        self.memo_entries: Dict[Any, Any] = {}
+
+        # Views of the store as it looks from inside this transaction
+        self.content = ChainMap(self.new_content, self.db.content)
+        self.canonical_addresses = ChainMap(self.new_canonical_addresses, self.db.canonical_addresses)
+        self.promises = _PendingPromises(self)
+        self.aliases = ChainMap(self.new_aliases, self.db.aliases)
 
     def dereference(self, address: Address) -> Any:
         address = self.canonicalize(address)
@@ -107,10 +668,9 @@ class TransactionAccumulator(Datastore):
             return self.db.content[address]
 
     def canonicalize(self, address: Address) -> Address:
-        if address in self.new_aliases:
-            return self.new_aliases[address]
-        elif address in self.db.aliases:
-            return self.db.aliases[address]
+        canonical = self.alias_index.find(address)
+        if canonical is not address:
+            return canonical
         elif address in self.new_content or address in self.new_promises:
             return address
         elif address in self.db.content or address in self.db.promises:
@@ -149,17 +709,19 @@ class TransactionAccumulator(Datastore):
 
     def resolve_promise(self, address: Address, content: Any) -> List[Any]:
         assert address in self.new_promises or address in self.db.promises, "{} not in promises".format(address)
-        if content in self.db.canonical_addresses:
-            self.new_aliases[address] = self.db.canonical_addresses[content]
+        if self.content_addressed:
+            self.alias_index.union(address, self.insert(content))
+        elif content in self.db.canonical_addresses:
+            self.alias_index.union(address, self.db.canonical_addresses[content])
         elif content in self.new_canonical_addresses:
-            self.new_aliases[address] = self.new_canonical_addresses[content]
+            self.alias_index.union(address, self.new_canonical_addresses[content])
         else:
             self.new_content[address] = content
             self.new_canonical_addresses[content] = address
 
         if address in self.db.promises:
-            promisees = self.db.promises[address]
-            promisees.extend(self.additional_promisees.get(address, []))
+            promisees = self.db.promises[address] + \
+                        self.additional_promisees.get(address, [])
             self.resolved_promises.add(address)
         else:
             promisees = self.new_promises[address]
@@ -167,6 +729,11 @@ class TransactionAccumulator(Datastore):
         return promisees
 
     def insert(self, content: Any) -> Address:
+        if self.content_addressed:
+            address = content_address(content)
+            if address not in self.new_content and address not in self.db.content:
+                self.new_content[address] = content
+            return address
         if content in self.new_canonical_addresses:
             return self.new_canonical_addresses[content]
         if content in self.db.canonical_addresses:
@@ -180,12 +747,99 @@ class TransactionAccumulator(Datastore):
         address = self.canonicalize(address)
         return address in self.new_content or address in self.db.content
 
+    def advancing_promises(self, promise: Address) -> Set[Address]:
+        # Transactions are short-lived, so they don't keep an index.
+        return _close_prerequisites(_index_prerequisites(self), promise)
+
+    def snapshot(self) -> StoreView:
+        # Nested transactions see their parent as it is.
+        return self
+
+    def release(self) -> None:
+        pass
+
+    def savepoint(self) -> "TransactionAccumulator":
+        """Start a transaction nested in this one.
+
+        Committing the nested transaction merges its changes into this one.
+        Rolling it back just means dropping it.
+        """
+        return TransactionAccumulator(self)
+
+    def apply(self, transaction: Union["TransactionAccumulator", "Changes"]) -> None:
+        self.new_promises.update(transaction.new_promises)
+        for a, l in transaction.additional_promisees.items():
+            if a in self.new_promises:
+                self.new_promises[a] = self.new_promises[a] + l
+            else:
+                self.additional_promisees[a] = self.additional_promisees[a] + l
+
+        # Changes made alongside this transaction's own (see
+        # Scheduler.processes) may have inserted equal content under a
+        # different address. Keep the one that is here.
+        merged: Dict[Address, Address] = {}
+        for content, address in transaction.new_canonical_addresses.items():
+            existing = self.canonical_addresses.get(content)
+            if existing is not None and existing != address:
+                merged[address] = existing
+        self.new_content.update((a, c) for a, c in transaction.new_content.items()
+                                if a not in merged)
+        self.new_canonical_addresses.update((c, a) for c, a in transaction.new_canonical_addresses.items()
+                                            if a not in merged)
+        self.new_aliases.update(transaction.new_aliases)
+        self.new_aliases.update(merged)
+        self.memo_entries.update(transaction.memo_entries)
+        for a in transaction.resolved_promises:
+            if a in self.new_promises:
+                del self.new_promises[a]
+            else:
+                self.resolved_promises.add(a)
+                self.additional_promisees.pop(a, None)
+
+    def changes(self) -> "Changes":
+        """Return a copy of the changes made in this transaction."""
+        return Changes(
+                dict(self.new_promises),
+                dict(self.additional_promisees),
+                dict(self.new_content),
+                dict(self.new_canonical_addresses),
+                dict(self.new_aliases),
+                set(self.resolved_promises),
+                dict(self.memo_entries))
+
     def commit(self) -> None:
-        self.db.promises.update(self.new_promises)
-        for a, l in self.additional_promisees.items():
-            self.db.promises[a].extend(l)
-        self.db.content.update(self.new_content)
-        self.db.canonical_addresses.update(self.new_canonical_addresses)
-        self.db.aliases.update(self.new_aliases)
-        for a in self.resolved_promises:
-            del self.db.promises[a]
+        self.db.apply(self)
+        # Reads now find the changes in the store.
+        self._clear()
+
+    def rollback(self) -> None:
+        """Discard the changes made in this transaction."""
+        self.db.release()
+        self._clear()
+
+    def _clear(self) -> None:
+        self.new_promises.clear()
+        self.resolved_promises.clear()
+        self.additional_promisees.clear()
+        self.new_content.clear()
+        self.new_canonical_addresses.clear()
+        self.new_aliases.clear()
+        self.alias_shortcuts.clear()
+        self.memo_entries.clear()
+
+
+@attr.s
+class Changes(object):
+    """The changes made in a transaction, apart from the store it read.
+
+    The fields mirror those of TransactionAccumulator, so changes can be
+    passed to Datastore.apply and TransactionAccumulator.apply, for example
+    after being sent from another process.
+    """
+    new_promises = attr.ib(type=Dict[Address, List[Any]])
+    additional_promisees = attr.ib(type=Dict[Address, List[Any]])
+    new_content = attr.ib(type=Dict[Address, Any])
+    new_canonical_addresses = attr.ib(type=Dict[Any, Address])
+    new_aliases = attr.ib(type=Dict[Address, Address])
+    resolved_promises = attr.ib(type=Set[Address])
+    memo_entries = attr.ib(type=Dict[Any, Any])
@@ -1,6 +1,7 @@
 from collections import deque
+from functools import partial
 from textwrap import indent
-from typing import Dict, Generator, List, Optional, Set, Tuple, Union
+from typing import AbstractSet, Dict, Generator, Iterable, List, Optional, Set, Tuple, Union
 
 from .datastore import Address, Datastore
 
@@ -11,7 +12,7 @@ def visit_unlocked_region(
         template_link: Address,
         workspace_link: Address,
         db: Datastore,
-        unlocked_locations: Optional[Set[Address]],
+        unlocked_locations: Optional[AbstractSet[Address]],
         ) -> Generator[Address, None, None]:
     frontier = deque([(template_link, workspace_link)])
     seen = set(frontier)
@@ -28,27 +29,78 @@ def visit_unlocked_region(
 
 
 class Hypertext(object):
+    """Immutable hypertext.
+
+    Hypertext is hashed and compared by its structure (see ``identity``),
+    and the hash is computed once, on construction.
+    """
+    __slots__ = ("_hash",)
+    _hash: int
+
     def links(self) -> List[Address]:
         raise NotImplementedError("Hypertext is a pure virtual class")
 
+    def structure(self) -> tuple:
+        """Return the contents as nested tuples of strings and addresses."""
+        raise NotImplementedError("Hypertext is a pure virtual class")
+
+    def identity(self) -> tuple:
+        """Return the part of the structure that equality compares."""
+        return self.structure()
+
+    def references(self) -> List[Address]:
+        """Return every address this hypertext keeps alive in the datastore."""
+        return self.links()
+
     def to_str(self, display_map: Optional[Dict[Address, str]]=None) -> str:
         raise NotImplementedError("Hypertext is a pure virtual class")
 
+    def _freeze(self) -> None:
+        object.__setattr__(self, "_hash", hash((type(self).__name__, self.identity())))
+
+    def __setattr__(self, name: str, value: object) -> None:
+        raise AttributeError("Hypertext is immutable")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError("Hypertext is immutable")
+
     def __str__(self) -> str:
         return self.to_str()
 
     def __eq__(self, other: object):
+        if self is other:
+            return True
         if not isinstance(other, Hypertext):
             return False
-        return str(self) == str(other)
+        return type(self) is type(other) \
+            and self._hash == other._hash \
+            and self.identity() == other.identity()
 
     def __hash__(self):
-        return hash(str(self))
+        return self._hash
 
 
 class RawHypertext(Hypertext):
-    def __init__(self, chunks: List[HypertextFragment]) -> None:
-        self.chunks = chunks
+    __slots__ = ("chunks",)
+    chunks: Tuple[HypertextFragment, ...]
+
+    def __init__(self, chunks: Iterable[HypertextFragment]) -> None:
+        # Adjacent strings are merged so that equal text compares equal no
+        # matter how it was split up.
+        normalized: List[HypertextFragment] = []
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                if chunk == "":
+                    continue
+                if normalized and isinstance(normalized[-1], str):
+                    normalized[-1] += chunk
+                    continue
+            normalized.append(chunk)
+        object.__setattr__(self, "chunks", tuple(normalized))
+        self._freeze()
+
+    def __reduce__(self):
+        return (RawHypertext, (self.chunks,))
 
     def links(self) -> List[Address]:
         result = []
@@ -59,6 +111,9 @@ class RawHypertext(Hypertext):
                 result.append(chunk)
         return result
 
+    def structure(self) -> tuple:
+        return self.chunks
+
     def to_str(self, display_map: Optional[Dict[Address, str]]=None) -> str:
         builder = []
         for chunk in self.chunks:
@@ -72,22 +127,51 @@ class RawHypertext(Hypertext):
 
 
 class Workspace(Hypertext):
+    __slots__ = (
+            "question_link",
+            "answer_promise",
+            "final_workspace_promise",
+            "promises",
+            "scratchpad_link",
+            "subquestions",
+            "predecessor_link",
+            )
+    question_link: Address
+    answer_promise: Address
+    final_workspace_promise: Address
+    promises: Tuple[Address, Address]
+    scratchpad_link: Address
+    subquestions: Tuple[Subquestion, ...]
+    predecessor_link: Optional[Address]
+
     def __init__(
             self,
             question_link: Address,
             answer_promise: Address,
             final_workspace_promise: Address,
             scratchpad_link: Address,
-            subquestions: List[Subquestion],
+            subquestions: Iterable[Subquestion],
             predecessor_link: Optional[Address]=None,
             ) -> None:
-        self.question_link = question_link
-        self.answer_promise = answer_promise
-        self.final_workspace_promise = final_workspace_promise
-        self.promises = [answer_promise, final_workspace_promise]
-        self.scratchpad_link = scratchpad_link
-        self.subquestions = subquestions
-        self.predecessor_link = predecessor_link
+        set_field = partial(object.__setattr__, self)
+        set_field("question_link", question_link)
+        set_field("answer_promise", answer_promise)
+        set_field("final_workspace_promise", final_workspace_promise)
+        set_field("promises", (answer_promise, final_workspace_promise))
+        set_field("scratchpad_link", scratchpad_link)
+        set_field("subquestions", tuple(tuple(subquestion) for subquestion in subquestions))
+        set_field("predecessor_link", predecessor_link)
+        self._freeze()
+
+    def __reduce__(self):
+        return (Workspace, (
+                self.question_link,
+                self.answer_promise,
+                self.final_workspace_promise,
+                self.scratchpad_link,
+                self.subquestions,
+                self.predecessor_link,
+                ))
 
     def links(self) -> List[Address]:
         result = []
@@ -99,6 +183,30 @@ class Workspace(Hypertext):
             result.extend([q, a, w])
         return result
 
+    def references(self) -> List[Address]:
+        # The promises aren't links, but the workspace still needs them.
+        return self.links() + list(self.promises)
+
+    def structure(self) -> tuple:
+        return (
+                self.question_link,
+                self.answer_promise,
+                self.final_workspace_promise,
+                self.scratchpad_link,
+                self.subquestions,
+                self.predecessor_link,
+                )
+
+    def identity(self) -> tuple:
+        # Workspaces that only differ in their promises are the same
+        # workspace, so asking the same question twice reuses its answer.
+        return (
+                self.question_link,
+                self.scratchpad_link,
+                self.subquestions,
+                self.predecessor_link,
+                )
+
     def to_str(self, display_map: Optional[Dict[Address, str]]=None) -> str:
         builder = []
         if self.predecessor_link is not None:
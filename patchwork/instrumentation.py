@@ -0,0 +1,278 @@
+"""Counters and timers for the datastore and scheduler hot paths.
+
+Instrumentation works by wrapping the measured functions when it is enabled
+and unwrapping them when it is disabled, so while it is off it costs nothing.
+Work done in the worker processes of ``Scheduler(processes=...)`` is counted
+too: each worker sends its statistics back along with its results::
+
+    from patchwork import instrumentation
+    instrumentation.enable(dump_interval=10)
+    ...
+    print(instrumentation.stats())
+    instrumentation.disable()
+"""
+import functools
+import json
+import sys
+import threading
+
+from time import perf_counter
+from typing import Any, Callable, Dict, IO, Optional, Tuple
+
+import attr
+
+from . import context, scheduling, text_manipulation
+from .datastore import Datastore, TransactionAccumulator, content_address
+
+
+@attr.s
+class Timer(object):
+    calls = attr.ib(default=0, type=int)
+    seconds = attr.ib(default=0.0, type=float)
+    max_seconds = attr.ib(default=0.0, type=float)
+
+    def record(self, seconds: float) -> None:
+        self.calls += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+
+@attr.s
+class Histogram(object):
+    samples = attr.ib(default=0, type=int)
+    total = attr.ib(default=0, type=int)
+    max = attr.ib(default=0, type=int)
+
+    def record(self, value: int) -> None:
+        self.samples += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+
+_timers: Dict[str, Timer] = {}
+_counters: Dict[str, int] = {}
+_counters_lock = threading.Lock()
+_histograms: Dict[str, Histogram] = {}
+
+# (owner, attribute name) -> original value, for everything that is wrapped.
+_originals: Dict[Tuple[Any, str], Any] = {}
+_dumper: Optional[threading.Thread] = None
+_stop_dumping = threading.Event()
+
+
+def _count(name: str, n: int=1) -> None:
+    # Concurrent transactions may count from several threads.
+    with _counters_lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def _timed(name: str) -> Callable[[Callable], Callable]:
+    def make(original: Callable) -> Callable:
+        timer = _timers.setdefault(name, Timer())
+        @functools.wraps(original)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                timer.record(perf_counter() - start)
+        return wrapper
+    return make
+
+
+def _counting_insert(original: Callable) -> Callable:
+    timed = _timed("datastore.insert")(original)
+    @functools.wraps(original)
+    def wrapper(db: Datastore, content: Any) -> Any:
+        if db.content_addressed:
+            duplicate = content_address(content) in db.content
+        else:
+            duplicate = content in db.canonical_addresses
+        _count("datastore.insert.duplicates" if duplicate else "datastore.insert.new")
+        return timed(db, content)
+    return wrapper
+
+
+def _counting_can_handle(original: Callable) -> Callable:
+    @functools.wraps(original)
+    def wrapper(memoizer: Any, ctx: Any) -> bool:
+        result = original(memoizer, ctx)
+        _count("memoizer.hits" if result else "memoizer.misses")
+        return result
+    return wrapper
+
+
+def _counting_handle(original: Callable) -> Callable:
+    @functools.wraps(original)
+    def wrapper(automator: Any, ctx: Any) -> Any:
+        _count("scheduler.automated_actions")
+        return original(automator, ctx)
+    return wrapper
+
+
+def _measuring_resolve_action(original: Callable) -> Callable:
+    timed = _timed("scheduler.resolve_action")(original)
+    cascade_lengths = _histograms.setdefault("scheduler.cascade_length", Histogram())
+    @functools.wraps(original)
+    def wrapper(*args, **kwargs):
+        before = _counters.get("scheduler.automated_actions", 0)
+        try:
+            return timed(*args, **kwargs)
+        finally:
+            cascade_lengths.record(_counters.get("scheduler.automated_actions", 0) - before)
+    return wrapper
+
+
+def _counting(name: str) -> Callable[[Callable], Callable]:
+    def make(original: Callable) -> Callable:
+        @functools.wraps(original)
+        def wrapper(*args, **kwargs):
+            _count(name)
+            return original(*args, **kwargs)
+        return wrapper
+    return make
+
+
+class _WorkerResult(tuple):
+    """A result of scheduling._automate_subtree, sent from a worker process
+    with the statistics it collected, which are added to the parent's when
+    the result is unpickled there."""
+    worker_stats: Dict[str, Any]
+
+    def __reduce__(self):
+        return (_merge_worker_result, (tuple(self), self.worker_stats))
+
+
+def _merge_worker_result(result: tuple, worker_stats: Dict[str, Any]) -> tuple:
+    cache = text_manipulation.fragment_cache
+    with _counters_lock: # Results arrive on the pool's result thread.
+        for name, n in worker_stats["counters"].items():
+            _counters[name] = _counters.get(name, 0) + n
+        for name, (calls, seconds, max_seconds) in worker_stats["timers"].items():
+            timer = _timers.setdefault(name, Timer())
+            timer.calls += calls
+            timer.seconds += seconds
+            timer.max_seconds = max(timer.max_seconds, max_seconds)
+        for name, (samples, total, max_value) in worker_stats["histograms"].items():
+            histogram = _histograms.setdefault(name, Histogram())
+            histogram.samples += samples
+            histogram.total += total
+            histogram.max = max(histogram.max, max_value)
+        hits, misses = worker_stats["fragment_cache"]
+        cache.hits += hits
+        cache.misses += misses
+    return result
+
+
+def _reporting_automate_subtree(original: Callable) -> Callable:
+    @functools.wraps(original)
+    def wrapper(*args, **kwargs):
+        # This runs in a worker, which started with a copy of the parent's
+        # statistics, so only what it counts from here on is sent back.
+        reset()
+        result = _WorkerResult(original(*args, **kwargs))
+        cache = text_manipulation.fragment_cache
+        result.worker_stats = {
+                "counters": dict(_counters),
+                "timers": {name: attr.astuple(timer) for name, timer in _timers.items()},
+                "histograms": {name: attr.astuple(histogram) for name, histogram in _histograms.items()},
+                "fragment_cache": (cache.hits, cache.misses),
+                }
+        return result
+    return wrapper
+
+
+def _wrap(owner: Any, name: str, make_wrapper: Callable[[Callable], Callable]) -> None:
+    if (owner, name) in _originals:
+        return
+    original = owner.__dict__[name]
+    _originals[(owner, name)] = original
+    setattr(owner, name, make_wrapper(original))
+
+
+def _wrap_function(function: Callable, make_wrapper: Callable[[Callable], Callable]) -> None:
+    # Module-level functions are imported by name, so every module that
+    # imported the function gets the wrapper.
+    wrapper = make_wrapper(function)
+    for module in list(sys.modules.values()):
+        if getattr(module, "__name__", "").startswith("patchwork") and \
+                getattr(module, function.__name__, None) is function:
+            _originals[(module, function.__name__)] = function
+            setattr(module, function.__name__, wrapper)
+
+
+def enable(dump_interval: Optional[float]=None, dump_file: IO[str]=sys.stderr) -> None:
+    """Start measuring.
+
+    If ``dump_interval`` is given, the statistics are also written to
+    ``dump_file`` as JSON every ``dump_interval`` seconds.
+    """
+    global _dumper
+    for cls in [Datastore, TransactionAccumulator]:
+        for name in ["dereference", "canonicalize"]:
+            if name in cls.__dict__:
+                _wrap(cls, name, _timed("datastore.{}".format(name)))
+        _wrap(cls, "insert", _counting_insert)
+    _wrap(TransactionAccumulator, "rollback", _counting("transaction.rollbacks"))
+    _wrap(context.Context, "to_str", _timed("context.render"))
+    _wrap(scheduling.Memoizer, "can_handle", _counting_can_handle)
+    _wrap(scheduling.Memoizer, "handle", _counting_handle)
+    _wrap(scheduling.Scheduler, "resolve_action", _measuring_resolve_action)
+    # Looked up by name when the pool is started, and pickled by name.
+    _wrap(scheduling, "_automate_subtree", _reporting_automate_subtree)
+    if not any(owner is text_manipulation for owner, _ in _originals):
+        _wrap_function(text_manipulation.make_link_texts, _timed("make_link_texts"))
+
+    if dump_interval is not None and _dumper is None:
+        _stop_dumping.clear()
+        def dump() -> None:
+            while not _stop_dumping.wait(dump_interval):
+                json.dump(stats(), dump_file, indent=2, sort_keys=True)
+                dump_file.write("\n")
+                dump_file.flush()
+        _dumper = threading.Thread(target=dump, daemon=True)
+        _dumper.start()
+
+
+def disable() -> None:
+    """Stop measuring and restore the original functions.
+
+    The statistics collected so far are kept until ``reset``.
+    """
+    global _dumper
+    for (owner, name), original in _originals.items():
+        setattr(owner, name, original)
+    _originals.clear()
+    if _dumper is not None:
+        _stop_dumping.set()
+        _dumper.join()
+        _dumper = None
+
+
+def reset() -> None:
+    """Forget the statistics collected so far."""
+    for timer in _timers.values():
+        timer.calls, timer.seconds, timer.max_seconds = 0, 0.0, 0.0
+    for histogram in _histograms.values():
+        histogram.samples, histogram.total, histogram.max = 0, 0, 0
+    _counters.clear()
+    text_manipulation.fragment_cache.hits = text_manipulation.fragment_cache.misses = 0
+
+
+def stats() -> Dict[str, Any]:
+    """Return the statistics collected so far."""
+    result: Dict[str, Any] = {}
+    for name, timer in _timers.items():
+        result[name] = attr.asdict(timer)
+    for name, histogram in _histograms.items():
+        result[name] = attr.asdict(histogram)
+    result.update(_counters)
+    result["make_link_texts.cache"] = text_manipulation.fragment_cache.stats()
+
+    inserts = _counters.get("datastore.insert.duplicates", 0) + _counters.get("datastore.insert.new", 0)
+    if inserts > 0:
+        result["datastore.insert.dedup_rate"] = _counters.get("datastore.insert.duplicates", 0) / inserts
+    lookups = _counters.get("memoizer.hits", 0) + _counters.get("memoizer.misses", 0)
+    if lookups > 0:
+        result["memoizer.hit_rate"] = _counters.get("memoizer.hits", 0) / lookups
+    return result
@@ -1,22 +1,53 @@
-import pickle
+import json
+import os
 import sys
 
+from . import instrumentation
 from .datastore import Datastore
-from .scheduling import RootQuestionSession, Scheduler
+from .scheduling import Memoizer, RootQuestionSession, Scheduler
 from .interface import UserInterface
+from .mapped_datastore import MappedDatastore, write_image
+from .sqlite_datastore import SqliteDatastore, SqliteMemoStore, SqliteSchedulerStore
 from .text_manipulation import make_link_texts
+from .wal import Journal
+
+
+SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+IMAGE_SUFFIX = ".img"
+CHECKPOINT_INTERVAL = 60 # seconds
 
 
 def main(argv):
-    if len(argv) > 1:
-        fn = argv[1]
+    # With --stats, statistics about the hot paths are printed on exit.
+    stats = "--stats" in argv[1:]
+    if stats:
+        argv = [arg for arg in argv if arg != "--stats"]
+        instrumentation.enable()
+
+    if len(argv) > 1 and argv[1].endswith(SQLITE_SUFFIXES):
+        db = SqliteDatastore(argv[1])
+        sched = Scheduler(db, Memoizer(store=SqliteMemoStore(db)), store=SqliteSchedulerStore(db))
+    elif len(argv) > 1 and argv[1].endswith(IMAGE_SUFFIX):
         try:
-            with open(fn, 'rb') as f:
-                db, sched = pickle.load(f)
+            db = MappedDatastore(argv[1])
+            sched = db.load_object("scheduler")
         except FileNotFoundError:
-            print("File '{}' not found, creating...".format(fn))
+            print("File '{}' not found, creating...".format(argv[1]))
             db = Datastore()
             sched = Scheduler(db)
+        except ValueError as e:
+            print(e)
+            return
+    elif len(argv) > 1:
+        if not os.path.exists(argv[1]):
+            print("File '{}' not found, creating...".format(argv[1]))
+        journal = Journal(argv[1])
+        try:
+            db, sched = journal.open()
+        except ValueError as e:
+            print(e)
+            return
+        journal.start(CHECKPOINT_INTERVAL)
     else:
         db = Datastore()
         sched = Scheduler(db)
@@ -29,10 +60,16 @@ def main(argv):
             ui = UserInterface(sess)
             ui.cmdloop()
 
-    if len(argv) > 1:
-        with open(argv[1], "wb") as f:
-            pickle.dump((db, sched), f)
+    if isinstance(db, SqliteDatastore):
+        db.close()
+    elif len(argv) > 1 and argv[1].endswith(IMAGE_SUFFIX):
+        write_image(db, argv[1], {"scheduler": sched})
+    elif len(argv) > 1:
+        journal.close()
+
+    if stats:
+        json.dump(instrumentation.stats(), sys.stderr, indent=2, sort_keys=True)
+        sys.stderr.write("\n")
 
 if __name__ == "__main__":
     main(sys.argv)
-
@@ -0,0 +1,240 @@
+import mmap
+import os
+import pickle
+import struct
+import uuid
+
+from bisect import bisect_left
+from typing import Any, Dict, Iterator, List, MutableMapping, Optional, Set, Tuple
+
+from . import serialization
+from .datastore import Address, AliasIndex, Datastore, identity_digest
+
+# An image file consists of
+#
+# - MAGIC,
+# - the pickled content records, back to back,
+# - the address index: one ADDRESS_ENTRY per record, sorted by address,
+# - the key index: one KEY_ENTRY per record, sorted by content key,
+# - the pickled state (promises, aliases and stored objects),
+# - a FOOTER locating the indices and the state.
+#
+# Content keys are the structural digests computed by identity_digest.
+MAGIC = b"PWIMAGE1"
+ADDRESS_ENTRY = struct.Struct(">16s16sQI") # address, key, offset, length
+KEY_ENTRY = struct.Struct(">16s16s") # key, address
+FOOTER = struct.Struct(">QQQQQQ") # index offsets and counts, state offset and length
+
+
+class _SortedEntries(object):
+    """Binary-searchable view of fixed-size index entries in the image."""
+    def __init__(self, buf: mmap.mmap, entry: struct.Struct, offset: int, count: int) -> None:
+        self.buf = buf
+        self.entry = entry
+        self.offset = offset
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> bytes:
+        # Only the leading 16-byte key is compared while searching.
+        start = self.offset + i * self.entry.size
+        return self.buf[start:start + 16]
+
+    def entry_at(self, i: int) -> tuple:
+        return self.entry.unpack_from(self.buf, self.offset + i * self.entry.size)
+
+    def find(self, key: bytes) -> Optional[tuple]:
+        i = bisect_left(self, key)
+        if i < self.count and self[i] == key:
+            return self.entry_at(i)
+        return None
+
+
+class _MappedContent(MutableMapping):
+    """Content mapping backed by the image, plus changes made since opening.
+
+    Records are unpickled the first time they are read.
+    """
+    def __init__(self, store: "MappedDatastore") -> None:
+        self.store = store
+        self.added: Dict[Address, Any] = {}
+        self.removed: Set[Address] = set()
+        self.decoded: Dict[Address, Any] = {}
+
+    def record(self, address: Address) -> Optional[Tuple[bytes, bytes]]:
+        """Return the key and raw record for ``address`` if it is in the image."""
+        if address in self.added or address in self.removed:
+            return None
+        entry = self.store.address_index.find(address.location.bytes)
+        if entry is None:
+            return None
+        _, key, offset, length = entry
+        return key, self.store.buf[offset:offset + length]
+
+    def __getitem__(self, address: Address) -> Any:
+        if address in self.added:
+            return self.added[address]
+        if address in self.decoded:
+            return self.decoded[address]
+        if address in self.removed:
+            raise KeyError(address)
+        entry = self.store.address_index.find(address.location.bytes)
+        if entry is None:
+            raise KeyError(address)
+        _, _, offset, length = entry
+        content = pickle.loads(self.store.buf[offset:offset + length])
+        self.decoded[address] = content
+        return content
+
+    def __contains__(self, address: object) -> bool:
+        if not isinstance(address, Address):
+            return False
+        if address in self.added or address in self.decoded:
+            return True
+        return address not in self.removed and \
+            self.store.address_index.find(address.location.bytes) is not None
+
+    def __setitem__(self, address: Address, content: Any) -> None:
+        self.removed.discard(address)
+        self.added[address] = content
+
+    def __delitem__(self, address: Address) -> None:
+        if address not in self:
+            raise KeyError(address)
+        self.added.pop(address, None)
+        self.decoded.pop(address, None)
+        self.removed.add(address)
+
+    def __iter__(self) -> Iterator[Address]:
+        index = self.store.address_index
+        for i in range(len(index)):
+            address = Address(uuid.UUID(bytes=index[i]))
+            if address not in self.added and address not in self.removed:
+                yield address
+        yield from self.added
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+class _MappedCanonicalAddresses(MutableMapping):
+    """Map from content to canonical address, backed by the image's key index."""
+    def __init__(self, store: "MappedDatastore") -> None:
+        self.store = store
+        self.added: Dict[Any, Address] = {}
+        self.removed: Set[Any] = set()
+
+    def __getitem__(self, content: Any) -> Address:
+        if content in self.added:
+            return self.added[content]
+        if content in self.removed:
+            raise KeyError(content)
+        entry = self.store.key_index.find(identity_digest(content))
+        if entry is None:
+            raise KeyError(content)
+        return Address(uuid.UUID(bytes=entry[1]))
+
+    def __contains__(self, content: object) -> bool:
+        try:
+            self[content]
+        except KeyError:
+            return False
+        return True
+
+    def __setitem__(self, content: Any, address: Address) -> None:
+        self.removed.discard(content)
+        self.added[content] = address
+
+    def __delitem__(self, content: Any) -> None:
+        if content not in self:
+            raise KeyError(content)
+        self.added.pop(content, None)
+        self.removed.add(content)
+
+    def __iter__(self) -> Iterator[Any]:
+        raise TypeError("canonical_addresses can't be iterated: the image indexes "
+                        "digests, from which the content can't be recovered")
+
+    def __len__(self) -> int:
+        return len(self.store.content)
+
+
+class MappedDatastore(Datastore):
+    """A Datastore opened from an image file written by ``write_image``.
+
+    The image is memory-mapped read-only, and content records are only
+    decoded when they are first dereferenced, so opening takes time
+    proportional to the number of promises and aliases rather than to the
+    amount of content. Processes that open the same image share its pages.
+
+    Changes are kept in memory until the next ``write_image``.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buf[:len(MAGIC)] != MAGIC:
+            raise ValueError("{} is not a datastore image".format(path))
+        address_offset, address_count, key_offset, key_count, state_offset, state_length = \
+            FOOTER.unpack_from(self.buf, len(self.buf) - FOOTER.size)
+        self.address_index = _SortedEntries(self.buf, ADDRESS_ENTRY, address_offset, address_count)
+        self.key_index = _SortedEntries(self.buf, KEY_ENTRY, key_offset, key_count)
+        self.content = _MappedContent(self)
+        self.canonical_addresses = _MappedCanonicalAddresses(self)
+
+        self.content_addressed, self.promises, self.aliases, self._objects = \
+            serialization.loads(self.buf[state_offset:state_offset + state_length], self)
+        self.alias_index = AliasIndex(self.aliases)
+        self._init_versions()
+
+    def load_object(self, name: str) -> Any:
+        """Return an object stored with the image, such as the scheduler."""
+        return serialization.loads(self._objects[name], self)
+
+    def close(self) -> None:
+        self.buf.close()
+
+
+def write_image(db: Datastore, path: str, objects: Optional[Dict[str, Any]]=None) -> None:
+    """Write the contents of ``db`` to an image file at ``path``.
+
+    ``objects`` are stored alongside and can be retrieved with
+    ``MappedDatastore.load_object``; references from them to ``db`` are
+    resolved to the opened datastore. The file is replaced atomically, so
+    ``db`` may have been opened from ``path``.
+    """
+    tmp_path = "{}.tmp".format(path)
+    stored_objects = {name: serialization.dumps(obj, db) for name, obj in (objects or {}).items()}
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        entries: List[Tuple[bytes, bytes, int, int]] = []
+        for address in db.content:
+            record = None
+            if isinstance(db.content, _MappedContent):
+                record = db.content.record(address)
+            if record is None:
+                content = db.content[address]
+                record = (identity_digest(content),
+                          pickle.dumps(content, protocol=pickle.HIGHEST_PROTOCOL))
+            key, data = record
+            entries.append((address.location.bytes, key, f.tell(), len(data)))
+            f.write(data)
+
+        entries.sort()
+        address_offset = f.tell()
+        for entry in entries:
+            f.write(ADDRESS_ENTRY.pack(*entry))
+
+        key_offset = f.tell()
+        for key, location in sorted((key, location) for location, key, _, _ in entries):
+            f.write(KEY_ENTRY.pack(key, location))
+
+        state_offset = f.tell()
+        state = serialization.dumps(
+                (db.content_addressed, dict(db.promises), dict(db.aliases), stored_objects), db)
+        f.write(state)
+        f.write(FOOTER.pack(address_offset, len(entries), key_offset, len(entries),
+                            state_offset, len(state)))
+    os.replace(tmp_path, path)
@@ -0,0 +1,317 @@
+"""Persistent (immutable, structurally shared) sets.
+
+A PersistentSet is a hash array mapped trie. Adding or removing an item
+returns a new set that shares all but O(log n) nodes with the old one::
+
+    s = PersistentSet([1, 2])
+    t = s.add(3) # s is unchanged
+"""
+from collections.abc import Set as AbstractSet
+from typing import Any, Hashable, Iterable, Iterator, List, Optional, Tuple, Union
+
+_BITS = 5
+_MASK = (1 << _BITS) - 1
+_HASH_MASK = (1 << 64) - 1
+
+
+class _Leaf(object):
+    __slots__ = ("hash", "item")
+
+    def __init__(self, hash_: int, item: Hashable) -> None:
+        self.hash = hash_
+        self.item = item
+
+
+class _Collision(object):
+    """Items whose hashes are equal."""
+    __slots__ = ("hash", "items")
+
+    def __init__(self, hash_: int, items: Tuple[Hashable, ...]) -> None:
+        self.hash = hash_
+        self.items = items
+
+
+class _Node(object):
+    __slots__ = ("bitmap", "children")
+
+    def __init__(self, bitmap: int, children: Tuple["_Entry", ...]) -> None:
+        self.bitmap = bitmap
+        self.children = children
+
+
+_Entry = Union[_Leaf, _Collision, _Node]
+_EMPTY = _Node(0, ())
+
+
+def _bit(hash_: int, shift: int) -> int:
+    return 1 << ((hash_ >> shift) & _MASK)
+
+
+def _index(bitmap: int, bit: int) -> int:
+    return bin(bitmap & (bit - 1)).count("1")
+
+
+def _contains(node: _Node, hash_: int, item: Hashable) -> bool:
+    shift = 0
+    while True:
+        bit = _bit(hash_, shift)
+        if not node.bitmap & bit:
+            return False
+        child = node.children[_index(node.bitmap, bit)]
+        if isinstance(child, _Node):
+            node = child
+            shift += _BITS
+        elif isinstance(child, _Leaf):
+            return child.hash == hash_ and child.item == item
+        else:
+            return child.hash == hash_ and item in child.items
+
+
+def _merge(a: Union[_Leaf, _Collision], b: _Leaf, shift: int) -> _Entry:
+    # a and b sit where their hashes agree on all bits below shift.
+    if a.hash == b.hash:
+        items = a.items if isinstance(a, _Collision) else (a.item,)
+        return _Collision(a.hash, items + (b.item,))
+    bit_a = _bit(a.hash, shift)
+    bit_b = _bit(b.hash, shift)
+    if bit_a == bit_b:
+        return _Node(bit_a, (_merge(a, b, shift + _BITS),))
+    children = (a, b) if bit_a < bit_b else (b, a)
+    return _Node(bit_a | bit_b, children)
+
+
+def _add(node: _Node, hash_: int, item: Hashable, shift: int) -> Optional[_Node]:
+    """Return ``node`` with ``item`` added, or None if it is already there."""
+    bit = _bit(hash_, shift)
+    i = _index(node.bitmap, bit)
+    if not node.bitmap & bit:
+        children = node.children[:i] + (_Leaf(hash_, item),) + node.children[i:]
+        return _Node(node.bitmap | bit, children)
+
+    child = node.children[i]
+    new_child: Optional[_Entry]
+    if isinstance(child, _Node):
+        new_child = _add(child, hash_, item, shift + _BITS)
+    elif isinstance(child, _Leaf):
+        if child.hash == hash_ and child.item == item:
+            return None
+        new_child = _merge(child, _Leaf(hash_, item), shift + _BITS)
+    else:
+        if child.hash == hash_ and item in child.items:
+            return None
+        new_child = _merge(child, _Leaf(hash_, item), shift + _BITS)
+    if new_child is None:
+        return None
+    return _Node(node.bitmap, node.children[:i] + (new_child,) + node.children[i + 1:])
+
+
+# Marks that _remove did not find the item.
+_MISSING = _Node(0, ())
+
+
+def _remove(node: _Node, hash_: int, item: Hashable, shift: int) -> Optional[_Entry]:
+    """Return ``node`` without ``item``.
+
+    Returns None if nothing is left and _MISSING if ``item`` was not there. A
+    node that is left with a single leaf or collision is replaced by it, so
+    the shape of the trie only depends on the items in it.
+    """
+    bit = _bit(hash_, shift)
+    if not node.bitmap & bit:
+        return _MISSING
+    i = _index(node.bitmap, bit)
+    child = node.children[i]
+
+    new_child: Optional[_Entry]
+    if isinstance(child, _Node):
+        new_child = _remove(child, hash_, item, shift + _BITS)
+        if new_child is _MISSING:
+            return _MISSING
+    elif isinstance(child, _Leaf):
+        if child.hash != hash_ or child.item != item:
+            return _MISSING
+        new_child = None
+    else:
+        if child.hash != hash_ or item not in child.items:
+            return _MISSING
+        items = tuple(x for x in child.items if x != item)
+        new_child = _Leaf(hash_, items[0]) if len(items) == 1 else _Collision(hash_, items)
+
+    if new_child is None:
+        bitmap = node.bitmap & ~bit
+        children = node.children[:i] + node.children[i + 1:]
+    else:
+        bitmap = node.bitmap
+        children = node.children[:i] + (new_child,) + node.children[i + 1:]
+    if len(children) == 0:
+        return None
+    if len(children) == 1 and not isinstance(children[0], _Node):
+        return children[0]
+    return _Node(bitmap, children)
+
+
+def _iterate(node: _Entry) -> Iterator[Hashable]:
+    if isinstance(node, _Node):
+        for child in node.children:
+            yield from _iterate(child)
+    elif isinstance(node, _Leaf):
+        yield node.item
+    else:
+        yield from node.items
+
+
+def _equal(a: _Entry, b: _Entry) -> bool:
+    # Tries with the same items have the same shape, and tries derived from
+    # one another share most of their nodes.
+    if a is b:
+        return True
+    if isinstance(a, _Node):
+        return isinstance(b, _Node) and a.bitmap == b.bitmap and \
+            all(_equal(x, y) for x, y in zip(a.children, b.children))
+    if isinstance(a, _Leaf):
+        return isinstance(b, _Leaf) and a.hash == b.hash and a.item == b.item
+    return isinstance(b, _Collision) and a.hash == b.hash and \
+        len(a.items) == len(b.items) and all(x in b.items for x in a.items)
+
+
+def _diff(a: _Entry, b: _Entry, only_a: List[Hashable], only_b: List[Hashable]) -> None:
+    if a is b:
+        return
+    if isinstance(a, _Node) and isinstance(b, _Node):
+        bitmap = a.bitmap | b.bitmap
+        while bitmap:
+            bit = bitmap & -bitmap
+            bitmap ^= bit
+            if not b.bitmap & bit:
+                only_a.extend(_iterate(a.children[_index(a.bitmap, bit)]))
+            elif not a.bitmap & bit:
+                only_b.extend(_iterate(b.children[_index(b.bitmap, bit)]))
+            else:
+                _diff(a.children[_index(a.bitmap, bit)], b.children[_index(b.bitmap, bit)],
+                      only_a, only_b)
+    else:
+        # At most a few items end up here, unless most of the hash is shared.
+        items_a, items_b = list(_iterate(a)), list(_iterate(b))
+        only_a.extend(item for item in items_a if item not in items_b)
+        only_b.extend(item for item in items_b if item not in items_a)
+
+
+class PersistentSet(AbstractSet):
+    """An immutable set that shares structure with the sets derived from it.
+
+    The hash is computed once, and comparing sets derived from one another
+    skips the parts they share.
+    """
+    __slots__ = ("_root", "_len", "_cached_hash")
+
+    def __init__(self, items: Iterable[Hashable]=()) -> None:
+        root, length = _EMPTY, 0
+        for item in items:
+            new_root = _add(root, hash(item) & _HASH_MASK, item, 0)
+            if new_root is not None:
+                root, length = new_root, length + 1
+        self._root = root
+        self._len = length
+        self._cached_hash: Optional[int] = None
+
+    @classmethod
+    def _make(cls, root: _Node, length: int) -> "PersistentSet":
+        result = cls.__new__(cls)
+        result._root = root
+        result._len = length
+        result._cached_hash = None
+        return result
+
+    @classmethod
+    def _from_iterable(cls, items: Iterable[Hashable]) -> "PersistentSet":
+        return cls(items)
+
+    def add(self, item: Hashable) -> "PersistentSet":
+        """Return this set with ``item`` added."""
+        root = _add(self._root, hash(item) & _HASH_MASK, item, 0)
+        if root is None:
+            return self
+        return self._make(root, self._len + 1)
+
+    def update(self, items: Iterable[Hashable]) -> "PersistentSet":
+        """Return this set with ``items`` added."""
+        result = self
+        for item in items:
+            result = result.add(item)
+        return result
+
+    def discard(self, item: Hashable) -> "PersistentSet":
+        """Return this set without ``item``."""
+        hash_ = hash(item) & _HASH_MASK
+        root = _remove(self._root, hash_, item, 0)
+        if root is _MISSING:
+            return self
+        if root is None:
+            return self._make(_EMPTY, 0)
+        if not isinstance(root, _Node):
+            root = _Node(_bit(root.hash, 0), (root,))
+        return self._make(root, self._len - 1)
+
+    def remove(self, item: Hashable) -> "PersistentSet":
+        """Return this set without ``item``, which must be in it."""
+        result = self.discard(item)
+        if result is self:
+            raise KeyError(item)
+        return result
+
+    def diff(self, other: "PersistentSet") -> Tuple[List[Hashable], List[Hashable]]:
+        """Return the items that are only in this set and those only in ``other``.
+
+        Like comparing, this skips the parts that the sets share, so it is
+        cheap for sets derived from one another.
+        """
+        only_self: List[Hashable] = []
+        only_other: List[Hashable] = []
+        _diff(self._root, other._root, only_self, only_other)
+        return only_self, only_other
+
+    def __contains__(self, item: object) -> bool:
+        try:
+            hash_ = hash(item) & _HASH_MASK
+        except TypeError:
+            return False
+        return _contains(self._root, hash_, item)
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return _iterate(self._root)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __hash__(self) -> int:
+        if self._cached_hash is None:
+            self._cached_hash = self._hash_items()
+        return self._cached_hash
+
+    def _hash_items(self) -> int:
+        # The same hash as a frozenset of the same items.
+        return AbstractSet._hash(self)
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, PersistentSet):
+            if self is other:
+                return True
+            if self._len != other._len:
+                return False
+            if self._cached_hash is not None and other._cached_hash is not None and \
+                    self._cached_hash != other._cached_hash:
+                return False
+            return _equal(self._root, other._root)
+        return super().__eq__(other)
+
+    def __ne__(self, other: object) -> bool:
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        # The trie depends on the hashes of the items, which may differ
+        # between processes.
+        return (PersistentSet, (list(self),))
+
+    def __repr__(self) -> str:
+        return "PersistentSet({!r})".format(list(self))
@@ -1,13 +1,18 @@
-from collections import deque
-from typing import Deque, Dict, Iterator, List, Optional, Set, Tuple, TypeVar, \
-    Union
+import multiprocessing
+import threading
+
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, IO, Iterator, List, Mapping, MutableMapping, Optional, \
+    Set, Tuple, TypeVar, Union
+
+import parsy
 
 from .actions import Action
 from .context import Context
-from .datastore import Address, Datastore, TransactionAccumulator
+from .datastore import Address, Changes, Datastore, TransactionAccumulator
 from .hypertext import Workspace
 
-from .text_manipulation import insert_raw_hypertext, make_link_texts
+from .text_manipulation import insert_raw_hypertext, iter_link_text
 
 
 # Credits: Adapted from first_true in itertools docs.
@@ -22,69 +27,22 @@ def next_truthy(iterator: Iterator[T], default: VT) -> Union[T, VT]:
 
 
 # What is the scheduler's job, what is the automator's job, and what is the session's job?
-# Well, it seems like the session should know which contexts are "active", at least, and
-# therefore which ones are available to be worked on.
-
-# The scheduler also needs to be responsible for coordinating automators, which means that
-# when a session records an action, the scheduler needs to check to see whether that action
-# will create a cycle, and only actually perform the action if it does not create a cycle.
-# This seems kind of scary since action execution (right now) can modify the state of the
-# database by fulfilling real promises. This cannot then be undone.  Maybe a better solution
-# here would be for action execution to return a representation of their effects instead.
-# I think promise fulfilment is the only scary thing here, though? Scratchpad editing seems
-# straightforwardly fine, asking subquestions is scary from the perspective of
-# "we might accidentally automate something that produces an infinite loop of subquestions" but
-# is not scary if you avoid that problem (you might end up with some uncollected garbage
-# in the datastore, but no infinite loops due to the workspace itself. Forgotten workspaces are
-# forgotten, and they don't prescribe any actions).
-
-# An automator clearly has to have a method which accepts a context and produces something.
-# Should it produce contexts? This seems plausible to me. However it could instead produce some
-# form of actions.
-
-# Some stuff about cycle detection:
-
-# Hm. What kind of cycles actually matter?
-
-# Budgets should circumvent this problem.
-
-# It's actually fine to produce a subquestion that _looks_ identical to the 
-# parent question, and in fact this is one way automation can work at all.
-# It's only not fine to produce a subquestion that _is_ the same as a parent
-# question, down to... what, exactly? Obviously ending up with a workspace
-# who's its own ancestor in the subquestion graph is bad. But you can end up
-# with this situation in annoying ways.
-
-# `A -> B [1] -> C -> B [2]` is fine.
-# `A -> B -> C -> B` is not.
-
-# But imagine you actually get `A -> (B, C)`, `B -> C`, and `C -> B`. You don't
-# want to privilege `B -> C` or `C -> B` over the other. But in some sense you
-# have to: You can't block actions, or else you have to sometimes show a user a
-# random error message.
-
-# So you have to present the temporally _second_ creator of `B -> C` or `C -> B`
-# the error message immediately (this is an unfortunate but necessary "side channel").
-# The problem that _this_ produces is that `C -> B` may be created _automatically_.
-
-# Imagine that you have previously seen that `A -> B [(locked) 1] -> C`. So you stored
-# that `B $1` produces `ask C`. But now you see that `C -> B [(locked) 2]`.
-# `B [(locked) 2]` is a different workspace from `B $1`, so the naive workspace-based
-# checking doesn't notice anything wrong until it tries to look at actions produced by
-# `C`, at which time it's too late (since C has already been scheduled). There is now
-# no way out of the trap.
-
-# I _think_ that you instead need to do the checking based on contexts: When you perform
-# an action, if you did all the automated steps this action implies, would you end up
-# with any copies of your starting workspace?
-
-# This implies a sort of automation-first approach that is pretty different from the
-# original way I wrote the scheduler, and might produce a much slower user experience
-# if the system gets big and highly automated.
-
-# Yeah, I think the best thing to do is basically do all possible automation up front inside
-# a transaction, as soon as an action is taken, letting bits throw exceptions if a cycle
-# would be created. When that happens, we can discard the transaction; otherwise we commit it.
+# The session knows which contexts are "active", and therefore which ones are available to
+# be worked on. The scheduler keeps the pending contexts and coordinates the automators.
+
+# An automator accepts a context and produces an action for it. Whenever an action is
+# taken, the scheduler performs all the automated steps it implies inside one transaction
+# before committing, so a user never sees a context that could have been automated.
+
+# Automation can loop: `A -> B [1] -> C -> B [2]` replays the actions recorded for `B`
+# forever, and the workspaces involved are all different, so cycles can't reliably be
+# detected from them. Instead, contexts carry budgets. Each automated step is paid for
+# from the budget of the context it is taken in, and the contexts it produces, including
+# subquestions, start with what is left. A chain of automated steps, however deep its
+# subquestions go, therefore stops after `budget` steps, and a branch that loops only uses
+# up its own budget. Every action a user takes, and every root question asked, starts
+# with a fresh allowance. When a budget runs out, the context is shown to users with
+# "Budget exhausted." appended, so they can tell a loop from an ordinary question.
 
 
 class Automator(object):
@@ -94,116 +52,591 @@ class Automator(object):
     def handle(self, context: Context) -> Action:
         raise NotImplementedError("Automator is pure virtual")
 
+    def references(self) -> List[Any]:
+        """Return the addresses and contexts this automator needs to keep alive.
+
+        Actions only contain text, so an automator that stores actions (like
+        the Memoizer) doesn't need to keep anything alive.
+        """
+        return []
+
 
 class Memoizer(Automator):
     """A memoizer for H's actions.
 
     This memoizer learns H's mapping ``str(Context) → Action`` and can be called
     instead of H for all string representations of contexts that it has seen.
+    Contexts that only differ in the numbering of anonymous pointers count as
+    the same: actions are kept with the canonical pointer names (see
+    ``Context.canonical_names``), keyed by ``Context.digest``, and translated
+    to the names of the context they are replayed in.
+
+    If ``maxsize`` is given, at most that many actions are kept in memory,
+    and the least recently used (``policy="lru"``) or the oldest
+    (``policy="fifo"``) are evicted first. If a ``store`` (a mutable mapping
+    such as :py:class:`patchwork.sqlite_datastore.SqliteMemoStore`) is given,
+    every action is also written to it, and actions that are not in memory are
+    looked up there, so they are not lost on eviction and can be shared
+    between runs.
     """
-    def __init__(self):
-        self.cache: Dict[str, Action] = {}
+    def __init__(
+            self,
+            maxsize: Optional[int]=None,
+            policy: str="lru",
+            store: Optional[MutableMapping[bytes, Action]]=None,
+            ) -> None:
+        if policy not in ("lru", "fifo"):
+            raise ValueError("Unknown eviction policy {!r}".format(policy))
+        self.cache: "OrderedDict[bytes, Action]" = OrderedDict()
+        self.maxsize = maxsize
+        self.policy = policy
+        self.store = store
+        # Lookups reorder the cache during automation, while checkpoints
+        # (see patchwork.wal) may be pickling it from another thread.
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        with self._lock:
+            state = self.__dict__.copy()
+            state["cache"] = self.cache.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def key(self, context: Context) -> bytes:
+        """Return the key under which actions for ``context`` are cached."""
+        return context.digest
 
     def remember(self, context: Context, action: Action):
-        self.cache[str(context)] = action
+        self.update({self.key(context): self.generalize(context, action)})
+
+    def generalize(self, context: Context, action: Action) -> Action:
+        """Return ``action``, taken in ``context``, as it is remembered."""
+        return action.rename_pointers(context.canonical_names)
+
+    def update(self, entries: Mapping[bytes, Action], store: bool=True) -> None:
+        """Add the actions in ``entries``, which are generalized and keyed
+        like remember's. Unless ``store`` is false, they are also written to
+        the store."""
+        with self._lock:
+            for key, action in entries.items():
+                self._cache(key, action)
+                if store and self.store is not None:
+                    self.store[key] = action
 
     def forget(self, context: Context):
-        del self.cache[str(context)]
+        key = self.key(context)
+        with self._lock:
+            self.cache.pop(key, None)
+            if self.store is not None:
+                self.store.pop(key, None)
+
+    def lookup(self, key: bytes) -> Optional[Action]:
+        with self._lock:
+            action = self.cache.get(key)
+            if action is not None:
+                if self.policy == "lru":
+                    self.cache.move_to_end(key)
+            elif self.store is not None:
+                action = self.store.get(key)
+                if action is not None:
+                    self._cache(key, action)
+            return action
+
+    def _cache(self, key: bytes, action: Action) -> None:
+        self.cache[key] = action
+        self.cache.move_to_end(key)
+        if self.maxsize is not None and len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
 
     def can_handle(self, context: Context) -> bool:
-        return str(context) in self.cache
+        return self.lookup(self.key(context)) is not None
 
     def handle(self, context: Context) -> Action:
-        return self.cache[str(context)]
+        action = self.lookup(self.key(context))
+        if action is None:
+            raise KeyError("No action for this context")
+        names = {canonical: name for name, canonical in context.canonical_names.items()}
+        return action.rename_pointers(names)
+
+
+class SchedulerStore(object):
+    """Where a Scheduler keeps what it needs to carry on after a restart.
+
+    Subclasses keep these in tables. ``contexts`` holds the pending and
+    active contexts by their position, and ``root_answer_promises`` holds the
+    order in which each root question was asked. The scheduler changes them
+    inside ``db.committing()``, along with the commits they go with.
+    """
+    contexts: MutableMapping[int, Context]
+    root_answer_promises: MutableMapping[Address, int]
 
 
 class Scheduler(object):
-    def __init__(self, db: Datastore) -> None:
+    """Schedules contexts for users and automates what it can.
+
+    Automation that a root question or a user's action sets off gets a
+    ``budget``. Every automated action is paid for from the budget of the
+    context it is taken in, and the contexts it produces, subquestions
+    included, get what is left, so memoized answers are replayed up to
+    ``budget`` levels of subquestions deep, and automation always stops.
+    Contexts that could have been automated if there had been budget left
+    are left for users, and say so.
+
+    If ``processes`` is given, automation is spread over that many worker
+    processes, which pays off when large memoized computations are replayed.
+    As soon as there are several contexts to automate, each of them and the
+    contexts it produces are automated in a worker, on a copy of the
+    transaction forked from this process. Their changes are merged back in
+    a fixed order, so the outcome doesn't depend on which worker finishes
+    first. This needs the fork start method of multiprocessing.
+
+    If a ``store`` is given, the scheduler continues from the state kept in
+    it, and saves each change to it as it is made rather than being pickled
+    as a whole. Contexts that were active when it stopped are pending again.
+    """
+    def __init__(
+            self,
+            db: Datastore,
+            memoizer: Optional[Memoizer]=None,
+            budget: int=1000,
+            processes: Optional[int]=None,
+            store: Optional[SchedulerStore]=None,
+            ) -> None:
+        if processes is not None and "fork" not in multiprocessing.get_all_start_methods():
+            raise ValueError("Automating in processes needs the fork start method")
         self.db = db
+        self.budget = budget
+        self.processes = processes
+        self.store = store
 
         # Contexts that are currently being shown to a user
         self.active_contexts: Set[Context] = set()
 
         # Contexts that are waiting to be shown to a user because
         # they cannot be automated.
-
-        # (note that these semantics mean that we must iterate over these contexts
-        # every time the automatability criteria change)
         self.pending_contexts: Deque[Context] = deque([])
 
+        # The pending contexts by memo key. Automators only change their
+        # minds when the memoizer learns an action or an automator is added,
+        # so only the contexts with the key of a new action need to be looked
+        # at again after an action, and all of them after add_automator.
+        self.pending_by_key: Dict[bytes, List[Context]] = {}
+
+        # The pending contexts by the promises of their workspaces, so that
+        # choose_context only looks at the ones that can advance a promise.
+        # Each entry carries its position in pending_contexts: new contexts
+        # are numbered down from zero and relinquished ones up from it.
+        self.pending_by_promise: Dict[Address, List[Tuple[int, Context]]] = {}
+        self.pending_first = 0
+        self.pending_last = 0
+
         # Things that can automate work - only the memoizer for now, though we could add
         # calculators, programs, macros, distilled agents, etc.
-        self.memoizer = Memoizer()
+        self.memoizer = memoizer if memoizer is not None else Memoizer()
         self.automators: List[Automator] = [self.memoizer]
 
-    def ask_root_question(self, contents: str) -> Tuple[Context, Address]:
+        # Answer promises of the root questions that have been asked.
+        self.root_answer_promises: List[Address] = []
+
+        if store is not None:
+            self.restore()
+
+    def restore(self) -> None:
+        """Take up the state kept in the store, as after a restart."""
+        assert self.store is not None
+        self.active_contexts = set()
+        self.pending_contexts = deque([])
+        self.pending_by_key = {}
+        self.pending_by_promise = {}
+        self.pending_first = self.pending_last = 0
+        roots = sorted(self.store.root_answer_promises.items(), key=lambda item: item[1])
+        self.root_answer_promises = [promise for promise, _ in roots]
+        for position, context in sorted(self.store.contexts.items(), key=lambda item: item[0]):
+            context.position = position
+            self.pending_contexts.append(context)
+            self._index_pending(context, position)
+            self.pending_first = min(self.pending_first, position)
+            self.pending_last = max(self.pending_last, position)
+
+    def ask_root_question(self, contents: str) -> Tuple[Optional[Context], Address]:
         # How root!
-        question_link = insert_raw_hypertext(contents, self.db, {})
-        answer_link = self.db.make_promise()
-        final_workspace_link = self.db.make_promise()
-        scratchpad_link = insert_raw_hypertext("", self.db, {})
-        new_workspace = Workspace(question_link, answer_link, final_workspace_link, scratchpad_link, [])
-        new_workspace_link = self.db.insert(new_workspace)
-        result = Context(new_workspace_link, self.db)
-        answer_link = self.db.dereference(result.workspace_link).answer_promise
-        self.active_contexts.add(result)
-        while self.memoizer.can_handle(result):
-            result = self.resolve_action(result, self.memoizer.handle(result))
+        transaction = TransactionAccumulator(self.db)
+        try:
+            question_link = insert_raw_hypertext(contents, transaction, {})
+            answer_link = transaction.make_promise()
+            final_workspace_link = transaction.make_promise()
+            scratchpad_link = insert_raw_hypertext("", transaction, {})
+            new_workspace = Workspace(question_link, answer_link, final_workspace_link, scratchpad_link, [])
+            new_workspace_link = transaction.insert(new_workspace)
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        # The workspace may be one that was there already.
+        answer_link = self.db.dereference(new_workspace_link).answer_promise
+        with self.db.committing(): # Checkpoints must see the scheduler as a whole.
+            if answer_link not in self.root_answer_promises:
+                if self.store is not None:
+                    self.store.root_answer_promises[answer_link] = len(self.root_answer_promises)
+                self.root_answer_promises.append(answer_link)
+            if self.db.is_fulfilled(answer_link):
+                # Replaying the memoized actions would only find the same answer.
+                return None, answer_link
+            result = Context(new_workspace_link, self.db, budget=self.budget)
+            self._activate(result)
+        while result is not None and self.memoizer.can_handle(result):
+            if result.budget <= 0:
+                result.budget_exhausted = True
+                break
+            result = self._resolve(result, self.memoizer.handle(result), result.budget - 1, [], {})
 
         return result, answer_link
 
     def resolve_action(self, starting_context: Context, action: Action) -> Optional[Context]:
-        # NOTE: There's a lot of wasted work in here for the sake of rolling back cycle-driven mistakes.
-        # This stuff could all be removed if we had budgets.
+        """Take ``action``, which a user chose, in ``starting_context``.
+
+        The action is remembered, and the automation it sets off gets a
+        fresh budget. Returns the successor context, if any.
+        """
         assert starting_context in self.active_contexts
-        transaction = TransactionAccumulator(self.db)
-        self.memoizer.remember(starting_context, action)
-        
+        key = self.memoizer.key(starting_context)
+        memo_entries = {key: self.memoizer.generalize(starting_context, action)}
+        with self.db.committing():
+            # The action is only written to the memoizer's store along with
+            # what it led to (see _resolve).
+            self.memoizer.update(memo_entries, store=False)
+            # The pending contexts that the memoizer can now handle.
+            woken = [c.with_budget(self.budget) for c in self.pending_by_key.get(key, [])]
         try:
-            successor, other_contexts = action.execute(transaction, starting_context) 
-            un_automatable_contexts: List[Context] = []
-            possibly_automatable_contexts = deque(self.pending_contexts)
-            possibly_automatable_contexts.extendleft(other_contexts)
-
-            while len(possibly_automatable_contexts) > 0:
-                context = possibly_automatable_contexts.popleft()
-                automatic_action = None
-                for automator in self.automators:
-                    if automator.can_handle(context):
-                        automatic_action = automator.handle(context)
-                        break
-                if automatic_action is not None:
-                    new_successor, new_contexts = automatic_action.execute(transaction, context)
-                    if new_successor is not None: # in the automated setting, successors are not special.
-                        new_contexts.append(new_successor)
-                    for context in new_contexts:
-                        if context.is_own_ancestor(transaction): # So much waste
-                            raise ValueError("Action resulted in an infinite loop")
-                        possibly_automatable_contexts.append(context)
-                else:
-                    un_automatable_contexts.append(context)
+            return self._resolve(starting_context, action, self.budget, woken, memo_entries)
+        except:
+            with self.db.committing():
+                self.memoizer.forget(starting_context)
+            raise
 
-            transaction.commit()
-            self.pending_contexts = deque(un_automatable_contexts)
-            self.active_contexts.remove(starting_context)
-            if successor is not None:
-                self.active_contexts.add(successor)
+    def _resolve(
+            self,
+            starting_context: Context,
+            action: Action,
+            budget: int,
+            woken: List[Context],
+            memo_entries: Dict[bytes, Action],
+            ) -> Optional[Context]:
+        """Take ``action`` in ``starting_context`` with ``budget`` left, and
+        automate the contexts it produces and the pending contexts in ``woken``."""
+        transaction = TransactionAccumulator(self.db)
+        transaction.memo_entries.update(memo_entries)
+        try:
+            successor, other_contexts = action.execute(transaction, starting_context.with_budget(budget))
+            new_contexts = list(reversed(other_contexts))
+            left_new, automated, left_derived = self._automate(transaction, new_contexts, woken)
+
+            with self.db.committing(): # Checkpoints must see the scheduler and datastore agree.
+                transaction.commit()
+                self.memoizer.update(memo_entries)
+                self._update_pending(left_new, automated, left_derived)
+                self.active_contexts.remove(starting_context)
+                self._unstore(starting_context)
+                if successor is not None:
+                    self._activate(successor)
             return successor
         except:
-            self.memoizer.forget(starting_context)
+            transaction.rollback()
             raise
 
+    def add_automator(self, automator: Automator) -> None:
+        """Add ``automator`` and let it take over the pending contexts it can handle."""
+        with self.db.committing():
+            self.automators.append(automator)
+            woken = [c.with_budget(self.budget) for c in self.pending_contexts]
+        transaction = TransactionAccumulator(self.db)
+        try:
+            _, automated, left_derived = self._automate(transaction, [], woken)
+            with self.db.committing():
+                transaction.commit()
+                self._update_pending([], automated, left_derived)
+        except:
+            transaction.rollback()
+            raise
+
+    def _automate(
+            self,
+            transaction: TransactionAccumulator,
+            new_contexts: List[Context],
+            woken: List[Context],
+            ) -> Tuple[List[Context], List[Context], List[Context]]:
+        """Automate ``new_contexts``, the pending contexts in ``woken`` and
+        the contexts this produces, as far as possible.
+
+        Returns the new contexts that are left, the woken contexts that were
+        automated and the left contexts that automation produced.
+        """
+        contexts = new_contexts + woken
+        if self.processes is None:
+            automated, left_derived = self._cascade(transaction, contexts)
+        else:
+            automated, left_derived = self._cascade_in_processes(transaction, contexts)
+        left_new = [c for c, done in zip(new_contexts, automated) if not done]
+        automated_woken = [c for c, done in zip(woken, automated[len(new_contexts):]) if done]
+        return left_new, automated_woken, left_derived
+
+    def _cascade(
+            self,
+            transaction: TransactionAccumulator,
+            contexts: List[Context],
+            ) -> Tuple[List[bool], List[Context]]:
+        """Automate ``contexts`` and the contexts this produces, as far as possible.
+
+        Returns whether each of ``contexts`` was automated, and the produced
+        contexts that are left.
+        """
+        automated: List[bool] = []
+        left: List[Context] = []
+        possibly_automatable_contexts = deque(contexts)
+        while len(possibly_automatable_contexts) > 0:
+            context = possibly_automatable_contexts.popleft()
+            produced = self._step(transaction, context)
+            if produced is not None:
+                possibly_automatable_contexts.extend(produced)
+            if len(automated) < len(contexts):
+                automated.append(produced is not None)
+            elif produced is None:
+                left.append(context)
+        return automated, left
+
+    def _cascade_in_processes(
+            self,
+            transaction: TransactionAccumulator,
+            contexts: List[Context],
+            ) -> Tuple[List[bool], List[Context]]:
+        """Like _cascade, but automate independent subtrees of the cascade
+        in worker processes.
+
+        Contexts are automated here until there are several to automate.
+        Each of those and the contexts it produces form a subtree that
+        doesn't depend on the others, unless one of them answers a question
+        that another waits for or answers too. See _automate_subtrees.
+        """
+        automated: List[bool] = []
+        left: List[Context] = []
+        frontier = contexts
+        while len(frontier) == 1:
+            context = frontier[0]
+            produced = self._step(transaction, context)
+            if len(automated) < len(contexts):
+                automated.append(produced is not None)
+            elif produced is None:
+                left.append(context)
+            frontier = produced or []
+        if len(frontier) > 0:
+            subtrees = self._automate_subtrees(transaction, frontier)
+            for context, (done, subtree_left) in zip(frontier, subtrees):
+                if len(automated) < len(contexts):
+                    automated.append(done)
+                elif not done:
+                    left.append(context)
+                left.extend(subtree_left)
+        return automated, left
+
+    def _automate_subtrees(
+            self,
+            transaction: TransactionAccumulator,
+            contexts: List[Context],
+            ) -> List[Tuple[bool, List[Context]]]:
+        """Automate each of ``contexts`` and the contexts it produces in a
+        worker process, and merge the changes into ``transaction``.
+
+        Returns whether each context was automated, and the produced contexts
+        that are left. The changes are merged in the order of ``contexts``.
+        A subtree that resolves a promise which an earlier one resolved or
+        waits for, or waits for a promise which an earlier one resolved, is
+        automated again on top of the merged changes instead.
+        """
+        global _forked
+        assert self.processes is not None
+        _forked = (self, transaction, contexts)
+        try:
+            # The workers inherit what they need when they are forked, so
+            # only indices and results are sent between processes.
+            with multiprocessing.get_context("fork").Pool(
+                    min(self.processes, len(contexts)), _start_worker) as pool:
+                results = pool.map(_automate_subtree, range(len(contexts)), chunksize=1)
+        finally:
+            _forked = None
+
+        merged: List[Tuple[bool, List[Context]]] = []
+        resolved: Set[Address] = set()
+        waited_for: Set[Address] = set()
+        for context, (done, exhausted, left, changes) in zip(contexts, results):
+            if not changes.resolved_promises.isdisjoint(resolved | waited_for) \
+                    or not resolved.isdisjoint(changes.additional_promisees):
+                savepoint = transaction.savepoint()
+                (done,), left = self._cascade(savepoint, [context])
+                changes = savepoint.changes()
+                savepoint.commit()
+            else:
+                context.budget_exhausted = exhausted
+                transaction.apply(changes)
+            resolved.update(changes.resolved_promises)
+            waited_for.update(changes.additional_promisees)
+            merged.append((done, left))
+        return merged
+
+    def _step(
+            self,
+            transaction: TransactionAccumulator,
+            context: Context,
+            ) -> Optional[List[Context]]:
+        """Automate ``context`` if possible, and return the contexts this produces.
+
+        The action runs in a savepoint of ``transaction``. If it fails, as a
+        replayed action can in a context it doesn't fit, only its changes are
+        rolled back and ``context`` is left for a user.
+        """
+        automator = next_truthy((a for a in self.automators if a.can_handle(context)), None)
+        if automator is None:
+            return None
+        if context.budget <= 0:
+            context.budget_exhausted = True
+            return None
+        action = automator.handle(context)
+        savepoint = transaction.savepoint()
+        try:
+            new_successor, produced = action.execute(savepoint, context.with_budget(context.budget - 1))
+        except (parsy.ParseError, ValueError, KeyError):
+            savepoint.rollback()
+            return None
+        savepoint.commit()
+        if new_successor is not None: # in the automated setting, successors are not special.
+            produced.append(new_successor)
+        return produced
+
+    def _update_pending(
+            self,
+            left_new: List[Context],
+            automated: List[Context],
+            left_derived: List[Context],
+            ) -> None:
+        # New contexts go first, then the pending contexts that are still
+        # pending, then the contexts that automation left.
+        for context in automated:
+            self.pending_contexts.remove(context)
+            self._unindex_pending(context)
+            self._unstore(context)
+        self.pending_contexts.extendleft(reversed(left_new))
+        self.pending_contexts.extend(left_derived)
+        for context in reversed(left_new):
+            self.pending_first -= 1
+            self._index_pending(context, self.pending_first)
+            self._store(context, self.pending_first)
+        for context in left_derived:
+            self.pending_last += 1
+            self._index_pending(context, self.pending_last)
+            self._store(context, self.pending_last)
+
+    def _index_pending(self, context: Context, position: int) -> None:
+        self.pending_by_key.setdefault(self.memoizer.key(context), []).append(context)
+        for promise in self.db.dereference(context.workspace_link).promises:
+            self.pending_by_promise.setdefault(promise, []).append((position, context))
+
+    def _unindex_pending(self, context: Context) -> None:
+        key = self.memoizer.key(context)
+        waiting = self.pending_by_key[key]
+        waiting.remove(context)
+        if len(waiting) == 0:
+            del self.pending_by_key[key]
+        for promise in self.db.dereference(context.workspace_link).promises:
+            waiting_for_promise = self.pending_by_promise[promise]
+            index = next(i for i, (_, c) in enumerate(waiting_for_promise) if c == context)
+            del waiting_for_promise[index]
+            if len(waiting_for_promise) == 0:
+                del self.pending_by_promise[promise]
+
+    def _activate(self, context: Context) -> None:
+        # If the scheduler stops while it is active, the context is pending
+        # again, ahead of the others.
+        self.active_contexts.add(context)
+        self.pending_first -= 1
+        self._store(context, self.pending_first)
+
+    def _store(self, context: Context, position: int) -> None:
+        """Keep ``context`` at ``position`` in the store, if there is one."""
+        if self.store is not None:
+            self._unstore(context)
+            context.position = position
+            self.store.contexts[position] = context
+
+    def _unstore(self, context: Context) -> None:
+        if self.store is not None and context.position is not None:
+            self.store.contexts.pop(context.position, None)
+            context.position = None
+
     def choose_context(self, promise: Address) -> Context:
-        """Return a context that can advance ``promise``."""
-        choice = next(c for c in self.pending_contexts
-                      if c.can_advance_promise(self.db, promise))
-        self.pending_contexts.remove(choice)
-        self.active_contexts.add(choice)
+        """Return the first pending context that can advance ``promise``.
+
+        Raises StopIteration if there is none.
+        """
+        with self.db.committing():
+            # See Context.can_advance_promise.
+            candidates = [entry
+                          for p in self.db.advancing_promises(promise)
+                          for entry in self.pending_by_promise.get(p, [])]
+            if len(candidates) == 0:
+                raise StopIteration("No pending context can advance {}".format(promise))
+            _, choice = min(candidates, key=lambda entry: entry[0])
+            self.pending_contexts.remove(choice)
+            self._unindex_pending(choice)
+            self.active_contexts.add(choice)
         return choice
 
     def relinquish_context(self, context: Context) -> None:
-        self.pending_contexts.append(context)
-        self.active_contexts.remove(context)
+        with self.db.committing():
+            self.pending_contexts.append(context)
+            self.pending_last += 1
+            self._index_pending(context, self.pending_last)
+            self._store(context, self.pending_last)
+            self.active_contexts.remove(context)
+
+    def collect_garbage(self) -> int:
+        """Drop everything from the datastore that the scheduler can't reach.
+
+        Returns the number of bytes reclaimed.
+        """
+        roots: List[Any] = list(self.root_answer_promises)
+        roots.extend(self.active_contexts)
+        roots.extend(self.pending_contexts)
+        for automator in self.automators:
+            roots.extend(automator.references())
+        return self.db.collect_garbage(roots)
+
+
+# The scheduler, transaction and contexts of Scheduler._automate_subtrees,
+# which its worker processes inherit when they are forked.
+_forked: Optional[Tuple[Scheduler, TransactionAccumulator, List[Context]]] = None
+
+
+def _start_worker() -> None:
+    # The worker is forked from a process in which a checkpoint may have
+    # been pickling the memoizer, and its lock would stay held here.
+    assert _forked is not None
+    _forked[0].memoizer._lock = threading.Lock()
+
+
+def _automate_subtree(i: int) -> Tuple[bool, bool, List[Context], Changes]:
+    """Automate the ``i``th context of _forked and the contexts it produces.
+
+    Returns whether the context was automated, whether its budget was
+    exhausted, the produced contexts that are left and the changes made.
+    """
+    assert _forked is not None
+    sched, transaction, contexts = _forked
+    savepoint = transaction.savepoint()
+    (done,), left = sched._cascade(savepoint, [contexts[i]])
+    return done, contexts[i].budget_exhausted, left, savepoint.changes()
 
 
 class Session(object):
@@ -280,20 +713,33 @@ class RootQuestionSession(Session):
         finds any promises that the root answer points to. The caller can then
         schedule contexts to resolve these promises.
         """
-        if not self.sched.db.is_fulfilled(root):
-            return root
-
-        return next_truthy((self.choose_promise(child)
-                            for child in self.sched.db.dereference(root).links()),
-                           None)
+        db = self.sched.db
+        # Depth-first, in the order of the links. Hypertext can be shared,
+        # but once searched, it doesn't need to be searched again.
+        stack = [root]
+        searched: Set[Address] = set()
+        while len(stack) > 0:
+            link = stack.pop()
+            if not db.is_fulfilled(link):
+                return link
+            if link not in searched:
+                searched.add(link)
+                stack.extend(reversed(db.dereference(link).links()))
+        return None
 
     def format_root_answer(self) -> str:
         """Format the root answer with all its pointers unlocked."""
-        self.root_answer = make_link_texts(
-                                self.root_answer_promise,
-                                self.sched.db)[self.root_answer_promise]
+        self.root_answer = "".join(iter_link_text(self.root_answer_promise, self.sched.db))
         return self.root_answer
 
+    def write_root_answer(self, out: IO[str]) -> None:
+        """Write the root answer with all its pointers unlocked to ``out``.
+
+        Unlike format_root_answer, this doesn't build the answer in memory.
+        """
+        for text in iter_link_text(self.root_answer_promise, self.sched.db):
+            out.write(text)
+
     def act(self, action: Action) -> Union[Context, str]:
         resulting_context = self.sched.resolve_action(self.current_context,
                                                       action)
@@ -0,0 +1,43 @@
+import io
+import pickle
+
+from typing import Any, Optional
+
+from .datastore import Datastore
+
+
+class _Pickler(pickle.Pickler):
+    # Objects kept in a datastore may refer to the datastore itself (for
+    # example, the scheduler does). Those references are stored symbolically
+    # and resolved to the open datastore when loading.
+    def __init__(self, file: io.BytesIO, store: Datastore) -> None:
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.store = store
+
+    def persistent_id(self, obj: Any) -> Optional[str]:
+        if obj is self.store:
+            return "datastore"
+        return None
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, file: io.BytesIO, store: Datastore) -> None:
+        super().__init__(file)
+        self.store = store
+
+    def persistent_load(self, pid: Any) -> Any:
+        if pid == "datastore":
+            return self.store
+        raise pickle.UnpicklingError("unsupported persistent id {}".format(pid))
+
+
+def dumps(obj: Any, store: Datastore) -> bytes:
+    """Pickle ``obj``, replacing references to ``store`` by a placeholder."""
+    f = io.BytesIO()
+    _Pickler(f, store).dump(obj)
+    return f.getvalue()
+
+
+def loads(data: bytes, store: Datastore) -> Any:
+    """Unpickle ``data``, resolving the placeholder to ``store``."""
+    return _Unpickler(io.BytesIO(data), store).load()
@@ -0,0 +1,292 @@
+import os
+import pickle
+import sqlite3
+import uuid
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Generator, Iterable, Iterator, List, MutableMapping, Optional, Union
+
+from . import serialization
+from .datastore import Address, AliasIndex, Changes, Datastore, TransactionAccumulator, identity_digest
+from .scheduling import SchedulerStore
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS content (
+    address TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS canonical_addresses (
+    key TEXT PRIMARY KEY,
+    address TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS promises (
+    address TEXT PRIMARY KEY,
+    promisees BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS aliases (
+    address TEXT PRIMARY KEY,
+    canonical TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS scheduled_contexts (
+    position INTEGER PRIMARY KEY,
+    context BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS root_answer_promises (
+    address TEXT PRIMARY KEY,
+    position INTEGER NOT NULL
+);
+"""
+
+
+def encode_address(address: Address) -> str:
+    return str(address.location)
+
+
+def decode_address(text: str) -> Address:
+    return Address(uuid.UUID(text))
+
+
+def content_key(content: Any) -> str:
+    """Return the key under which ``content`` is deduplicated.
+
+    Hypertext equality is structural, so the key is a digest of the
+    structure that equality compares.
+    """
+    return identity_digest(content).hex()
+
+
+class _Connected(object):
+    """Something with a connection to the SQLite database at ``path``.
+
+    A connection can't be used in a process forked from the one that opened
+    it (see Scheduler.processes), so each process opens its own. The parent's
+    connection is kept open in the child, since closing it there could
+    interfere with the parent.
+    """
+    path: str
+    _connections: Dict[int, sqlite3.Connection]
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = self._connections.get(os.getpid())
+        if conn is None:
+            # Concurrent transactions may commit from different threads;
+            # commits are serialized by the datastore's lock.
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self._connections[os.getpid()] = conn
+        return conn
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+class _Table(MutableMapping):
+    """A dict-like view of a two-column table.
+
+    Values are decoded from their rows on every access, so mutating a value
+    that was read from the table does not change the table.
+    """
+    def __init__(
+            self,
+            store: Any, # Anything with an SQLite connection, conn
+            table: str,
+            key_column: str,
+            value_column: str,
+            encode_key: Callable[[Any], Any],
+            decode_key: Callable[[Any], Any],
+            encode_value: Callable[[Any], Any],
+            decode_value: Callable[[Any], Any],
+            ) -> None:
+        self.store = store
+        self.encode_key = encode_key
+        self.decode_key = decode_key
+        self.encode_value = encode_value
+        self.decode_value = decode_value
+        self._select = "SELECT {} FROM {} WHERE {} = ?".format(value_column, table, key_column)
+        self._replace = "INSERT OR REPLACE INTO {} ({}, {}) VALUES (?, ?)".format(table, key_column, value_column)
+        self._delete = "DELETE FROM {} WHERE {} = ?".format(table, key_column)
+        self._keys = "SELECT {} FROM {}".format(key_column, table)
+        self._count = "SELECT COUNT(*) FROM {}".format(table)
+
+    def __getitem__(self, key: Any) -> Any:
+        row = self.store.conn.execute(self._select, (self.encode_key(key),)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return self.decode_value(row[0])
+
+    def __contains__(self, key: object) -> bool:
+        return self.store.conn.execute(self._select, (self.encode_key(key),)).fetchone() is not None
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        self.store.conn.execute(self._replace, (self.encode_key(key), self.encode_value(value)))
+
+    def __delitem__(self, key: Any) -> None:
+        if self.store.conn.execute(self._delete, (self.encode_key(key),)).rowcount == 0:
+            raise KeyError(key)
+
+    def __iter__(self) -> Iterator[Any]:
+        for (key,) in self.store.conn.execute(self._keys).fetchall():
+            yield self.decode_key(key)
+
+    def __len__(self) -> int:
+        return self.store.conn.execute(self._count).fetchone()[0]
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        self.store.conn.executemany(
+                self._replace,
+                [(self.encode_key(k), self.encode_value(v)) for k, v in dict(*args, **kwargs).items()])
+
+
+class _ContentTable(_Table):
+    """The content table, which keeps recently dereferenced rows decoded."""
+    CACHE_SIZE = 4096
+
+    def __init__(self, store: "SqliteDatastore") -> None:
+        super().__init__(store, "content", "address", "data",
+                         encode_address, decode_address, store.dumps, store.loads)
+        self._cache: "OrderedDict[Address, Any]" = OrderedDict()
+
+    def __getitem__(self, key: Address) -> Any:
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        value = super().__getitem__(key)
+        self._cache[key] = value
+        if len(self._cache) > self.CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return value
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._cache or super().__contains__(key)
+
+    def __delitem__(self, key: Address) -> None:
+        self._cache.pop(key, None)
+        super().__delitem__(key)
+
+
+class SqliteDatastore(Datastore, _Connected):
+    """A Datastore kept in an SQLite database.
+
+    Content is only loaded when it is dereferenced, and transactions are
+    committed as single SQL transactions, so a crash never leaves a partially
+    applied transaction behind.
+    """
+    def __init__(self, path: str, content_addressed: bool=False) -> None:
+        self.path = path
+        self.content_addressed = content_addressed
+        self._connections = {}
+        self.conn.executescript(SCHEMA)
+        self.content = _ContentTable(self)
+        self.canonical_addresses = _Table(
+                self, "canonical_addresses", "key", "address",
+                content_key, _unsupported_key, encode_address, decode_address)
+        self.promises = _Table(
+                self, "promises", "address", "promisees",
+                encode_address, decode_address, self.dumps, self.loads)
+        self.aliases = _Table(
+                self, "aliases", "address", "canonical",
+                encode_address, decode_address, encode_address, decode_address)
+        # Path compression is kept in memory rather than written on reads.
+        self.alias_index = AliasIndex(self.aliases, shortcuts={})
+        self._init_versions()
+
+    def __reduce__(self):
+        return (SqliteDatastore, (self.path, self.content_addressed))
+
+    def dumps(self, obj: Any) -> bytes:
+        return serialization.dumps(obj, self)
+
+    def loads(self, data: bytes) -> Any:
+        return serialization.loads(data, self)
+
+    @contextmanager
+    def atomic(self) -> Generator[None, None, None]:
+        """Run the enclosed statements as one SQL transaction."""
+        if self.conn.in_transaction:
+            yield
+            return
+        self.conn.execute("BEGIN")
+        try:
+            yield
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    @contextmanager
+    def committing(self) -> Generator[None, None, None]:
+        # State kept along with the store, such as a SqliteSchedulerStore,
+        # is saved in the same SQL transaction.
+        with super().committing(), self.atomic():
+            yield
+
+    def register_promisee(self, address: Address, promisee: Any) -> None:
+        self.promises[address] = self.promises[address] + [promisee]
+        self._index_promisees(address, [promisee])
+
+    def resolve_promise(self, address: Address, content: Any) -> List[Any]:
+        with self.atomic():
+            return super().resolve_promise(address, content)
+
+    def apply(self, transaction: Union[TransactionAccumulator, Changes]) -> None:
+        with self.atomic():
+            super().apply(transaction)
+
+    def collect_garbage(self, roots: Iterable[Any]) -> int:
+        with self.atomic():
+            reclaimed = super().collect_garbage(roots)
+        self.conn.execute("VACUUM")
+        return reclaimed
+
+
+def _unsupported_key(key: str) -> Any:
+    raise TypeError("canonical_addresses can't be iterated: it is keyed by "
+                    "digests, from which the content can't be recovered")
+
+
+class SqliteMemoStore(_Table, _Connected):
+    """A table of memoized actions in an SQLite database.
+
+    Pass one to Memoizer to keep its actions on disk. Actions don't refer to
+    any datastore, so a store can be shared between datastores and runs.
+
+    Given an SqliteDatastore instead of a path, the table is kept in its
+    database and written through its connection, so the actions a Scheduler
+    learns are saved in the same SQL transaction as the commit they go with.
+    """
+    def __init__(self, path: Union[str, SqliteDatastore]) -> None:
+        self.db: Optional[SqliteDatastore] = None
+        if isinstance(path, SqliteDatastore):
+            self.db = path
+            self.path = path.path
+            self._connections = path._connections # Shared with the datastore.
+        else:
+            self.path = path
+            self._connections = {}
+        self.conn.execute("CREATE TABLE IF NOT EXISTS memo (key BLOB PRIMARY KEY, action BLOB NOT NULL)")
+        super().__init__(self, "memo", "key", "action",
+                         bytes, bytes, pickle.dumps, pickle.loads)
+
+    def __reduce__(self):
+        return (SqliteMemoStore, (self.db if self.db is not None else self.path,))
+
+
+class SqliteSchedulerStore(SchedulerStore):
+    """The state of a Scheduler, kept in the database of ``db``.
+
+    Pass one to Scheduler to save each context as it is scheduled, in the
+    same SQL transaction as the commit it goes with.
+    """
+    def __init__(self, db: SqliteDatastore) -> None:
+        self.db = db
+        self.contexts = _Table(
+                db, "scheduled_contexts", "position", "context",
+                int, int, db.dumps, db.loads)
+        self.root_answer_promises = _Table(
+                db, "root_answer_promises", "address", "position",
+                encode_address, decode_address, int, int)
+
+    def __reduce__(self):
+        return (SqliteSchedulerStore, (self.db,))
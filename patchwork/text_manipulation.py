@@ -1,56 +1,77 @@
-from collections import defaultdict, deque
-from typing import Any, DefaultDict, Dict, List, Optional, Set, Union
+import re
+import threading
+
+from collections import OrderedDict, defaultdict, deque
+from typing import AbstractSet, Any, DefaultDict, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple, Union
 
 import parsy
 
 from .datastore import Address, Datastore
 from .hypertext import RawHypertext, visit_unlocked_region
 
-link = parsy.regex(r"\$([awq]?[1-9][0-9]*)")
-otherstuff = parsy.regex(r"[^\[\$\]]+")
+# Hypertext is written as text with $-pointers, and with brackets around
+# nested hypertext: "Is [$1 or $2] bigger than $3?"
+LINK_PATTERN = r"\$([awq]?[1-9][0-9]*)"
+TEXT_PATTERN = r"[^\[\$\]]+"
+_TOKEN = re.compile(r"(?P<link>{})|(?P<text>{})|(?P<open>\[)|(?P<close>\])"
+                    .format(LINK_PATTERN, TEXT_PATTERN))
 
-lbrack = parsy.string("[")
-rbrack = parsy.string("]")
+# What a parse error says was expected, at the top level and inside brackets.
+_EXPECTED_TOP = frozenset(["EOF", "[", TEXT_PATTERN, LINK_PATTERN])
+_EXPECTED_NESTED = frozenset(["]", "[", TEXT_PATTERN, LINK_PATTERN])
 
-@parsy.generate
-def subnode():
-    yield lbrack
-    result = yield hypertext
-    yield rbrack
-    return result
+# Token kinds
+LINK, TEXT, OPEN, CLOSE = "link", "text", "open", "close"
+Token = Tuple[str, str, int] # kind, text, position
 
-hypertext = (link | subnode | otherstuff).many()
 
-# MyPy can't deal with this yet
-# ParsePiece = Union[str, "ParsePiece"]
-ParsePiece = Any
+def tokenize(content: str) -> List[Token]:
+    """Split hypertext source into tokens.
 
-def recursively_create_hypertext(
-        pieces: List[ParsePiece],
-        db: Datastore,
-        pointer_link_map: Dict[str, Address]
-        ) -> RawHypertext:
-    result: List[Union[Address, str]] = []
-    for piece in pieces:
-        if isinstance(piece, list):
-            result.append(recursively_insert_hypertext(piece, db, pointer_link_map))
-        else:
-            try:
-                # This is a link that should be in the map
-                result.append(pointer_link_map[link.parse(piece)])
-            except parsy.ParseError:
-                # This is just a regular string
-                result.append(piece)
-    return RawHypertext(result)
+    Raises parsy.ParseError if ``content`` is not well-formed.
+    """
+    tokens: List[Token] = []
+    depth = 0
+    position = 0
+    match = _TOKEN.match
+    while position < len(content):
+        m = match(content, position)
+        if m is None:
+            raise parsy.ParseError(_EXPECTED_NESTED if depth > 0 else _EXPECTED_TOP, content, position)
+        kind = m.lastgroup
+        assert kind is not None # Every alternative is a named group.
+        if kind == OPEN:
+            depth += 1
+        elif kind == CLOSE:
+            if depth == 0:
+                raise parsy.ParseError(_EXPECTED_TOP, content, position)
+            depth -= 1
+        tokens.append((kind, m.group(), position))
+        position = m.end()
+    if depth > 0:
+        raise parsy.ParseError(_EXPECTED_NESTED, content, position)
+    return tokens
 
 
-def recursively_insert_hypertext(
-        pieces: List[ParsePiece],
+def _build_hypertext(
+        content: str,
         db: Datastore,
-        pointer_link_map: Dict[str, Address]
-        ) -> Address:
-    result = db.insert(recursively_create_hypertext(pieces, db, pointer_link_map))
-    return result
+        pointer_link_map: Dict[str, Address],
+        ) -> RawHypertext:
+    # Bracketed hypertext is inserted when its closing bracket is reached.
+    # Tokenizing first means that nothing is inserted if there is an error.
+    levels: List[List[Union[Address, str]]] = [[]]
+    for kind, text, _ in tokenize(content):
+        if kind == TEXT:
+            levels[-1].append(text)
+        elif kind == LINK:
+            levels[-1].append(pointer_link_map[text])
+        elif kind == OPEN:
+            levels.append([])
+        else:
+            nested = RawHypertext(levels.pop())
+            levels[-1].append(db.insert(nested))
+    return RawHypertext(levels[0])
 
 
 def insert_raw_hypertext(
@@ -58,8 +79,7 @@ def insert_raw_hypertext(
         db: Datastore,
         pointer_link_map: Dict[str, Address],
         ) -> Address:
-    parsed = hypertext.parse(content)
-    return recursively_insert_hypertext(parsed, db, pointer_link_map)
+    return db.insert(_build_hypertext(content, db, pointer_link_map))
 
 
 def create_raw_hypertext(
@@ -67,24 +87,131 @@ def create_raw_hypertext(
         db: Datastore,
         pointer_link_map: Dict[str, Address]
         ) -> RawHypertext:
-    parsed = hypertext.parse(content)
-    return recursively_create_hypertext(parsed, db, pointer_link_map)
+    return _build_hypertext(content, db, pointer_link_map)
+
+
+# Pointers other than $qN, $aN and $wN are numbered in the order in which
+# contexts visit them, so equivalent contexts may number them differently.
+_ANONYMOUS_POINTER = re.compile(r"\$[1-9][0-9]*")
+
+
+def canonicalize_pointer_names(text: str) -> Tuple[str, Dict[str, str]]:
+    """Renumber the anonymous pointers in ``text`` in order of appearance.
+
+    Returns the renumbered text and the map from old names to new ones.
+    """
+    names: Dict[str, str] = {}
+    def rename(match: Any) -> str:
+        name = match.group()
+        if name not in names:
+            names[name] = "${}".format(len(names) + 1)
+        return names[name]
+    return _ANONYMOUS_POINTER.sub(rename, text), names
+
+
+def rename_pointers(text: str, names: Dict[str, str]) -> str:
+    """Rename the anonymous pointers in ``text`` that are in ``names``."""
+    return _ANONYMOUS_POINTER.sub(lambda match: names.get(match.group(), match.group()), text)
+
+
+class FragmentCache(object):
+    """A bounded cache of rendered links, shared by all contexts and sessions.
+
+    Content never changes once it is written, so the text of a link only
+    depends on its address, the name it is shown under and the texts of the
+    links on its page. The least recently used texts are evicted first.
+    """
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._texts: "OrderedDict[Hashable, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[str]:
+        with self._lock:
+            text = self._texts.get(key)
+            if text is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._texts.move_to_end(key)
+            return text
+
+    def put(self, key: Hashable, text: str) -> None:
+        with self._lock:
+            self._texts[key] = text
+            if len(self._texts) > self.maxsize:
+                self._texts.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._texts.clear()
+            self.hits = self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._texts)}
+
+
+fragment_cache = FragmentCache(maxsize=65536)
+
+
+# The pointer name of an unlocked link, the texts of the links on its page and
+# the resulting text.
+Fragment = Tuple[str, Tuple[str, ...], str]
+
+
+def render_fragment(
+        link: Address,
+        page: Any,
+        pointer_name: str,
+        link_texts: Dict[Address, str],
+        previous: Optional[Fragment]=None,
+        ) -> Fragment:
+    """Render the unlocked ``link``, whose content is ``page``.
+
+    ``link_texts`` has the texts of the links on ``page``. The text of
+    ``previous`` is reused if it was rendered with the same name and texts.
+    """
+    child_texts = tuple(link_texts[child] for child in page.links())
+    if previous is not None and previous[0] == pointer_name and previous[1] == child_texts:
+        return previous
+    key = (link, pointer_name, child_texts)
+    text = fragment_cache.get(key)
+    if text is None:
+        text = "[{}: {}]".format(pointer_name, page.to_str(display_map=link_texts))
+        fragment_cache.put(key, text)
+    return pointer_name, child_texts, text
 
 
 def make_link_texts(
         root_link: Address,
         db: Datastore,
-        unlocked_locations: Optional[Set[Address]]=None,
+        unlocked_locations: Optional[AbstractSet[Address]]=None,
         pointer_names: Optional[Dict[Address, str]]=None,
+        previous_fragments: Optional[Dict[Address, Fragment]]=None,
+        fragments: Optional[Dict[Address, Fragment]]=None,
+        unlocked_region: Optional[Iterable[Address]]=None,
         ) -> Dict[Address, str]:
-    INLINE_FMT = "[{pointer_name}: {content}]"
+    """Render every link visible from ``root_link``.
+
+    When ``pointer_names`` are given, ``fragments`` (if given) is filled with
+    the fragments rendered for unlocked links. Passing those as
+    ``previous_fragments`` to a later call lets it reuse the text of every
+    link whose name and contents render the same as before.
+
+    ``unlocked_region`` saves a traversal if the caller already knows which
+    links visible from ``root_link`` are unlocked.
+    """
     ANONYMOUS_INLINE_FMT = "[{content}]"
     # We need to construct this string in topological order since pointers
     # are substrings of other unlocked pointers. Since everything is immutable
     # once created, we are guaranteed to have a DAG.
     include_counts: DefaultDict[Address, int] = defaultdict(int)
 
-    for link in visit_unlocked_region(root_link, root_link, db, unlocked_locations):
+    if unlocked_region is None:
+        unlocked_region = visit_unlocked_region(root_link, root_link, db, unlocked_locations)
+    for link in unlocked_region:
         page = db.dereference(link)
         for visible_link in page.links():
             include_counts[visible_link] += 1
@@ -112,15 +239,48 @@ def make_link_texts(
             if unlocked_locations is not None and link not in unlocked_locations:
                 link_texts[link] = pointer_names[link]
             else:
-                page = db.dereference(link)
-                link_texts[link] = INLINE_FMT.format(
-                        pointer_name=pointer_names[link],
-                        content=page.to_str(display_map=link_texts))
+                previous = previous_fragments.get(link) if previous_fragments else None
+                fragment = render_fragment(link, db.dereference(link), pointer_names[link],
+                                           link_texts, previous)
+                link_texts[link] = fragment[2]
+                if fragments is not None:
+                    fragments[link] = fragment
     else:
         for link in reversed(order):
             page = db.dereference(link)
-            link_texts[link] = ANONYMOUS_INLINE_FMT.format(
-                    content=page.to_str(display_map=link_texts))
+            # With everything unlocked, the text only depends on the address.
+            if unlocked_locations is None:
+                key: Hashable = (link,)
+            else:
+                key = (link, tuple(link_texts[child] for child in page.links()))
+            text = fragment_cache.get(key)
+            if text is None:
+                text = ANONYMOUS_INLINE_FMT.format(
+                        content=page.to_str(display_map=link_texts))
+                fragment_cache.put(key, text)
+            link_texts[link] = text
 
 
     return link_texts
+
+
+def iter_link_text(link: Address, db: Datastore) -> Iterator[str]:
+    """Yield the text of ``link`` with all pointers unlocked, in pieces.
+
+    The pieces make up ``make_link_texts(link, db)[link]``, but the text is
+    never held in memory as a whole, and arbitrarily deep nesting is fine.
+    """
+    stack: List[Iterator[Union[str, Address]]] = [iter([link])]
+    while len(stack) > 0:
+        item = next(stack[-1], None)
+        if item is None:
+            stack.pop()
+        elif isinstance(item, str):
+            yield item
+        else:
+            page = db.dereference(item)
+            if isinstance(page, RawHypertext):
+                stack.append(iter(("[",) + page.chunks + ("]",)))
+            else:
+                # Other pages (workspaces) indent what they contain.
+                yield make_link_texts(item, db)[item]
@@ -0,0 +1,254 @@
+import logging
+import os
+import pickle
+import struct
+import threading
+import zlib
+
+from typing import IO, Any, Dict, Iterator, List, MutableMapping, Optional, Tuple
+
+import attr
+
+from . import serialization
+from .context import Context
+from .datastore import Address, Changes, Datastore, TransactionAccumulator
+from .scheduling import Scheduler, SchedulerStore
+
+logger = logging.getLogger(__name__)
+
+# Each record is a HEADER (payload length and CRC-32) followed by the
+# payload, a pickled LogRecord. A torn or corrupt record ends the log.
+HEADER = struct.Struct(">II")
+
+# A checkpoint starts with CHECKPOINT_MAGIC and the FORMAT_VERSION it was
+# written in. Bump the version whenever a change to the pickled classes
+# means that older checkpoints can't be loaded any more.
+CHECKPOINT_MAGIC = b"patchwork checkpoint\n"
+CHECKPOINT_HEADER = struct.Struct(">I")
+FORMAT_VERSION = 2
+
+
+@attr.s
+class SchedulerChanges(object):
+    """Changes to a JournalSchedulerStore: the new value of each key that
+    was set, or None for a key that was deleted."""
+    contexts = attr.ib(type=Dict[int, Optional[Context]], factory=dict)
+    root_answer_promises = attr.ib(type=Dict[Address, Optional[int]], factory=dict)
+
+
+@attr.s
+class LogRecord(object):
+    """What was committed inside one ``db.committing()`` block, and its number."""
+    sequence = attr.ib(type=int)
+    changes = attr.ib(type=List[Changes])
+    scheduler_changes = attr.ib(type=SchedulerChanges)
+
+
+class _LoggedDict(MutableMapping):
+    """A dict that keeps track of its changes until they are taken."""
+    def __init__(self) -> None:
+        self.data: Dict[Any, Any] = {}
+        self.changes: Dict[Any, Any] = {}
+
+    def __getitem__(self, key: Any) -> Any:
+        return self.data[key]
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        self.data[key] = value
+        self.changes[key] = value
+
+    def __delitem__(self, key: Any) -> None:
+        del self.data[key]
+        self.changes[key] = None
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self.data)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def take_changes(self) -> Dict[Any, Any]:
+        changes, self.changes = self.changes, {}
+        return changes
+
+    def apply(self, changes: Dict[Any, Any]) -> None:
+        for key, value in changes.items():
+            if value is None:
+                self.data.pop(key, None)
+            else:
+                self.data[key] = value
+
+
+class JournalSchedulerStore(SchedulerStore):
+    """The state of a Scheduler, kept in the checkpoint along with it, and
+    logged along with each commit in between."""
+    contexts: _LoggedDict
+    root_answer_promises: _LoggedDict
+
+    def __init__(self) -> None:
+        self.contexts = _LoggedDict()
+        self.root_answer_promises = _LoggedDict()
+
+    def take_changes(self) -> SchedulerChanges:
+        """Return the changes since they were last taken."""
+        return SchedulerChanges(self.contexts.take_changes(), self.root_answer_promises.take_changes())
+
+    def apply(self, changes: SchedulerChanges) -> None:
+        self.contexts.apply(changes.contexts)
+        self.root_answer_promises.apply(changes.root_answer_promises)
+
+
+class WriteAheadLog(object):
+    def __init__(
+            self,
+            path: str,
+            db: Datastore,
+            sync: bool=True,
+            store: Optional[JournalSchedulerStore]=None,
+            ) -> None:
+        self.path = path
+        self.db = db
+        self.sync = sync
+        self.store = store
+        self.file = open(path, "ab")
+        self._changes: List[Changes] = []
+
+    def append(self, transaction: TransactionAccumulator) -> None:
+        """Add the changes made by ``transaction`` to the next record."""
+        self._changes.append(transaction.changes())
+
+    def flush(self) -> None:
+        """Durably append a record of the changes to the datastore and to
+        ``store`` since the last one, if there are any."""
+        scheduler_changes = self.store.take_changes() if self.store is not None else SchedulerChanges()
+        if len(self._changes) == 0 and len(scheduler_changes.contexts) == 0 \
+                and len(scheduler_changes.root_answer_promises) == 0:
+            return
+        self.db.log_sequence += 1
+        record = LogRecord(self.db.log_sequence, self._changes, scheduler_changes)
+        self._changes = []
+        payload = serialization.dumps(record, self.db)
+        self.file.write(HEADER.pack(len(payload), zlib.crc32(payload)))
+        self.file.write(payload)
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+
+    def records(self) -> Iterator[LogRecord]:
+        with open(self.path, "rb") as f:
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return
+                length, checksum = HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != checksum:
+                    return
+                yield serialization.loads(payload, self.db)
+
+    def truncate(self) -> None:
+        self.file.truncate(0)
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class Journal(object):
+    """Keeps a datastore and its scheduler durable between checkpoints.
+
+    A checkpoint is a header followed by a pickle of ``(db, sched)`` at
+    ``path``. The pickles that ``patchwork.main`` wrote before there was a
+    header use classes that have changed since, so opening one raises a
+    ValueError instead of loading it. What is committed after the
+    checkpoint, along with the changes to the scheduler's pending contexts
+    and root questions that go with it, is appended to a write-ahead log next
+    to it, and replayed onto the checkpoint when it is opened again. Contexts
+    that were active are pending again, as after any restart.
+    """
+    def __init__(self, path: str, sync: bool=True) -> None:
+        self.path = path
+        self.log_path = "{}.wal".format(path)
+        self.sync = sync
+        self.db: Optional[Datastore] = None
+        self.sched: Optional[Scheduler] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def open(self) -> Tuple[Datastore, Scheduler]:
+        try:
+            with open(self.path, "rb") as f:
+                db, sched = _load_checkpoint(self.path, f)
+        except FileNotFoundError:
+            db = Datastore()
+            sched = Scheduler(db, store=JournalSchedulerStore())
+        store = sched.store
+        assert isinstance(store, JournalSchedulerStore)
+
+        wal = WriteAheadLog(self.log_path, db, self.sync, store)
+        for record in wal.records():
+            if record.sequence <= db.log_sequence:
+                continue # Already in the checkpoint.
+            for changes in record.changes:
+                db.apply(changes)
+                sched.memoizer.update(changes.memo_entries)
+            store.apply(record.scheduler_changes)
+            db.log_sequence = record.sequence
+        sched.restore()
+        db.wal = wal
+        self.db, self.sched = db, sched
+        return db, sched
+
+    def checkpoint(self) -> None:
+        """Write a new checkpoint and empty the log.
+
+        The scheduler changes its state inside ``db.committing()``, so holding
+        the datastore's lock keeps both as they were at a commit.
+        """
+        assert self.db is not None and self.db.wal is not None, "Journal is not open"
+        tmp_path = "{}.tmp".format(self.path)
+        with self.db.lock:
+            with open(tmp_path, "wb") as f:
+                f.write(CHECKPOINT_MAGIC + CHECKPOINT_HEADER.pack(FORMAT_VERSION))
+                pickle.dump((self.db, self.sched), f)
+                f.flush()
+                if self.sync:
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self.db.wal.truncate()
+
+    def start(self, interval: float) -> None:
+        """Write checkpoints every ``interval`` seconds in the background."""
+        def run() -> None:
+            while not self._stop.wait(interval):
+                try:
+                    self.checkpoint()
+                except Exception:
+                    # The log is only emptied after a checkpoint was written,
+                    # so nothing is lost, and the next one may succeed.
+                    logger.exception("Writing a checkpoint failed")
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        """Stop background checkpoints and write a final one."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.checkpoint()
+        assert self.db is not None and self.db.wal is not None
+        self.db.wal.close()
+        self.db.wal = None
+
+
+def _load_checkpoint(path: str, f: IO[bytes]) -> Tuple[Datastore, Scheduler]:
+    if f.read(len(CHECKPOINT_MAGIC)) != CHECKPOINT_MAGIC:
+        raise ValueError("'{}' was written by an older version of patchwork "
+                         "and can't be opened".format(path))
+    version, = CHECKPOINT_HEADER.unpack(f.read(CHECKPOINT_HEADER.size))
+    if version != FORMAT_VERSION:
+        raise ValueError("'{}' is in checkpoint format {}, but this version of "
+                         "patchwork reads format {}".format(path, version, FORMAT_VERSION))
+    return pickle.load(f)
@@ -1,8 +1,12 @@
+import io
+import sys
 import unittest
 
-from patchwork.actions import AskSubquestion, Reply, Unlock
+from patchwork.actions import AskSubquestion, Reply, Scratch, Unlock
 from patchwork.datastore import Datastore
+from patchwork.hypertext import RawHypertext
 from patchwork.scheduling import RootQuestionSession, Scheduler
+from patchwork.text_manipulation import iter_link_text, make_link_texts
 
 
 class TestBasic(unittest.TestCase):
@@ -123,3 +127,65 @@ class TestBasic(unittest.TestCase):
             self.assertEqual("[[NO! It's Bicycle Repair Man.]"
                              " [NO! It's Bicycle Repair Man.]]",
                              sess.root_answer)
+
+
+    def testSameSubquestionTwice(self):
+        """Test that asking the same subquestion twice reuses its answer."""
+        db = Datastore()
+        sched = Scheduler(db)
+
+        with RootQuestionSession(sched, "Root?") as sess:
+            sess.act(AskSubquestion("Sub?"))
+            context = sess.act(AskSubquestion("Sub?"))
+            self.assertEqual(2, str(context).count("$a1"))
+            self.assertNotIn("$a2", str(context))
+            sess.act(Reply("$a1 $a2"))
+            self.assertEqual("[[Done.] [Done.]]", sess.act(Reply("Done.")))
+
+    def testAutomationCycle(self):
+        """Test that budgets stop automation cycles.
+
+        The second subquestion goes through the same scratchpads as the first,
+        but automatically, back and forth until the budget of the root question
+        is used up.
+        The context it ends in is left for a human.
+        """
+        db = Datastore()
+        sched = Scheduler(db, budget=40)
+
+        with RootQuestionSession(sched, "Root?") as sess:
+            sess.act(AskSubquestion("Sub?"))
+            sess.act(AskSubquestion("Sub?"))
+            sess.act(Unlock("$a1"))
+            sess.act(Scratch("a"))
+            sess.act(Scratch("b"))
+            sess.act(Scratch("a"))
+            self.assertEqual(1, len(sched.pending_contexts))
+            self.assertIn("Scratchpad: [$2: b]", str(sched.pending_contexts[0]))
+            self.assertIn("Budget exhausted.", str(sched.pending_contexts[0]))
+
+
+    def testDeepRootAnswer(self):
+        """Test a root answer nested deeper than the recursion limit."""
+        db = Datastore()
+        sched = Scheduler(db)
+
+        with RootQuestionSession(sched, "Root?") as sess:
+            sess.act(AskSubquestion("Sub?"))
+            answer = db.insert(RawHypertext(["leaf"]))
+            for _ in range(sys.getrecursionlimit() + 100):
+                answer = db.insert(RawHypertext(["x", answer]))
+            self.assertIsNone(sess.choose_promise(answer))
+            sub_answer = db.dereference(sess.current_context.workspace_link).subquestions[0][1]
+            self.assertEqual(sub_answer, sess.choose_promise(db.insert(RawHypertext([answer, sub_answer]))))
+
+            out = io.StringIO()
+            text = "".join(iter_link_text(answer, db))
+            self.assertTrue(text.startswith("[x[x[x"))
+            self.assertIn("[x[leaf]]]", text)
+            self.assertEqual(make_link_texts(answer, db)[answer], text)
+
+            sess.act(Reply("$a1"))
+            sess.act(Reply("Sub answer"))
+            sess.write_root_answer(out)
+            self.assertEqual(sess.root_answer, out.getvalue())
@@ -0,0 +1,133 @@
+import gc
+import pickle
+import unittest
+import weakref
+
+from patchwork.actions import AskSubquestion
+from patchwork.context import Context, DryContext
+from patchwork.datastore import Datastore, TransactionAccumulator
+from patchwork.hypertext import RawHypertext, Workspace
+from patchwork.scheduling import Scheduler
+from patchwork.text_manipulation import FragmentCache, fragment_cache
+
+
+class TestContext(unittest.TestCase):
+    def testLazyRendering(self):
+        db = Datastore()
+        sched = Scheduler(db)
+        root, _ = sched.ask_root_question("Root?")
+
+        transaction = TransactionAccumulator(db)
+        context = Context(root.workspace_link, transaction)
+        self.assertIsNone(context._display)
+        self.assertEqual(root, context)
+        self.assertEqual(hash(root), hash(context))
+        self.assertIsNone(context._display)
+
+        transaction.commit()
+        self.assertEqual(str(root), str(context))
+
+    def testPickleRenders(self):
+        db = Datastore()
+        sched = Scheduler(db)
+        root, _ = sched.ask_root_question("Root?")
+        context = pickle.loads(pickle.dumps(Context(root.workspace_link, TransactionAccumulator(db))))
+        self.assertEqual(str(root), str(context))
+
+    def testIncrementalRendering(self):
+        db = Datastore()
+        sched = Scheduler(db)
+        root, _ = sched.ask_root_question("Root [with a pointer]?")
+        str(root)
+        fragment_cache.clear()
+        child = Context(root.workspace_link, db, set(root.unlocked_locations) | {root.name_pointers["$3"]}, root)
+        str(child)
+
+        # The scratchpad is taken from the parent without consulting the cache.
+        workspace = db.dereference(root.workspace_link)
+        self.assertIs(root._fragments[workspace.scratchpad_link][2],
+                      child._fragments[workspace.scratchpad_link][2])
+        self.assertNotIn((workspace.scratchpad_link,) + root._fragments[workspace.scratchpad_link][:2],
+                         fragment_cache._texts)
+
+        fresh = Context(root.workspace_link, db, set(child.unlocked_locations))
+        self.assertEqual(str(fresh), str(child))
+
+    def testKeptPointerNames(self):
+        db = Datastore()
+        sched = Scheduler(db)
+        context, _ = sched.ask_root_question("Root [with a pointer]?")
+        context = sched.resolve_action(context, AskSubquestion("First [sub]?"))
+        str(context)
+        successor = sched.resolve_action(context, AskSubquestion("Second?"))
+
+        # The successor is named from its parent, and only the new
+        # subquestion is rendered again.
+        for link, name in context.pointer_names.items():
+            if link in successor.pointer_names:
+                self.assertEqual(name, successor.pointer_names[link])
+        self.assertIsNotNone(successor._changed)
+        str(successor)
+        self.assertIs(context._subquestion_texts[0], successor._subquestion_texts[0])
+
+        fresh = Context(successor.workspace_link, db, successor.unlocked_locations)
+        self.assertEqual(fresh.unlocked_region, successor.unlocked_region)
+        self.assertEqual(str(fresh), str(successor))
+
+    def testSelfReferentialPage(self):
+        db = Datastore()
+        question_link = db.insert(RawHypertext(["Root?"]))
+        loop_link = db.make_promise()
+        db.resolve_promise(loop_link, RawHypertext(["Loop ", loop_link]))
+        workspace_link = db.insert(Workspace(question_link, db.make_promise(), db.make_promise(), loop_link, ()))
+        parent = Context(workspace_link, db, {workspace_link, question_link})
+        str(parent)
+        child = Context(workspace_link, db, {workspace_link, question_link, loop_link}, parent)
+        self.assertRaises(ValueError, str, child)
+
+    def testSharedFragmentCache(self):
+        db = Datastore()
+        sched = Scheduler(db)
+        root, _ = sched.ask_root_question("Root [with a pointer]?")
+        fragment_cache.clear()
+
+        first = Context(root.workspace_link, db, set(root.unlocked_locations))
+        str(first)
+        self.assertEqual(0, fragment_cache.hits)
+        second = Context(root.workspace_link, db, set(root.unlocked_locations))
+        self.assertEqual(str(first), str(second))
+        self.assertEqual(fragment_cache.misses, fragment_cache.hits)
+
+        small_cache = FragmentCache(maxsize=1)
+        small_cache.put("a", "A")
+        small_cache.put("b", "B")
+        self.assertIsNone(small_cache.get("a"))
+        self.assertEqual("B", small_cache.get("b"))
+
+    def testNamingIndex(self):
+        db = Datastore()
+        sched = Scheduler(db)
+        root, _ = sched.ask_root_question("Root [with a pointer]?")
+        self.assertIs(root.name_pointers, root.name_pointers_for_workspace(root.workspace_link, db))
+        region = root.unlocked_locations_from_workspace(root.workspace_link, db)
+        self.assertEqual(root.unlocked_region, region)
+        self.assertIsNot(root.unlocked_region, region)
+        self.assertNotIn(root.name_pointers["$3"], region)
+
+    def testLineage(self):
+        db = Datastore()
+        sched = Scheduler(db)
+        root, _ = sched.ask_root_question("Root [with a pointer]?")
+        unlocked = root.unlocked_locations | {root.name_pointers["$3"]}
+        child = Context(root.workspace_link, db, set(unlocked), root)
+        dry_child = Context.from_dry(DryContext(root.workspace_link, set(unlocked), root.budget), db)
+        self.assertEqual(child, dry_child)
+        self.assertEqual(child.budget, dry_child.budget)
+
+        parent = Context(root.workspace_link, db)
+        child = Context(root.workspace_link, db, set(unlocked), parent)
+        str(child)
+        parent_ref = weakref.ref(parent)
+        del parent
+        gc.collect()
+        self.assertIsNone(parent_ref())
@@ -0,0 +1,242 @@
+import pickle
+import unittest
+
+from patchwork.actions import AskSubquestion, Reply, Scratch, Unlock
+from patchwork.datastore import Address, AliasIndex, Datastore, \
+    TransactionAccumulator, TransactionConflict
+from patchwork.hypertext import RawHypertext
+from patchwork.scheduling import RootQuestionSession, Scheduler
+
+
+class TestContentAddressing(unittest.TestCase):
+    def testStableAddresses(self):
+        """Test that equal content gets the same address in any datastore."""
+        db1 = Datastore(content_addressed=True)
+        db2 = Datastore(content_addressed=True)
+        address = db1.insert(RawHypertext(["Hello"]))
+        self.assertEqual(address, db2.insert(RawHypertext(["Hello"])))
+        self.assertEqual(address, db1.insert(RawHypertext(["Hello"])))
+        self.assertNotEqual(address, db1.insert(RawHypertext(["Hello!"])))
+
+        outer1 = db1.insert(RawHypertext(["Say ", address]))
+        outer2 = db2.insert(RawHypertext(["Say ", address]))
+        self.assertEqual(outer1, outer2)
+
+    def testPromisesAreOpaque(self):
+        db = Datastore(content_addressed=True)
+        address = db.insert(RawHypertext(["Hello"]))
+        transaction = TransactionAccumulator(db)
+        promise = transaction.make_promise()
+        self.assertNotEqual(address, promise)
+        transaction.resolve_promise(promise, RawHypertext(["Hello"]))
+        transaction.commit()
+        self.assertEqual(address, db.canonicalize(promise))
+        self.assertEqual(RawHypertext(["Hello"]), db.dereference(promise))
+
+    def testSameSubquestion(self):
+        """Test that asking a subquestion twice reuses its answer, like
+        it does without content addressing."""
+        for content_addressed in [False, True]:
+            db = Datastore(content_addressed=content_addressed)
+            sched = Scheduler(db)
+            context, _ = sched.ask_root_question("Root?")
+            context = sched.resolve_action(context, AskSubquestion("Sub?"))
+            context = sched.resolve_action(context, AskSubquestion("Sub?"))
+            first, second = db.dereference(context.workspace_link).subquestions
+            self.assertEqual(first, second)
+
+    def testSession(self):
+        db = Datastore(content_addressed=True)
+        sched = Scheduler(db)
+        with RootQuestionSession(sched, "Root?") as sess:
+            sess.act(AskSubquestion("Sub1?"))
+            sess.act(AskSubquestion("Sub2?"))
+            sess.act(Unlock("$a1"))
+            sess.act(Reply("Same"))
+            sess.act(Unlock("$a2"))
+            sess.act(Reply("Same"))
+            sess.act(Reply("$a1 $a2"))
+            self.assertEqual("[[Same] [Same]]", sess.root_answer)
+
+
+class TestStructuralEquality(unittest.TestCase):
+    def testEquality(self):
+        db = Datastore()
+        link = db.insert(RawHypertext(["Hello"]))
+        self.assertEqual(RawHypertext(["Say ", link]),
+                         RawHypertext(["S", "ay ", "", link]))
+        self.assertEqual(hash(RawHypertext(["Say ", link])),
+                         hash(RawHypertext(["Say ", link])))
+        self.assertNotEqual(RawHypertext(["Say ", link]),
+                            RawHypertext(["Say ", db.make_promise()]))
+
+    def testImmutable(self):
+        hypertext = RawHypertext(["Hello"])
+        with self.assertRaises(AttributeError):
+            hypertext.chunks = ("Goodbye",)
+
+    def testPickle(self):
+        db = Datastore()
+        hypertext = RawHypertext(["Say ", db.make_promise()])
+        self.assertEqual(hypertext, pickle.loads(pickle.dumps(hypertext)))
+
+
+class TestGarbageCollection(unittest.TestCase):
+    def testCollectGarbage(self):
+        db = Datastore()
+        sched = Scheduler(db)
+        with RootQuestionSession(sched, "Root?") as sess:
+            sess.act(Scratch("Scratch that."))
+            sess.act(AskSubquestion("Sub1?"))
+            sess.act(Unlock("$a1"))
+            sess.act(Reply("Answer"))
+            sess.act(Reply("$a1"))
+
+        scratch = db.insert(RawHypertext(["Scratch that."]))
+        self.assertGreater(sched.collect_garbage(), 0)
+        with self.assertRaises(KeyError):
+            db.dereference(scratch)
+
+        with RootQuestionSession(sched, "Root?") as sess:
+            self.assertEqual("[[Answer]]", sess.root_answer)
+        sched.collect_garbage()
+        self.assertEqual(0, sched.collect_garbage())
+
+    def testDropPromiseIndexes(self):
+        db = Datastore()
+        sched = Scheduler(db)
+        context, answer_promise = sched.ask_root_question("Root?")
+        orphan = db.make_promise()
+        db.advancing_promises(orphan)
+        db.register_promisee(orphan, context)
+        self.assertEqual({answer_promise, orphan}, db.advancing_promises(answer_promise))
+
+        sched.collect_garbage()
+        self.assertNotIn(orphan, db.promises)
+        self.assertNotIn(orphan, db._promise_versions)
+        self.assertNotIn(orphan, db._advancing)
+        self.assertFalse(any(orphan in prerequisites for prerequisites in db._prerequisites.values()))
+        self.assertEqual({answer_promise}, db.advancing_promises(answer_promise))
+
+
+class TestAliasIndex(unittest.TestCase):
+    def testPathCompression(self):
+        a, b, c, d = Address(), Address(), Address(), Address()
+        base = AliasIndex()
+        base.union(a, b)
+        base.parents[b] = c  # b was itself aliased after a was.
+        overlay = AliasIndex({}, base)
+        overlay.union(c, d)
+
+        self.assertEqual(d, overlay.find(a))
+        self.assertEqual({a: d, b: d, c: d}, overlay.parents)
+        self.assertEqual({a: b, b: c}, base.parents)
+        self.assertEqual(c, base.find(a))
+        self.assertEqual({a: c, b: c}, base.parents)
+
+
+    def testReadsDontAddAliases(self):
+        db = Datastore()
+        a, b, c = Address(), Address(), Address()
+        db.content[c] = RawHypertext(["Hello"])
+        db.aliases.update({a: b, b: c})
+        transaction = TransactionAccumulator(db)
+        self.assertEqual(c, transaction.canonicalize(a))
+        self.assertEqual({}, transaction.new_aliases)
+        transaction.commit()
+        self.assertEqual({a: b, b: c}, db.aliases)
+
+
+class TestSavepoints(unittest.TestCase):
+    def testRollbackAndCommit(self):
+        db = Datastore()
+        promise = db.make_promise()
+        transaction = TransactionAccumulator(db)
+        inner_promise = transaction.make_promise()
+        transaction.register_promisee(promise, "outer")
+
+        savepoint = transaction.savepoint()
+        savepoint.register_promisee(inner_promise, "inner")
+        self.assertEqual(["outer"], savepoint.resolve_promise(promise, RawHypertext(["Done"])))
+        self.assertTrue(savepoint.is_fulfilled(promise))
+        savepoint.rollback()
+        self.assertFalse(transaction.is_fulfilled(promise))
+        self.assertEqual([], transaction.get_promisees(inner_promise))
+
+        savepoint = transaction.savepoint()
+        savepoint.register_promisee(inner_promise, "inner")
+        address = savepoint.insert(RawHypertext(["Inner"]))
+        savepoint.resolve_promise(promise, RawHypertext(["Done"]))
+        savepoint.commit()
+        self.assertEqual(["inner"], transaction.get_promisees(inner_promise))
+
+        transaction.commit()
+        self.assertEqual(["inner"], db.get_promisees(inner_promise))
+        self.assertEqual(RawHypertext(["Done"]), db.dereference(promise))
+        self.assertEqual(RawHypertext(["Inner"]), db.dereference(address))
+
+    def testApplyChanges(self):
+        """Test that changes made alongside each other are merged."""
+        db = Datastore()
+        transaction = TransactionAccumulator(db)
+        first, second = transaction.savepoint(), transaction.savepoint()
+        first_address = first.insert(RawHypertext(["Same"]))
+        second_address = second.insert(RawHypertext(["Same"]))
+        promise = second.make_promise()
+        transaction.apply(first.changes())
+        transaction.apply(pickle.loads(pickle.dumps(second.changes())))
+        self.assertEqual(first_address, transaction.canonicalize(second_address))
+        self.assertEqual(first_address, transaction.insert(RawHypertext(["Same"])))
+        self.assertFalse(transaction.is_fulfilled(promise))
+
+
+class TestSnapshotIsolation(unittest.TestCase):
+    def testConflict(self):
+        db = Datastore()
+        promise = db.make_promise()
+        first = TransactionAccumulator(db)
+        second = TransactionAccumulator(db)
+
+        second.resolve_promise(promise, RawHypertext(["Second"]))
+        second.commit()
+        self.assertTrue(db.is_fulfilled(promise))
+
+        # The first transaction still sees the promise as it was.
+        self.assertFalse(first.is_fulfilled(promise))
+        first.register_promisee(promise, "waiting")
+        with self.assertRaises(TransactionConflict):
+            first.commit()
+        self.assertEqual(RawHypertext(["Second"]), db.dereference(promise))
+
+    def testConcurrentInserts(self):
+        db = Datastore()
+        first = TransactionAccumulator(db)
+        second = TransactionAccumulator(db)
+        first_address = first.insert(RawHypertext(["Same"]))
+        second_address = second.insert(RawHypertext(["Same"]))
+        first.commit()
+        second.commit()
+        self.assertEqual(first_address, db.canonicalize(second_address))
+        self.assertEqual(first_address, db.insert(RawHypertext(["Same"])))
+
+
+class TestPromiseIndex(unittest.TestCase):
+    def testAdvancingPromises(self):
+        db = Datastore()
+        sched = Scheduler(db)
+        with RootQuestionSession(sched, "Root?") as sess:
+            root_answer = sess.root_answer_promise
+            sess.act(AskSubquestion("Sub?"))
+            sess.act(Unlock("$a1"))
+            sub_context = sess.current_context
+            sub_answer = db.dereference(sub_context.workspace_link).answer_promise
+
+            # The root context waits on the subquestion's answer.
+            self.assertEqual({root_answer, sub_answer}, db.advancing_promises(root_answer))
+            self.assertEqual({sub_answer}, db.advancing_promises(sub_answer))
+            self.assertTrue(sub_context.can_advance_promise(db, root_answer))
+            self.assertEqual(db.advancing_promises(root_answer),
+                             TransactionAccumulator(db).advancing_promises(root_answer))
+
+            sess.act(Reply("Sub answer"))
+            self.assertEqual({root_answer}, db.advancing_promises(root_answer))
@@ -0,0 +1,64 @@
+import copy
+import unittest
+
+from patchwork import instrumentation
+from patchwork.actions import AskSubquestion, Reply
+from patchwork.datastore import Datastore
+from patchwork.scheduling import Memoizer, RootQuestionSession, Scheduler
+from patchwork.text_manipulation import make_link_texts
+
+
+class TestInstrumentation(unittest.TestCase):
+    def tearDown(self):
+        instrumentation.disable()
+        instrumentation.reset()
+
+    def testStats(self):
+        original_dereference = Datastore.dereference
+        instrumentation.enable()
+        self.assertIsNot(original_dereference, Datastore.dereference)
+
+        db = Datastore()
+        sched = Scheduler(db)
+        with RootQuestionSession(sched, "Bicycle Repair Man, but how?") as sess:
+            sess.act(AskSubquestion("Is it a [stockbroker]?"))
+            sess.act(AskSubquestion("Is it a [quantity surveyor]?"))
+            sess.act(Reply("$a1 $a2"))
+            sess.act(Reply("NO! It's Bicycle Repair Man."))
+
+        stats = instrumentation.stats()
+        self.assertGreater(stats["datastore.dereference"]["calls"], 0)
+        self.assertGreater(stats["make_link_texts"]["calls"], 0)
+        self.assertGreater(stats["context.render"]["calls"], 0)
+        self.assertEqual(1, stats["scheduler.automated_actions"])
+        self.assertEqual(1, stats["scheduler.cascade_length"]["max"])
+        self.assertGreater(stats["datastore.insert.dedup_rate"], 0)
+        self.assertIn("memoizer.hit_rate", stats)
+
+        instrumentation.disable()
+        self.assertIs(original_dereference, Datastore.dereference)
+        from patchwork import context
+        self.assertIs(make_link_texts, context.make_link_texts)
+
+    def testWorkerProcesses(self):
+        """Test that work done in worker processes is counted."""
+        memoizer = Memoizer()
+        with RootQuestionSession(Scheduler(Datastore(), memoizer), "Root?") as sess:
+            sess.act(AskSubquestion("A?"))
+            sess.act(AskSubquestion("B?"))
+            sess.act(Reply("$a1 $a2"))
+            sess.act(Reply("a"))
+            sess.act(Reply("b"))
+
+        counts = []
+        for processes in [None, 2]:
+            instrumentation.enable()
+            sched = Scheduler(Datastore(), copy.deepcopy(memoizer), processes=processes)
+            with RootQuestionSession(sched, "Outer?") as sess:
+                sess.act(AskSubquestion("Root?"))
+            stats = instrumentation.stats()
+            counts.append((stats["scheduler.automated_actions"], stats["memoizer.hits"]))
+            instrumentation.disable()
+            instrumentation.reset()
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(5, counts[0][0])
@@ -0,0 +1,49 @@
+import os
+import tempfile
+import unittest
+
+from patchwork.actions import AskSubquestion, Reply, Unlock
+from patchwork.datastore import Datastore
+from patchwork.hypertext import RawHypertext
+from patchwork.mapped_datastore import MappedDatastore, write_image
+from patchwork.scheduling import RootQuestionSession, Scheduler
+
+
+class TestMappedDatastore(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".img")
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def testRoundTrip(self):
+        """Test that a session can be continued from an image."""
+        db = Datastore()
+        sched = Scheduler(db)
+        with RootQuestionSession(sched, "Root?") as sess:
+            sess.act(AskSubquestion("Sub1?"))
+            sess.act(Unlock("$a1"))
+            sess.act(Reply("Answer 1"))
+            sess.act(Reply("Root $a1."))
+        hello = db.insert(RawHypertext(["Hello"]))
+        write_image(db, self.path, {"scheduler": sched})
+
+        db = MappedDatastore(self.path)
+        self.assertEqual(0, len(db.content.decoded))
+        self.assertEqual(RawHypertext(["Hello"]), db.dereference(hello))
+        self.assertEqual(1, len(db.content.decoded))
+        self.assertEqual(hello, db.insert(RawHypertext(["Hello"])))
+        self.assertRaises(TypeError, list, db.canonical_addresses)
+
+        sched = db.load_object("scheduler")
+        self.assertIs(db, sched.db)
+        with RootQuestionSession(sched, "Root?") as sess:
+            self.assertEqual("[Root [Answer 1].]", sess.root_answer)
+
+        # An image can be rewritten from the datastore that mapped it.
+        write_image(db, self.path, {"scheduler": sched})
+        db.close()
+        db = MappedDatastore(self.path)
+        self.assertEqual(RawHypertext(["Hello"]), db.dereference(hello))
+        db.close()
@@ -0,0 +1,66 @@
+import pickle
+import random
+import unittest
+
+from patchwork.persistent import PersistentSet
+
+
+class Collider(object):
+    """An item whose hash collides with those of many other items."""
+    def __init__(self, value):
+        self.value = value
+
+    def __hash__(self):
+        return self.value % 3
+
+    def __eq__(self, other):
+        return isinstance(other, Collider) and self.value == other.value
+
+
+class TestPersistentSet(unittest.TestCase):
+    def testAgainstSet(self):
+        rng = random.Random(0)
+        expected = set()
+        actual = PersistentSet()
+        for _ in range(2000):
+            item = rng.choice([rng.randrange(200), Collider(rng.randrange(20))])
+            if rng.random() < 0.6:
+                expected.add(item)
+                actual = actual.add(item)
+            else:
+                expected.discard(item)
+                actual = actual.discard(item)
+            self.assertEqual(len(expected), len(actual))
+            self.assertEqual(expected, set(actual))
+        self.assertEqual(PersistentSet(expected), actual)
+        self.assertEqual(hash(frozenset(expected)), hash(actual))
+        self.assertEqual(frozenset(expected), actual)
+
+    def testPersistence(self):
+        s = PersistentSet([1, 2])
+        t = s.add(3)
+        self.assertEqual({1, 2}, set(s))
+        self.assertEqual({1, 2, 3}, set(t))
+        self.assertIs(s, s.add(1))
+        self.assertEqual(s, t.remove(3))
+        with self.assertRaises(KeyError):
+            s.remove(3)
+
+    def testPickle(self):
+        s = PersistentSet(range(100))
+        self.assertEqual(s, pickle.loads(pickle.dumps(s)))
+
+    def testDiff(self):
+        rng = random.Random(1)
+        items = [rng.choice([rng.randrange(500), Collider(rng.randrange(20))]) for _ in range(300)]
+        s = PersistentSet(items)
+        t = s
+        for item in items[:20]:
+            t = t.discard(item)
+        for item in range(500, 520):
+            t = t.add(item)
+        only_t, only_s = t.diff(s)
+        self.assertEqual(set(t) - set(s), set(only_t))
+        self.assertEqual(set(s) - set(t), set(only_s))
+        self.assertEqual(len(set(only_t)), len(only_t))
+        self.assertEqual(([], []), s.diff(PersistentSet(items)))
@@ -0,0 +1,258 @@
+import copy
+import unittest
+
+import parsy
+
+from patchwork.actions import Action, AskSubquestion, Reply, Scratch
+from patchwork.context import Context
+from patchwork.datastore import Datastore
+from patchwork.hypertext import RawHypertext
+from patchwork.scheduling import Automator, Memoizer, RootQuestionSession, Scheduler
+
+
+class TestMemoizer(unittest.TestCase):
+    def setUp(self):
+        db = Datastore()
+        sched = Scheduler(db)
+        self.contexts = [sched.ask_root_question("Question {}?".format(i))[0] for i in range(3)]
+
+    def testDigestKeys(self):
+        memoizer = Memoizer()
+        memoizer.remember(self.contexts[0], Reply("Answer"))
+        self.assertEqual(16, len(memoizer.key(self.contexts[0])))
+        self.assertTrue(memoizer.can_handle(self.contexts[0]))
+        self.assertFalse(memoizer.can_handle(self.contexts[1]))
+        memoizer.forget(self.contexts[0])
+        self.assertFalse(memoizer.can_handle(self.contexts[0]))
+
+    def testEviction(self):
+        for policy, kept in [("lru", 0), ("fifo", 1)]:
+            memoizer = Memoizer(maxsize=2, policy=policy)
+            memoizer.remember(self.contexts[0], Scratch("0"))
+            memoizer.remember(self.contexts[1], Scratch("1"))
+            memoizer.handle(self.contexts[0])
+            memoizer.remember(self.contexts[2], Scratch("2"))
+            self.assertTrue(memoizer.can_handle(self.contexts[kept]))
+            self.assertFalse(memoizer.can_handle(self.contexts[1 - kept]))
+
+    def testStore(self):
+        store = {}
+        memoizer = Memoizer(maxsize=1, store=store)
+        memoizer.remember(self.contexts[0], Scratch("0"))
+        memoizer.remember(self.contexts[1], Scratch("1"))
+        self.assertEqual(1, len(memoizer.cache))
+        self.assertEqual("0", memoizer.handle(self.contexts[0]).scratch_text)
+        self.assertTrue(Memoizer(store=store).can_handle(self.contexts[1]))
+
+    def testRenamedPointers(self):
+        class RenumberedContext(object):
+            """A context like contexts[0], but with $2 and $3 swapped."""
+            digest = self.contexts[0].digest
+            canonical_names = {"$1": "$1", "$3": "$2", "$2": "$3"}
+
+        memoizer = Memoizer()
+        memoizer.remember(self.contexts[0], Reply("$2 and $3 and $q1"))
+        self.assertEqual("$3 and $2 and $q1", memoizer.handle(RenumberedContext()).reply_text)
+        self.assertEqual("$2 and $3 and $q1", memoizer.handle(self.contexts[0]).reply_text)
+
+
+class TestAskRootQuestion(unittest.TestCase):
+    def testMalformedQuestion(self):
+        db = Datastore()
+        sched = Scheduler(db)
+        self.assertRaises(parsy.ParseError, sched.ask_root_question, "Bad [question")
+        self.assertEqual({}, dict(db._snapshots))
+
+
+class TestPendingWakeup(unittest.TestCase):
+    def setUp(self):
+        self.sched = Scheduler(Datastore())
+        self.asked, _ = self.sched.ask_root_question("Question?")
+        self.other, _ = self.sched.ask_root_question("Other question?")
+        # Asking the same question again would give the same context. This
+        # one looks the same, but has a link it doesn't show unlocked.
+        self.same = Context(self.asked.workspace_link, self.sched.db,
+                            self.asked.unlocked_locations.add(self.other.workspace_link))
+        self.sched.active_contexts.add(self.same)
+        self.sched.relinquish_context(self.same)
+        self.sched.relinquish_context(self.other)
+
+    def testNewMemoEntry(self):
+        examined = []
+        can_handle = self.sched.memoizer.can_handle
+        def recording_can_handle(context):
+            examined.append(context)
+            return can_handle(context)
+        self.sched.memoizer.can_handle = recording_can_handle
+
+        self.sched.resolve_action(self.asked, Scratch("Noted."))
+        self.assertIn(self.same, examined)
+        self.assertNotIn(self.other, examined)
+        # The automated context was replaced by its successor.
+        self.assertNotIn(self.same, self.sched.pending_contexts)
+        self.assertEqual(self.other, self.sched.pending_contexts[0])
+        self.assertIn("Noted.", str(self.sched.pending_contexts[1]))
+        self.assertNotIn(self.sched.memoizer.key(self.same), self.sched.pending_by_key)
+
+    def testAddAutomator(self):
+        class OtherAutomator(Automator):
+            def can_handle(self, context):
+                return "Other question?" in str(context)
+
+            def handle(self, context):
+                return Reply("Answer")
+
+        self.sched.add_automator(OtherAutomator())
+        self.assertEqual([self.same], list(self.sched.pending_contexts))
+        self.assertEqual([self.sched.memoizer.key(self.same)], list(self.sched.pending_by_key))
+
+
+class TestFailedSteps(unittest.TestCase):
+    def testFailedStepIsRolledBack(self):
+        class HalfDone(Action):
+            def execute(self, db, context):
+                db.insert(RawHypertext(["Half done"]))
+                raise ValueError("$9 is not visible in this context")
+
+        class TestAutomator(Automator):
+            def can_handle(self, context):
+                return "Broken?" in str(context) or "Fine?" in str(context)
+
+            def handle(self, context):
+                return HalfDone() if "Broken?" in str(context) else Reply("Fine.")
+
+        sched = Scheduler(Datastore())
+        root, _ = sched.ask_root_question("Root?")
+        successor = sched.resolve_action(root, AskSubquestion("Broken?"))
+        successor = sched.resolve_action(successor, AskSubquestion("Fine?"))
+        sched.add_automator(TestAutomator())
+
+        # The automation that worked was kept, and the context that failed
+        # is left for a user.
+        (_, broken_answer, _), (_, fine_answer, _) = \
+            sched.db.dereference(successor.workspace_link).subquestions
+        self.assertTrue(sched.db.is_fulfilled(fine_answer))
+        self.assertFalse(sched.db.is_fulfilled(broken_answer))
+        self.assertEqual(1, len(sched.pending_contexts))
+        self.assertIn("Broken?", str(sched.pending_contexts[0]))
+        self.assertNotIn(RawHypertext(["Half done"]), sched.db.canonical_addresses)
+
+
+class TestChooseContext(unittest.TestCase):
+    def testIndexedByPromise(self):
+        sched = Scheduler(Datastore())
+        root, answer_promise = sched.ask_root_question("Root?")
+        successor = sched.resolve_action(root, AskSubquestion("First?"))
+        successor = sched.resolve_action(successor, AskSubquestion("Second?"))
+        workspace = sched.db.dereference(successor.workspace_link)
+        (_, first_answer, _), (_, second_answer, _) = workspace.subquestions
+        sched.active_contexts.add(successor)
+        sched.relinquish_context(successor)
+
+        def no_scan(context, db, promise):
+            raise AssertionError("choose_context scanned the pending contexts")
+        original = Context.can_advance_promise
+        Context.can_advance_promise = no_scan
+        try:
+            second = sched.choose_context(second_answer)
+            chosen = sched.choose_context(answer_promise)
+            first = sched.choose_context(first_answer)
+        finally:
+            Context.can_advance_promise = original
+        self.assertIn("Question: [$1: Second?]", str(second))
+        # Nothing waits on the subquestions' answers yet.
+        self.assertEqual(successor, chosen)
+        self.assertIn("Question: [$1: First?]", str(first))
+        self.assertEqual([], list(sched.pending_contexts))
+        self.assertEqual({}, sched.pending_by_promise)
+        self.assertRaises(StopIteration, sched.choose_context, answer_promise)
+
+
+class TestBudgets(unittest.TestCase):
+    def replay(self, depth, budget=1000):
+        """Let a user answer a chain of ``depth`` nested subquestions, then
+        ask the same question of a scheduler with ``budget``."""
+        memoizer = Memoizer()
+        with RootQuestionSession(Scheduler(Datastore(), memoizer), "Level 0?") as sess:
+            for level in range(depth):
+                sess.act(AskSubquestion("Level {}?".format(level + 1)))
+                sess.act(Reply("$a1"))
+            sess.act(Reply("Bottom."))
+
+        sched = Scheduler(Datastore(), memoizer, budget=budget)
+        return sched, RootQuestionSession(sched, "Level 0?")
+
+    def testDeepReplay(self):
+        sched, sess = self.replay(100)
+        self.assertEqual("[" * 101 + "Bottom." + "]" * 101, sess.root_answer)
+
+    def testExhaustion(self):
+        sched, sess = self.replay(12, 10)
+        self.assertIsNone(sess.root_answer)
+        # Asking each subquestion takes one action of the budget.
+        self.assertIn("[$q1: Level 10?]", str(sess.current_context))
+        self.assertIn("Budget exhausted.", str(sess.current_context))
+
+    def testRunawaySubquestion(self):
+        """Test that a subquestion that is automated forever only uses up its
+        share of the budget."""
+        memoizer = Memoizer()
+        with RootQuestionSession(Scheduler(Datastore(), memoizer), "Loop?") as sess:
+            sess.act(Scratch("a"))
+            sess.act(Scratch("b"))
+            sess.act(Scratch("a"))
+        with RootQuestionSession(Scheduler(Datastore(), memoizer), "Root?") as sess:
+            sess.act(AskSubquestion("Loop?"))
+            sess.act(AskSubquestion("Sub?"))
+            sess.act(Reply("$a2"))
+            self.assertEqual("[[Done.]]", sess.act(Reply("Done.")))
+
+        sched = Scheduler(Datastore(), memoizer, budget=100)
+        sess = RootQuestionSession(sched, "Root?")
+        self.assertEqual("[[Done.]]", sess.root_answer)
+        self.assertEqual(1, len(sched.pending_contexts))
+        self.assertIn("Loop?", str(sched.pending_contexts[0]))
+        self.assertIn("Budget exhausted.", str(sched.pending_contexts[0]))
+
+    def testFreshBudgetPerAction(self):
+        sched = Scheduler(Datastore(), budget=2)
+        root, _ = sched.ask_root_question("Root?")
+        for i in range(12):
+            root = sched.resolve_action(root, AskSubquestion("Sub {}?".format(i)))
+        # Later subquestions get as much as the first.
+        self.assertEqual([2] * 12, [c.budget for c in sched.pending_contexts])
+
+    def testAnsweredRootIsNotReplayed(self):
+        sched, sess = self.replay(3, 100)
+        self.assertEqual("[[[[Bottom.]]]]", sess.root_answer)
+        examined = []
+        sched.memoizer.can_handle = examined.append
+        context, answer = sched.ask_root_question("Level 0?")
+        self.assertIsNone(context)
+        self.assertEqual(sess.root_answer_promise, answer)
+        self.assertEqual([], examined)
+        self.assertEqual(set(), sched.active_contexts)
+
+
+class TestParallelAutomation(unittest.TestCase):
+    def setUp(self):
+        self.memoizer = Memoizer()
+        with RootQuestionSession(Scheduler(Datastore(), self.memoizer), "Root?") as sess:
+            sess.act(AskSubquestion("A?"))
+            sess.act(AskSubquestion("B?"))
+            sess.act(AskSubquestion("A?"))
+            sess.act(Reply("$a1 $a2 $a3"))
+            sess.act(Reply("a"))
+            sess.act(Reply("b"))
+
+    def replay(self, processes):
+        sched = Scheduler(Datastore(), copy.deepcopy(self.memoizer), processes=processes)
+        with RootQuestionSession(sched, "Outer?") as sess:
+            sess.act(AskSubquestion("Root?"))
+            self.assertEqual(0, len(sched.pending_contexts))
+            return sess.act(Reply("$a1"))
+
+    def testSameOutcome(self):
+        answer = self.replay(2)
+        self.assertEqual("[[[a] [b] [a]]]", answer)
+        self.assertEqual(self.replay(None), answer)
@@ -0,0 +1,112 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+from patchwork.actions import AskSubquestion, Reply, Unlock
+from patchwork.datastore import Datastore
+from patchwork.hypertext import RawHypertext
+from patchwork.scheduling import Memoizer, RootQuestionSession, Scheduler
+from patchwork.sqlite_datastore import SqliteDatastore, SqliteMemoStore, SqliteSchedulerStore
+
+
+class TestSqliteDatastore(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def testDeduplication(self):
+        db = SqliteDatastore(self.path)
+        address = db.insert(RawHypertext(["Hello"]))
+        self.assertEqual(address, db.insert(RawHypertext(["Hello"])))
+        self.assertEqual(address, db.canonical_addresses[RawHypertext(["Hello"])])
+        self.assertRaises(TypeError, list, db.canonical_addresses)
+
+        promise = db.make_promise()
+        db.resolve_promise(promise, RawHypertext(["Hello"]))
+        self.assertEqual(address, db.canonicalize(promise))
+        self.assertTrue(db.is_fulfilled(promise))
+
+    def testReadsDontWrite(self):
+        db = SqliteDatastore(self.path)
+        a, b, c = db.make_promise(), db.make_promise(), db.insert(RawHypertext(["Hello"]))
+        with db.atomic():
+            db.aliases.update({a: b, b: c})
+        changes = db.conn.total_changes
+        self.assertEqual(c, db.canonicalize(a))
+        self.assertEqual(changes, db.conn.total_changes)
+
+    def open(self):
+        db = SqliteDatastore(self.path)
+        return Scheduler(db, Memoizer(store=SqliteMemoStore(db)),
+                         store=SqliteSchedulerStore(db))
+
+    def testPersistence(self):
+        """Test that a session can be continued from a reopened database."""
+        sched = self.open()
+        with RootQuestionSession(sched, "Root?") as sess:
+            sess.act(AskSubquestion("Sub1?"))
+            sess.act(Unlock("$a1"))
+            sess.act(Reply("Answer 1"))
+            sess.act(Reply("Root $a1."))
+            self.assertEqual("[Root [Answer 1].]", sess.root_answer)
+        sched.db.close()
+
+        sched = self.open()
+        self.assertEqual(1, len(sched.root_answer_promises))
+        with RootQuestionSession(sched, "Root?") as sess:
+            self.assertEqual("[Root [Answer 1].]", sess.root_answer)
+
+    def testCrash(self):
+        """Test that the scheduler survives a crash."""
+        sched = self.open()
+        sess = RootQuestionSession(sched, "Root?")
+        root = sess.current_context
+        sess.act(AskSubquestion("Sub1?"))
+        sched.db.close() # Crash without relinquishing the active context.
+
+        sched = self.open()
+        self.assertEqual(2, len(sched.pending_contexts))
+        self.assertIn("Subquestions:\n1.\n  [$q1: Sub1?]", str(sched.pending_contexts[0]))
+        self.assertIn("Question: [$1: Sub1?]", str(sched.pending_contexts[1]))
+        self.assertTrue(sched.memoizer.can_handle(root))
+        promise = sched.root_answer_promises[0]
+        self.assertIn("[$q1: Sub1?]", str(sched.choose_context(promise)))
+
+
+    def testMemoizedWithCommit(self):
+        """Test that an action is only memoized along with what it led to."""
+        sched = self.open()
+        sess = RootQuestionSession(sched, "Root?")
+        root = sess.current_context
+        def crash(*args):
+            raise OSError("Disk full")
+        sched._update_pending = crash
+        self.assertRaises(OSError, sess.act, AskSubquestion("Sub1?"))
+        sched.db.close()
+
+        sched = self.open()
+        self.assertFalse(sched.memoizer.can_handle(root))
+        self.assertEqual(1, len(sched.pending_contexts))
+
+class TestSqliteMemoStore(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def testSharedBetweenRuns(self):
+        store = SqliteMemoStore(self.path)
+        with RootQuestionSession(Scheduler(Datastore(), Memoizer(store=store)), "Root?") as sess:
+            sess.act(Reply("Answer"))
+        store.close()
+
+        store = pickle.loads(pickle.dumps(SqliteMemoStore(self.path)))
+        with RootQuestionSession(Scheduler(Datastore(), Memoizer(store=store)), "Root?") as sess:
+            self.assertEqual("[Answer]", sess.root_answer)
+        store.close()
@@ -0,0 +1,44 @@
+import unittest
+
+import parsy
+
+from patchwork.datastore import Address, Datastore
+from patchwork.text_manipulation import LINK, OPEN, TEXT, CLOSE, canonicalize_pointer_names, \
+    create_raw_hypertext, insert_raw_hypertext, rename_pointers, tokenize
+
+
+class TestHypertextParsing(unittest.TestCase):
+    def testTokenize(self):
+        self.assertEqual([(TEXT, "Is ", 0), (OPEN, "[", 3), (LINK, "$a1", 4), (TEXT, " red", 7),
+                          (CLOSE, "]", 11), (TEXT, "?", 12)],
+                         tokenize("Is [$a1 red]?"))
+
+    def testNested(self):
+        db = Datastore()
+        pointer = Address()
+        hypertext = create_raw_hypertext("Is [$1 [red]]?", db, {"$1": pointer})
+        self.assertEqual(2, len(db.content))
+        nested = db.dereference(hypertext.links()[0])
+        self.assertEqual(pointer, nested.links()[0])
+        self.assertEqual("red", db.dereference(nested.links()[1]).to_str())
+
+    def testErrors(self):
+        for content, index in [("a]", 1), ("[a", 2), ("$0", 0), ("[$", 1)]:
+            db = Datastore()
+            with self.assertRaises(parsy.ParseError) as cm:
+                insert_raw_hypertext(content, db, {})
+            self.assertEqual(index, cm.exception.index)
+            self.assertEqual(0, len(db.content))
+        with self.assertRaises(KeyError):
+            insert_raw_hypertext("$1", Datastore(), {})
+
+
+class TestPointerNames(unittest.TestCase):
+    def testCanonicalize(self):
+        text, names = canonicalize_pointer_names("[$1: Is $3 in $q1?] [$2: $3 $10]")
+        self.assertEqual("[$1: Is $2 in $q1?] [$3: $2 $4]", text)
+        self.assertEqual({"$1": "$1", "$3": "$2", "$2": "$3", "$10": "$4"}, names)
+
+    def testRename(self):
+        # Renaming is simultaneous.
+        self.assertEqual("$2 $1 $a1 $5", rename_pointers("$1 $2 $a1 $5", {"$1": "$2", "$2": "$1"}))
@@ -0,0 +1,94 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from patchwork.actions import AskSubquestion, Reply, Unlock
+from patchwork.scheduling import RootQuestionSession
+from patchwork.wal import Journal
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "session.pickle")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def answerRoot(self, sched):
+        with RootQuestionSession(sched, "Root?") as sess:
+            sess.act(AskSubquestion("Sub1?"))
+            sess.act(Unlock("$a1"))
+            sess.act(Reply("Answer 1"))
+            sess.act(Reply("Root $a1."))
+            self.assertEqual("[Root [Answer 1].]", sess.root_answer)
+
+    def testRecovery(self):
+        """Test that actions survive a crash before the next checkpoint."""
+        journal = Journal(self.path, sync=False)
+        db, sched = journal.open()
+        journal.checkpoint()
+        self.answerRoot(sched)
+        db.wal.close() # Crash without a checkpoint.
+
+        db, sched = Journal(self.path, sync=False).open()
+        with RootQuestionSession(sched, "Root?") as sess:
+            self.assertEqual("[Root [Answer 1].]", sess.root_answer)
+
+    def testPendingRecovery(self):
+        """Test that the scheduler's pending contexts survive a crash."""
+        journal = Journal(self.path, sync=False)
+        db, sched = journal.open()
+        sess = RootQuestionSession(sched, "Root?")
+        sess.act(AskSubquestion("Sub1?"))
+        sess.act(AskSubquestion("Sub2?"))
+        journal.checkpoint()
+        _, sub1_answer, _ = db.dereference(sess.current_context.workspace_link).subquestions[0]
+        sched.resolve_action(sched.choose_context(sub1_answer), Reply("Answer 1"))
+        sess.act(AskSubquestion("Sub3?"))
+        expected = sorted(str(c) for c in list(sched.pending_contexts) + [sess.current_context])
+        db.wal.close() # Crash without a checkpoint.
+
+        db, sched = Journal(self.path, sync=False).open()
+        self.assertEqual(expected, sorted(str(c) for c in sched.pending_contexts))
+        self.assertEqual(3, len(sched.pending_contexts))
+        self.assertEqual(1, len(sched.root_answer_promises))
+        self.assertTrue(db.is_fulfilled(sub1_answer))
+
+    def testCheckpoint(self):
+        journal = Journal(self.path, sync=False)
+        db, sched = journal.open()
+        self.answerRoot(sched)
+        self.assertGreater(os.path.getsize(journal.log_path), 0)
+        journal.close()
+        self.assertEqual(0, os.path.getsize(journal.log_path))
+
+        db, sched = Journal(self.path, sync=False).open()
+        with RootQuestionSession(sched, "Root?") as sess:
+            self.assertEqual("[Root [Answer 1].]", sess.root_answer)
+
+    def testFailedCheckpoint(self):
+        """Test that background checkpoints carry on after one fails."""
+        journal = Journal(self.path, sync=False)
+        journal.open()
+        attempts = []
+        def failing_checkpoint():
+            attempts.append(None)
+            if len(attempts) == 1:
+                raise OSError("Disk full")
+            journal._stop.set()
+        journal.checkpoint = failing_checkpoint
+        with self.assertLogs("patchwork.wal") as logs:
+            journal.start(0.001)
+            journal._thread.join(5)
+        self.assertEqual(2, len(attempts))
+        self.assertIn("Disk full", logs.output[0])
+
+    def testOldCheckpoint(self):
+        """Test that checkpoints without a header are rejected."""
+        with open(self.path, "wb") as f:
+            pickle.dump(("db", "sched"), f)
+        with self.assertRaisesRegex(ValueError, "older version"):
+            Journal(self.path, sync=False).open()